@@ -0,0 +1,148 @@
+"""
+ Copyright 2021 Trustees of the University of Pennsylvania
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import threading
+import time
+
+from cachetools import Cache, LRUCache, TTLCache
+
+
+class _CountingLRUCache(LRUCache):
+    evictions = 0
+
+    def popitem(self):
+        item = LRUCache.popitem(self)
+        self.evictions += 1
+        return item
+
+
+class _CountingTTLCache(TTLCache):
+    evictions = 0
+    expirations = 0
+
+    def popitem(self):
+        item = TTLCache.popitem(self)
+        self.evictions += 1
+        return item
+
+    def expire(self, time=None):
+        # Counted without the size properties, which expire entries themselves
+        before = Cache.__len__(self)
+        expired = TTLCache.expire(self, time)
+        self.expirations += before - Cache.__len__(self)
+        return expired
+
+
+class GraphCache:
+    """
+    GraphCache is a read-through cache, in front of the graph store, of the
+    data of nodes (get_node) and of the nodes connected to a node by an edge
+    label (get_connected_to and get_connected_from), least recently used
+    entries evicted first, and optionally expiring after a time to live.
+
+    MProvConnection invalidates the entries of the nodes and edges in each
+    batch it writes, so a connection always reads its own writes.  Writes by
+    other connections are only seen once entries are evicted or expire, so
+    give a TTL if other processes write to the graph being read.
+    """
+    def __init__(self, maxsize=10000, ttl=None, timer=time.monotonic):
+        # type: (int, Optional[float], Any) -> None
+        """
+        :param maxsize: Most entries kept
+        :param ttl: Seconds an entry is kept, or None to keep it until evicted
+        :param timer: Clock the TTL is measured by
+        """
+        if ttl is None:
+            self._entries = _CountingLRUCache(maxsize=maxsize)
+        else:
+            self._entries = _CountingTTLCache(maxsize=maxsize, ttl=ttl, timer=timer)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def node_key(graph, token):
+        # type: (str, str) -> tuple
+        return 'node', graph, token
+
+    @staticmethod
+    def edges_key(graph, token, label, reverse=False):
+        # type: (str, str, Optional[str], bool) -> tuple
+        """
+        The key of the nodes with edges from a node, or with reverse=True the
+        nodes with edges to it; label is None for edges of any label
+        """
+        return 'to' if reverse else 'from', graph, token, label
+
+    def get(self, key):
+        # type: (Hashable) -> Any
+        """
+        The value cached under a key, or None
+        """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def put(self, key, value):
+        # type: (Hashable, Any) -> None
+        with self._lock:
+            self._entries[key] = value
+
+    def invalidate(self, key):
+        # type: (Hashable) -> None
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def invalidate_batch(self, batch):
+        # type: (WriteBatch) -> None
+        """
+        Drop the entries a batch written to the graph store makes stale: the
+        data of its nodes, and the adjacency of both ends of its edges, by
+        label and for any label
+        """
+        for key, resource, _ in batch.nodes:
+            self.invalidate(self.node_key(resource, key))
+        for prop in batch.props:
+            self.invalidate(self.node_key(prop[1], prop[0]))
+        for resource, from_key, to_key, label in batch.edges:
+            for edge_label in (label, None):
+                self.invalidate(self.edges_key(resource, from_key, edge_label))
+                self.invalidate(self.edges_key(resource, to_key, edge_label, reverse=True))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        # type: () -> Dict[str, Any]
+        """
+        Hits, misses, hit rate, entries evicted to make room, expired and
+        invalidated by writes, and the size of the cache
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                    'evictions': self._entries.evictions,
+                    'expirations': getattr(self._entries, 'expirations', 0),
+                    'invalidations': self.invalidations,
+                    'size': len(self._entries),
+                    'maxsize': self._entries.maxsize}
@@ -0,0 +1,162 @@
+"""
+ Copyright 2021 Trustees of the University of Pennsylvania
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import threading
+
+
+class _Closure:
+    """
+    The transitive closure of the edges of one graph.  Nodes are numbered
+    in the order they are first seen, and each node has the set of nodes it
+    reaches (its ancestors) and the set of nodes that reach it, so adding
+    an edge only touches the nodes whose ancestors it changes.
+    """
+    __slots__ = ('ids', 'keys', 'up', 'down')
+
+    def __init__(self):
+        self.ids = {}  # type: Dict[str, int]
+        self.keys = []  # type: List[str]
+        self.up = []  # type: List[Set[int]]
+        self.down = []  # type: List[Set[int]]
+
+    def node(self, key):
+        # type: (str) -> int
+        ret = self.ids.get(key)
+        if ret is None:
+            ret = self.ids[key] = len(self.keys)
+            self.keys.append(key)
+            self.up.append(set())
+            self.down.append(set())
+        return ret
+
+    def add_edge(self, from_key, to_key):
+        # type: (str, str) -> None
+        """
+        Record that from_key reaches to_key, and so everything to_key reaches,
+        as does every node that reaches from_key.  A node is never its own
+        ancestor, even on a cycle.
+        """
+        source, target = self.node(from_key), self.node(to_key)
+        reached = self.up[target] | {target}
+        if reached <= self.up[source]:
+            return
+        for node in self.down[source] | {source}:
+            added = reached - self.up[node]
+            added.discard(node)
+            self.up[node] |= added
+            for ancestor in added:
+                self.down[ancestor].add(node)
+
+    def reaches(self, from_key, to_key):
+        # type: (str, str) -> bool
+        source, target = self.ids.get(from_key), self.ids.get(to_key)
+        return source is not None and target is not None and target in self.up[source]
+
+    def ancestors(self, key):
+        # type: (str) -> Set[str]
+        node = self.ids.get(key)
+        if node is None:
+            return set()
+        return {self.keys[ancestor] for ancestor in self.up[node]}
+
+
+class ReachabilityIndex:
+    """
+    ReachabilityIndex keeps, for each node of a graph, every node it was
+    transitively derived from, generated by, used or made of, so asking
+    whether one node depends on another is a set lookup rather than a walk
+    of the graph.
+
+    The closure of a graph is loaded from the graph store the first time
+    it is asked about, then maintained from each batch MProvConnection
+    writes, so the cost of an edge is paid when it is stored.  Edges written
+    by other connections are only seen once the graph is loaded again (see
+    drop).  Memory grows with the number of (node, ancestor) pairs.
+    """
+    LABELS = ('wasDerivedFrom', 'used', 'wasGeneratedBy', 'hadMember')
+
+    def __init__(self, labels=LABELS):
+        # type: (Iterable[str]) -> None
+        """
+        :param labels: Edge labels to follow, from the dependent node to what it depends on
+        """
+        self.labels = tuple(labels)
+        self._graphs = {}  # type: Dict[str, _Closure]
+        self._lock = threading.Lock()
+
+    def is_loaded(self, graph):
+        # type: (str) -> bool
+        return graph in self._graphs
+
+    def load(self, graph, edges):
+        # type: (str, Iterable[Tuple[str, str, str]]) -> None
+        """
+        Build the closure of a graph from its (from, to, label) edges,
+        replacing any it had
+        """
+        closure = _Closure()
+        for from_key, to_key, label in edges:
+            if label in self.labels:
+                closure.add_edge(from_key, to_key)
+        with self._lock:
+            self._graphs[graph] = closure
+
+    def add_batch(self, batch):
+        # type: (WriteBatch) -> None
+        """
+        Add the edges of a batch written to the graph store to the closures
+        of the graphs loaded; the others pick them up when they are loaded
+        """
+        with self._lock:
+            for resource, from_key, to_key, label in batch.edges:
+                closure = self._graphs.get(resource)
+                if closure is not None and label in self.labels:
+                    closure.add_edge(from_key, to_key)
+
+    def depends_on(self, graph, token, source):
+        # type: (str, str, str) -> bool
+        """
+        Whether a node transitively depends on another
+        """
+        with self._lock:
+            return self._graphs[graph].reaches(token, source)
+
+    def ancestors(self, graph, token):
+        # type: (str, str) -> Set[str]
+        """
+        Every node a node transitively depends on
+        """
+        with self._lock:
+            return self._graphs[graph].ancestors(token)
+
+    def drop(self, graph):
+        # type: (str) -> None
+        """
+        Forget the closure of a graph, so it is loaded again when next used
+        """
+        with self._lock:
+            self._graphs.pop(graph, None)
+
+    def clear(self):
+        with self._lock:
+            self._graphs.clear()
+
+    def get_stats(self):
+        # type: () -> Dict[str, Any]
+        """
+        Graphs loaded, nodes, and (node, ancestor) pairs indexed
+        """
+        with self._lock:
+            return {'graphs': len(self._graphs),
+                    'nodes': sum(len(closure.keys) for closure in self._graphs.values()),
+                    'pairs': sum(len(ancestors) for closure in self._graphs.values() for ancestors in closure.up)}
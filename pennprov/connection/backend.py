@@ -0,0 +1,395 @@
+"""
+ Copyright 2021 Trustees of the University of Pennsylvania
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import functools
+
+import psycopg2
+
+from pennprov.connection.layout import TableLayout
+from pennprov.connection.prepared import PreparedStatements
+from pennprov.connection import migrations
+
+
+class StorageBackend:
+    """
+    A StorageBackend holds the nodes, properties and edges that
+    MProvConnection captures, and answers the lookups its queries are built
+    from.  Tokens, batches and property rows are the same in every backend;
+    only where and how they are stored differs.
+    """
+    name = None  # type: str
+
+    # The connection of the calling thread, if the backend has one
+    graph_conn = None
+
+    def create_graph(self, graph):
+        # type: (str) -> None
+        """
+        Get the store ready for a graph
+        """
+        pass
+
+    def reset_graph(self, graph):
+        # type: (str) -> None
+        """
+        Remove every node, property and edge of a graph
+        """
+        raise NotImplementedError
+
+    def write_epoch(self):
+        # type: () -> Any
+        """
+        The period being written to, for stores that keep each period
+        separately; when it changes, nodes already written are written again
+        """
+        return None
+
+    def write_batch(self, batch):
+        # type: (WriteBatch) -> None
+        """
+        Write a batch, all or nothing
+        """
+        raise NotImplementedError
+
+    def bulk_write(self, batch):
+        # type: (WriteBatch) -> None
+        """
+        Write a large batch, as fast as the store allows
+        """
+        self.write_batch(batch)
+
+    def open_writer(self):
+        # type: () -> Tuple[Any, Callable[[Any, WriteBatch], None]]
+        """
+        A connection for a background writer thread, and the function that
+        writes a batch through it
+        """
+        raise NotImplementedError
+
+    def node_props(self, graph, token):
+        # type: (str, str) -> List[tuple]
+        """
+        The properties of a node, as (index, code, value, ivalue, lvalue,
+        fvalue, dvalue, tvalue, tsvalue, label, jvalue) rows
+        """
+        raise NotImplementedError
+
+    def nodes_props(self, graph, tokens):
+        # type: (str, Sequence[str]) -> Dict[str, List[tuple]]
+        """
+        The properties of several nodes, as node_props() rows, by token
+        """
+        return {token: self.node_props(graph, token) for token in tokens}
+
+    def connected_props(self, graph, token, label):
+        # type: (str, str, str) -> Dict[str, List[tuple]]
+        """
+        The properties of the nodes with edges of a label to a node, as
+        node_props() rows, by token
+        """
+        return self.nodes_props(graph, self.connected(graph, token, label, reverse=True))
+
+    def producer_code_props(self, graph, token, operator_label):
+        # type: (str, str, str) -> Dict[str, List[tuple]]
+        """
+        The properties of the code entities named (by their property of
+        operator_label) by the activities that generated a node, as
+        node_props() rows, by token
+        """
+        code_ids = []
+        for activity in self.connected(graph, token, 'wasGeneratedBy'):
+            code_ids.extend(row[2] for row in self.node_props(graph, activity) if row[9] == operator_label)
+        return self.nodes_props(graph, code_ids)
+
+    def connected(self, graph, token, label=None, reverse=False):
+        # type: (str, str, str, bool) -> List[str]
+        """
+        The nodes a node has edges to, optionally only those with a label, or
+        with reverse=True the nodes with edges to it
+        """
+        raise NotImplementedError
+
+    def iter_connected(self, graph, token, label=None, reverse=False, after=None, limit=None, itersize=2000):
+        # type: (str, str, str, bool, str, int, int) -> Iterator[str]
+        """
+        Like connected(), each node once and in key order, starting after the
+        key after and stopping after limit nodes, so results can be paged
+        through by key.  Backends that can stream results read itersize rows
+        at a time.
+        """
+        nodes = sorted(set(self.connected(graph, token, label, reverse)))
+        if after is not None:
+            nodes = [node for node in nodes if node > after]
+        return iter(nodes if limit is None else nodes[:limit])
+
+    def iter_node_props(self, graph, token, itersize=2000):
+        # type: (str, str, int) -> Iterator[tuple]
+        """
+        Like node_props(), reading itersize rows at a time where the backend
+        can stream results
+        """
+        return iter(self.node_props(graph, token))
+
+    def edges(self, graph, labels, itersize=2000):
+        # type: (str, Sequence[str], int) -> Iterator[Tuple[str, str, str]]
+        """
+        Every edge of a graph with one of the labels, as (from, to, label),
+        reading itersize rows at a time where the backend can stream results
+        """
+        raise NotImplementedError
+
+    def find_nodes(self, graph, keys):
+        # type: (str, Sequence[str]) -> List[str]
+        """
+        Which of the keys are nodes of the graph
+        """
+        raise NotImplementedError
+
+    def lineage(self, graph, token, labels, reverse=False, max_depth=None, limit=None):
+        # type: (str, str, Sequence[str], bool, int, int) -> List[Tuple[str, str, str]]
+        """
+        The edges with the given labels reachable from a node, following edges
+        forward, or with reverse=True backward, as (from, to, label), nearest
+        first.  Each node is visited once, so cycles are followed once.
+
+        This breadth-first search makes a call of connected() per node and
+        label; backends that can find them in one query override it.
+
+        :param max_depth: Most edges from the node to follow, or None for any number
+        :param limit: Most edges to return, or None for all
+        """
+        edges = []  # type: List[Tuple[str, str, str]]
+        seen = {token}
+        frontier = [token]
+        depth = 0
+        while frontier and (max_depth is None or depth < max_depth):
+            depth += 1
+            reached = []
+            for node in frontier:
+                for label in labels:
+                    for other in self.connected(graph, node, label, reverse):
+                        edges.append((other, node, label) if reverse else (node, other, label))
+                        if limit is not None and len(edges) >= limit:
+                            return edges
+                        if other not in seen:
+                            seen.add(other)
+                            reached.append(other)
+            frontier = reached
+        return edges
+
+    def read_batches(self, graph, batch_size=10000):
+        # type: (str, int) -> Iterator[WriteBatch]
+        """
+        Every node, property and edge of a graph, in batches that can be
+        written to another store in order
+        """
+        raise NotImplementedError
+
+    def get_statement_stats(self):
+        # type: () -> Dict[str, Dict[str, float]]
+        return {}
+
+    def close(self):
+        pass
+
+
+class PostgresBackend(StorageBackend):
+    """
+    The PostgreSQL graph store, in the tables of a storage layout (see
+    pennprov.connection.layout).  Connecting applies any schema migrations
+    the database has not seen yet (see pennprov.connection.migrations).
+    """
+    name = 'postgres'
+
+    def __init__(self, host, database, user, password, layout=None, prepare_statements=True):
+        # type: (str, str, str, str, TableLayout, bool) -> None
+        """
+        :param layout: Storage layout of the graph tables, TableLayout by default
+        :param prepare_statements: PREPARE the hot statements once per session
+        """
+        self._connect_args = dict(host=host, database=database, user=user, password=password)
+        self.layout = layout or TableLayout()
+        self.prepare_statements = prepare_statements
+        self.graph_conn = self.connect()
+        self.statements = PreparedStatements(self.layout.STATEMENTS, prepare_statements)
+        self.writer_statements = None  # type: PreparedStatements
+        self.schema_version = migrations.upgrade(self.graph_conn)
+        # Idle connections for server-side cursors (see _stream)
+        self._readers = []  # type: List[Any]
+
+    def connect(self):
+        """
+        A new connection to the graph database
+        """
+        return psycopg2.connect(**self._connect_args)
+
+    def create_graph(self, graph):
+        # type: (str) -> None
+        self.layout.create_graph(self.graph_conn, graph)
+
+    def reset_graph(self, graph):
+        # type: (str) -> None
+        self.layout.reset_graph(self.graph_conn, graph)
+
+    def write_epoch(self):
+        # type: () -> Any
+        return self.layout.write_epoch()
+
+    @staticmethod
+    def write_rows(graph_conn, batch, statements, layout):
+        # type: (Any, WriteBatch, PreparedStatements, TableLayout) -> None
+        """
+        Write a batch with a single call of the layout's write function
+        """
+        if len(batch) == 0:
+            return
+        columns = layout.columns(graph_conn, batch)
+        with graph_conn as conn:
+            with conn.cursor() as cursor:
+                statements.execute(cursor, 'mprov_write_batch', columns)
+
+    def write_batch(self, batch):
+        # type: (WriteBatch) -> None
+        self.write_rows(self.graph_conn, batch, self.statements, self.layout)
+
+    def bulk_write(self, batch):
+        # type: (WriteBatch) -> None
+        """
+        Stream a batch with COPY into temporary staging tables, and merge
+        them into the graph
+        """
+        self.layout.prepare_batch(self.graph_conn, batch)
+        with self.graph_conn as conn:
+            with conn.cursor() as cursor:
+                batch.copy(cursor, self.layout.MERGE_STAGING)
+
+    def open_writer(self):
+        # type: () -> Tuple[Any, Callable[[Any, WriteBatch], None]]
+        self.writer_statements = PreparedStatements(self.layout.STATEMENTS, self.prepare_statements)
+        return self.connect(), functools.partial(self.write_rows, statements=self.writer_statements,
+                                                 layout=self.layout)
+
+    def node_props(self, graph, token):
+        # type: (str, str) -> List[tuple]
+        with self.graph_conn as conn:
+            with conn.cursor() as cursor:
+                self.statements.execute(cursor, 'mprov_node_props', (graph, token))
+                return cursor.fetchall()
+
+    def nodes_props(self, graph, tokens):
+        # type: (str, Sequence[str]) -> Dict[str, List[tuple]]
+        ret = {token: [] for token in tokens}
+        if not ret:
+            return ret
+        return self._props_by_key('mprov_nodes_props', (graph, list(ret)), ret)
+
+    def connected_props(self, graph, token, label):
+        # type: (str, str, str) -> Dict[str, List[tuple]]
+        return self._props_by_key('mprov_connected_to_props', (graph, token, label))
+
+    def producer_code_props(self, graph, token, operator_label):
+        # type: (str, str, str) -> Dict[str, List[tuple]]
+        return self._props_by_key('mprov_producer_code_props', (graph, token, operator_label))
+
+    def _props_by_key(self, name, params, ret=None):
+        # type: (str, tuple, Dict[str, List[tuple]]) -> Dict[str, List[tuple]]
+        """
+        Run a statement returning a key and a node property per row, and
+        group the properties by key
+        """
+        if ret is None:
+            ret = {}
+        with self.graph_conn as conn:
+            with conn.cursor() as cursor:
+                self.statements.execute(cursor, name, params)
+                for row in cursor.fetchall():
+                    props = ret.setdefault(row[0], [])
+                    # Outer joins give a node without properties a NULL label
+                    if row[10] is not None:
+                        props.append(row[1:])
+        return ret
+
+    def connected(self, graph, token, label=None, reverse=False):
+        # type: (str, str, str, bool) -> List[str]
+        name = 'mprov_connected_to' if reverse else 'mprov_connected_from'
+        with self.graph_conn as conn:
+            with conn.cursor() as cursor:
+                if label is None:
+                    self.statements.execute(cursor, name, (graph, token))
+                else:
+                    self.statements.execute(cursor, name + '_label', (graph, token, label))
+                return [x[0] for x in cursor.fetchall()]
+
+    def iter_connected(self, graph, token, label=None, reverse=False, after=None, limit=None, itersize=2000):
+        # type: (str, str, str, bool, str, int, int) -> Iterator[str]
+        query = self.layout.connected_query(reverse, label is not None, after is not None)
+        params = {'graph': graph, 'token': token, 'label': label, 'after': after, 'limit': limit}
+        for row in self._stream(query, params, itersize):
+            yield row[0]
+
+    def iter_node_props(self, graph, token, itersize=2000):
+        # type: (str, str, int) -> Iterator[tuple]
+        return self._stream(self.layout.STATEMENTS['mprov_node_props'][0], (graph, token), itersize)
+
+    def edges(self, graph, labels, itersize=2000):
+        # type: (str, Sequence[str], int) -> Iterator[Tuple[str, str, str]]
+        return self._stream(self.layout.edges_query(), {'graph': graph, 'labels': list(labels)}, itersize)
+
+    def _stream(self, query, params, itersize):
+        # type: (str, Any, int) -> Iterator[tuple]
+        """
+        The rows of a query, read itersize at a time through a named
+        (server-side) cursor.  The cursor lives in a transaction of its own,
+        on a connection of its own, so the graph connection can be used while
+        iterating, and iterations can be nested.
+        """
+        conn = self._readers.pop() if self._readers else self.connect()
+        try:
+            with conn:
+                with conn.cursor(name='mprov_stream') as cursor:
+                    cursor.itersize = itersize
+                    cursor.execute(query, params)
+                    for row in cursor:
+                        yield row
+        finally:
+            if not conn.closed:
+                self._readers.append(conn)
+
+    def find_nodes(self, graph, keys):
+        # type: (str, Sequence[str]) -> List[str]
+        with self.graph_conn as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(self.layout.FIND_NODES, (graph, list(keys)))
+                return [x[0] for x in cursor.fetchall()]
+
+    def lineage(self, graph, token, labels, reverse=False, max_depth=None, limit=None):
+        # type: (str, str, Sequence[str], bool, int, int) -> List[Tuple[str, str, str]]
+        with self.graph_conn as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(self.layout.lineage_query(reverse, max_depth is not None),
+                               {'graph': graph, 'token': token, 'labels': list(labels),
+                                'max_depth': max_depth, 'limit': limit})
+                return [tuple(row) for row in cursor.fetchall()]
+
+    def get_statement_stats(self):
+        # type: () -> Dict[str, Dict[str, float]]
+        stats = self.statements.get_stats()
+        if self.writer_statements is not None:
+            for name, writer_stats in self.writer_statements.get_stats().items():
+                stats['writer:' + name] = writer_stats
+        return stats
+
+    def close(self):
+        while self._readers:
+            self._readers.pop().close()
+        self.graph_conn.close()
@@ -0,0 +1,355 @@
+"""
+ Copyright 2021 Trustees of the University of Pennsylvania
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import datetime
+import io
+import json
+import weakref
+
+from pennprov.metadata.stream_metadata import BasicTuple
+
+# Property column and code used for values of each Python type
+VALUE_TYPES = {
+    int: ('ivalue', 'I'),
+    float: ('fvalue', 'F'),
+    datetime.datetime: ('tsvalue', 't'),
+    str: ('value', 'S'),
+}
+
+# Property column, code and accepted Python types for each type name a
+# BasicSchema may declare
+SCHEMA_TYPES = {
+    'int': ('ivalue', 'I', (int,)),
+    'integer': ('ivalue', 'I', (int,)),
+    'long': ('lvalue', 'L', (int,)),
+    'bigint': ('lvalue', 'L', (int,)),
+    'float': ('fvalue', 'F', (float, int)),
+    'real': ('fvalue', 'F', (float, int)),
+    'double': ('dvalue', 'D', (float, int)),
+    'date': ('tvalue', 'T', (datetime.date,)),
+    'datetime': ('tsvalue', 't', (datetime.datetime,)),
+    'timestamp': ('tsvalue', 't', (datetime.datetime,)),
+    'str': ('value', 'S', (str,)),
+    'string': ('value', 'S', (str,)),
+    'text': ('value', 'S', (str,)),
+}
+
+# Compiled column mappings, by schema (see compile_schema)
+_schema_plans = weakref.WeakKeyDictionary()
+
+
+def _json_default(value):
+    # type: (Any) -> str
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value)
+
+
+def tuple_json(data):
+    # type: (Any) -> str
+    """
+    Encode the fields of a BasicTuple or dict as a JSON object.  Dates and
+    timestamps become ISO 8601 strings, and other values JSON cannot hold
+    their str().
+    """
+    if isinstance(data, BasicTuple):
+        data = {field: data[field] for field in data.schema.fields}
+    return json.dumps(data, default=_json_default)
+
+
+def _copy_text(value):
+    # type: (Any) -> str
+    """
+    Encode a value as a field of PostgreSQL's COPY text format
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        value = int(value)
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def value_column(value):
+    # type: (Any) -> Tuple[str, str]
+    """
+    The property column and code for a value, from its Python type
+    """
+    column = VALUE_TYPES.get(type(value))
+    if column is not None:
+        return column
+    if isinstance(value, bool):
+        return VALUE_TYPES[int]
+    for python_type, column in VALUE_TYPES.items():
+        if isinstance(value, python_type):
+            return column
+    return 'value', 'S'
+
+
+def compile_schema(schema):
+    # type: (BasicSchema) -> List[Tuple[str, str, str, tuple]]
+    """
+    Map each field of a BasicSchema to the property column and code its
+    declared type is stored in, so tuples of the schema need no per-value type
+    dispatch.  Fields of undeclared or unknown type map to a None column.
+    The mapping is cached per schema, and rebuilt if fields are added.
+
+    :return: List of (field, column, code, accepted Python types)
+    """
+    plan = _schema_plans.get(schema)
+    if plan is None or len(plan) != len(schema.fields):
+        plan = []
+        for i, field in enumerate(schema.fields):
+            declared = schema.types[i] if i < len(schema.types) else None
+            column, code, accepted = SCHEMA_TYPES.get(str(declared).lower(), (None, None, ()))
+            plan.append((field, column, code, accepted))
+        _schema_plans[schema] = plan
+    return plan
+
+
+class WriteBatch:
+    """
+    WriteBatch collects the node, node property and edge rows produced by
+    one or more store_* calls, so they can be sent to the graph store as a
+    single call rather than one statement per row.
+    """
+    PROP_COLUMNS = ('_key', '_resource', 'label', 'code', 'index',
+                    'value', 'ivalue', 'lvalue', 'dvalue', 'fvalue', 'tvalue', 'tsvalue', 'jvalue')
+    VALUE_COLUMNS = PROP_COLUMNS[5:]
+    _VALUE_POSITIONS = {column: i for i, column in enumerate(VALUE_COLUMNS)}
+
+    # Label of the property holding a whole tuple, and its code when the tuple
+    # is a JSONB object (see add_json) or a schema ID and array (see add_positional)
+    TUPLE_LABEL = '_tuple'
+    TUPLE_CODE = 'J'
+    POSITIONAL_CODE = 'P'
+
+    # MProv_WriteBatch, the server-side function that writes a whole batch in
+    # one round trip, with each column passed as an array.  Installed by the
+    # versioned migrations in migrations.py.  Its argument types, in the
+    # order of columns():
+    WRITE_TYPES = ('VARCHAR[]', 'VARCHAR[]', 'VARCHAR[]',
+                   'VARCHAR[]', 'VARCHAR[]', 'VARCHAR[]', 'CHAR(1)[]', 'BIGINT[]',
+                   'VARCHAR[]', 'INTEGER[]', 'BIGINT[]', 'DOUBLE PRECISION[]', 'REAL[]', 'DATE[]', 'TIMESTAMP[]',
+                   'JSONB[]',
+                   'VARCHAR[]', 'VARCHAR[]', 'VARCHAR[]', 'VARCHAR[]')
+    WRITE_SQL = "SELECT MProv_WriteBatch(" + ','.join(['%s'] * len(WRITE_TYPES)) + ")"
+
+    # Session-local tables that copy() streams rows into before merging them
+    STAGING_TABLES = """
+                     CREATE TEMP TABLE IF NOT EXISTS MProv_Node_Staging(_key VARCHAR(80),
+                                                                        _resource VARCHAR(80),
+                                                                        label VARCHAR(80))
+                       ON COMMIT DELETE ROWS;
+                     CREATE TEMP TABLE IF NOT EXISTS MProv_NodeProp_Staging(_key VARCHAR(80),
+                                                                            _resource VARCHAR(80),
+                                                                            label VARCHAR(80),
+                                                                            code CHAR(1),
+                                                                            index BIGINT,
+                                                                            value VARCHAR,
+                                                                            ivalue INTEGER,
+                                                                            lvalue BIGINT,
+                                                                            dvalue DOUBLE PRECISION,
+                                                                            fvalue REAL,
+                                                                            tvalue DATE,
+                                                                            tsvalue TIMESTAMP,
+                                                                            jvalue JSONB)
+                       ON COMMIT DELETE ROWS;
+                     CREATE TEMP TABLE IF NOT EXISTS MProv_Edge_Staging(_resource VARCHAR(80),
+                                                                        _from VARCHAR(80),
+                                                                        _to VARCHAR(80),
+                                                                        label VARCHAR(80))
+                       ON COMMIT DELETE ROWS;
+                     """
+
+    # Statements merging the staged nodes, properties and edges into the graph
+    MERGE_STAGING = ("INSERT INTO MProv_Node(_key,_resource,label) "
+                     "SELECT _key,_resource,label FROM MProv_Node_Staging ON CONFLICT DO NOTHING",
+                     "INSERT INTO MProv_NodeProp(" + ','.join(PROP_COLUMNS) + ") "
+                     "SELECT " + ','.join(PROP_COLUMNS) + " FROM MProv_NodeProp_Staging ON CONFLICT DO NOTHING",
+                     "INSERT INTO MProv_Edge(_resource,_from,_to,label) "
+                     "SELECT _resource,_from,_to,label FROM MProv_Edge_Staging ON CONFLICT DO NOTHING")
+
+    def __init__(self, written=None, pending=None):
+        # type: (WrittenSet, Set[tuple]) -> None
+        """
+        :param written: Optional set of node and edge keys known to be in the
+            graph store already; rows for them are skipped
+        :param pending: Optional set of the keys of rows in an earlier batch
+            that is yet to be written; rows for them are skipped too
+        """
+        self.nodes = []
+        self.props = []
+        self.edges = []
+        self.written = written
+        self.pending = pending
+        # Keys of the nodes and edges added to this batch, to be recorded in
+        # the written set once the batch has been committed
+        self.new_keys = []
+
+    def __len__(self):
+        return len(self.nodes) + len(self.props) + len(self.edges)
+
+    def add_node(self, resource, key, label):
+        # type: (str, str, str) -> bool
+        """
+        Add a node, unless it is known to be written already
+        :return: True if the node was added
+        """
+        if self.written is not None:
+            written_key = ('N', resource, key)
+            if self._is_written(written_key):
+                return False
+            self.new_keys.append(written_key)
+        self.nodes.append((key, resource, label))
+        return True
+
+    def add_prop(self, resource, key, label, value, column='value', code=None, index=None):
+        # type: (str, str, str, Any, str, str, int) -> None
+        """
+        Add a node property, stored in the given typed value column
+        """
+        values = [None] * len(self.VALUE_COLUMNS)
+        values[self.VALUE_COLUMNS.index(column)] = value
+        self.props.append((key, resource, label, code, index) + tuple(values))
+
+    def add_tuple(self, resource, key, data):
+        # type: (str, str, Any) -> None
+        """
+        Add a property for each field of a BasicTuple or dict.  BasicTuple
+        fields use the columns compiled from their schema; values that do not
+        match the declared type, or whose type is undeclared, are dispatched
+        on their own type.
+        """
+        if isinstance(data, BasicTuple):
+            for field, column, code, accepted in compile_schema(data.schema):
+                v = data[field]
+                if column is None or (v is not None and not isinstance(v, accepted)):
+                    column, code = value_column(v)
+                self._add_value(resource, key, field, v, column, code)
+        else:
+            for field, v in data.items():
+                column, code = value_column(v)
+                self._add_value(resource, key, field, v, column, code)
+
+    def add_json(self, resource, key, data):
+        # type: (str, str, Any) -> None
+        """
+        Add a BasicTuple or dict as a single property, holding all of its
+        fields as a JSONB object
+        """
+        self._add_value(resource, key, self.TUPLE_LABEL, tuple_json(data), 'jvalue', self.TUPLE_CODE)
+
+    def add_positional(self, resource, key, schema_id, data):
+        # type: (str, str, str, BasicTuple) -> None
+        """
+        Add a BasicTuple as a single property: the ID its schema is registered
+        under (see SchemaRegistry) and a JSONB array of its values, in the
+        order of the schema's fields
+        """
+        values = [None] * len(self.VALUE_COLUMNS)
+        values[self._VALUE_POSITIONS['value']] = schema_id
+        values[self._VALUE_POSITIONS['jvalue']] = json.dumps([data[field] for field in data.schema.fields],
+                                                             default=_json_default)
+        self.props.append((key, resource, self.TUPLE_LABEL, self.POSITIONAL_CODE, None) + tuple(values))
+
+    def _add_value(self, resource, key, label, value, column, code):
+        if column == 'value' and value is not None and not isinstance(value, str):
+            value = str(value)
+        elif isinstance(value, bool):
+            value = int(value)
+        values = [None] * len(self.VALUE_COLUMNS)
+        values[self._VALUE_POSITIONS[column]] = value
+        self.props.append((key, resource, label, code, None) + tuple(values))
+
+    def add_edge(self, resource, from_key, to_key, label):
+        # type: (str, str, str, str) -> bool
+        """
+        Add an edge, unless it is known to be written already
+        :return: True if the edge was added
+        """
+        if self.written is not None:
+            written_key = ('E', resource, from_key, to_key, label)
+            if self._is_written(written_key):
+                return False
+            self.new_keys.append(written_key)
+        self.edges.append((resource, from_key, to_key, label))
+        return True
+
+    def _is_written(self, written_key):
+        # type: (tuple) -> bool
+        return (self.pending is not None and written_key in self.pending) or written_key in self.written
+
+    def extend(self, other):
+        # type: (WriteBatch) -> None
+        self.nodes.extend(other.nodes)
+        self.props.extend(other.props)
+        self.edges.extend(other.edges)
+        self.new_keys.extend(other.new_keys)
+
+    def clear(self):
+        self.nodes = []
+        self.props = []
+        self.edges = []
+        self.new_keys = []
+
+    def columns(self):
+        """
+        The batch transposed into one list per column, in MProv_WriteBatch's
+        argument order.  Written with a single call of WRITE_SQL, which inserts
+        the nodes first, since the property and edge tables reference them.
+        """
+        return self._transpose(self.nodes, 3) + \
+            self._transpose(self.props, len(self.PROP_COLUMNS)) + \
+            self._transpose(self.edges, 4)
+
+    @staticmethod
+    def _transpose(rows, width):
+        if not rows:
+            return [[] for i in range(width)]
+        return [list(column) for column in zip(*rows)]
+
+    def copy(self, cursor, merge=None):
+        """
+        Write the batch through the cursor using COPY into the staging tables,
+        then merge the staged rows into the graph tables.  Staged rows are
+        discarded when the enclosing transaction commits.
+
+        :param cursor: Database cursor
+        :param merge: Node, property and edge merge statements, MERGE_STAGING by default
+        """
+        cursor.execute(self.STAGING_TABLES)
+        self.stage(cursor)
+
+        for rows, statement in zip((self.nodes, self.props, self.edges), merge or self.MERGE_STAGING):
+            if rows:
+                cursor.execute(statement)
+
+    def stage(self, cursor, tables=('MProv_Node_Staging', 'MProv_NodeProp_Staging', 'MProv_Edge_Staging')):
+        """
+        Write the batch through the cursor using COPY into node, property and
+        edge tables with the columns of the staging tables
+        """
+        self._copy_rows(cursor, tables[0], ('_key', '_resource', 'label'), self.nodes)
+        self._copy_rows(cursor, tables[1], self.PROP_COLUMNS, self.props)
+        self._copy_rows(cursor, tables[2], ('_resource', '_from', '_to', 'label'), self.edges)
+
+    @staticmethod
+    def _copy_rows(cursor, table, columns, rows):
+        if not rows:
+            return
+        data = io.StringIO()
+        for row in rows:
+            data.write('\t'.join(_copy_text(v) for v in row))
+            data.write('\n')
+        data.seek(0)
+        cursor.copy_expert("COPY " + table + "(" + ','.join(columns) + ") FROM STDIN", data)
@@ -0,0 +1,99 @@
+"""
+ Copyright 2021 Trustees of the University of Pennsylvania
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+
+ Micro-benchmarks for provenance capture.  Run as
+
+     python -m pennprov.connection.benchmark tokens
+     python -m pennprov.connection.benchmark capture --backends postgres sqlite memory
+"""
+from __future__ import print_function
+
+import argparse
+import logging
+import os
+import tempfile
+import time
+import timeit
+
+from pennprov.connection.mprov import MProvConnection
+from pennprov.connection.tokens import Blake2bTokenGenerator, Pbkdf2TokenGenerator
+
+
+def bench_tokens(number=10000):
+    # type: (int) -> Dict[str, float]
+    """
+    Time token generation
+    :param number: Number of tokens to generate per generator
+    :return: Seconds per token, by generator
+    """
+    operator = 'e_v2.3f786850e387550fdab836ed7e6dc881de23001b'
+    location = 'w[[1, 1], [3, 1]]'
+    code = 'def test(n):\n    return n.groupby(\'x\').count()\n'
+    # Time the code IDs without the memo in front of them
+    get_code_id = MProvConnection.get_code_id.__wrapped__
+
+    timings = {
+        'activity/pbkdf2': lambda: Pbkdf2TokenGenerator().activity_id(operator, location),
+        'activity/blake2b': lambda: Blake2bTokenGenerator().activity_id(operator, location),
+        'code/v1 (pbkdf2)': lambda: get_code_id(code, 1),
+        'code/v2 (blake2b)': lambda: get_code_id(code, 2),
+    }
+    return {name: timeit.timeit(fn, number=number) / number for name, fn in timings.items()}
+
+
+def bench_capture(number=1000, backends=('postgres', 'sqlite', 'memory')):
+    # type: (int, Sequence[str]) -> Dict[str, float]
+    """
+    Time store_stream_tuple, each tuple written and committed on its own, on
+    each storage backend.  The SQLite database is a temporary file; backends
+    that cannot be reached are skipped.
+    :param number: Number of tuples to store per backend
+    :return: Seconds per tuple, by backend
+    """
+    timings = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for backend in backends:
+            try:
+                conn = MProvConnection(backend=backend, path=os.path.join(directory, backend + '.db'))
+            except Exception as e:
+                logging.warning('Skipping the %s backend: %s', backend, e)
+                continue
+            conn.set_graph('mProv-benchmark')
+            conn.create_or_reset_graph()
+            start = time.perf_counter()
+            for i in range(number):
+                conn.store_stream_tuple('benchmark_stream', i, {'name': 'tuple %d' % i, 'value': i})
+            timings['capture/' + backend] = (time.perf_counter() - start) / number
+            conn.create_or_reset_graph()
+            conn.close()
+    return timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Provenance capture micro-benchmarks')
+    parser.add_argument('benchmark', choices=['tokens', 'capture'])
+    parser.add_argument('-n', '--number', type=int, default=1000, help='Iterations per measurement')
+    parser.add_argument('--backends', nargs='+', default=['postgres', 'sqlite', 'memory'],
+                        choices=sorted(MProvConnection.BACKENDS), help='Storage backends to compare')
+    args = parser.parse_args(argv)
+
+    if args.benchmark == 'tokens':
+        results = bench_tokens(args.number)
+    elif args.benchmark == 'capture':
+        results = bench_capture(args.number, args.backends)
+
+    for name, seconds in results.items():
+        print('%-24s %12.2f us' % (name, seconds * 1e6))
+
+
+if __name__ == '__main__':
+    main()
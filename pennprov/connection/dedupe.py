@@ -0,0 +1,65 @@
+"""
+ Copyright 2021 Trustees of the University of Pennsylvania
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import threading
+
+from cachetools import LRUCache
+
+
+class WrittenSet:
+    """
+    WrittenSet is a bounded, least-recently-used set of the node and edge keys
+    a connection has already written, so repeated inserts that the graph store
+    would discard with ON CONFLICT DO NOTHING can be skipped client-side.
+    Keys are added once their rows are committed, possibly by the background
+    writer's thread, so it is thread-safe.
+    """
+    def __init__(self, maxsize=100000):
+        # type: (int) -> None
+        self._keys = LRUCache(maxsize=maxsize)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        # type: (Any) -> bool
+        with self._lock:
+            if key in self._keys:
+                # Reading the entry marks it as recently used
+                self._keys[key]
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def __len__(self):
+        return len(self._keys)
+
+    def update(self, keys):
+        # type: (Iterable) -> None
+        with self._lock:
+            for key in keys:
+                self._keys[key] = True
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+    def get_stats(self):
+        # type: () -> Dict[str, Any]
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'size': len(self._keys),
+                'maxsize': self._keys.maxsize}
@@ -0,0 +1,199 @@
+"""
+ Copyright 2021 Trustees of the University of Pennsylvania
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import logging
+import threading
+import time
+
+from pennprov.connection.batch import WriteBatch
+
+# UNLOGGED tables shared by every connection writing in staged mode, with the
+# columns of the temporary staging tables and the time each row was staged
+INGEST_TABLES = ('MProv_Node_Ingest', 'MProv_NodeProp_Ingest', 'MProv_Edge_Ingest')
+
+_NODE_COLUMNS = ('_key', '_resource', 'label')
+_EDGE_COLUMNS = ('_resource', '_from', '_to', 'label')
+
+# Move the staged properties and edges of nodes missing from a layout's node
+# table into the rejected tables, once the staged nodes have been merged
+_REJECT_PROPS = ("WITH rejected AS (DELETE FROM MProv_NodeProp_Staging s WHERE NOT EXISTS ("
+                 "SELECT 1 FROM {nodes} n WHERE n._resource = s._resource AND n._key = s._key) "
+                 "RETURNING " + ','.join('s.' + column for column in WriteBatch.PROP_COLUMNS) + "), "
+                 "moved AS (INSERT INTO MProv_NodeProp_Rejected(" + ','.join(WriteBatch.PROP_COLUMNS) + ") "
+                 "SELECT * FROM rejected RETURNING 1) SELECT count(*) FROM moved")
+_REJECT_EDGES = ("WITH rejected AS (DELETE FROM MProv_Edge_Staging s WHERE NOT EXISTS ("
+                 "SELECT 1 FROM {nodes} n WHERE n._resource = s._resource AND n._key = s._from) OR NOT EXISTS ("
+                 "SELECT 1 FROM {nodes} n WHERE n._resource = s._resource AND n._key = s._to) "
+                 "RETURNING " + ','.join('s.' + column for column in _EDGE_COLUMNS) + "), "
+                 "moved AS (INSERT INTO MProv_Edge_Rejected(" + ','.join(_EDGE_COLUMNS) + ") "
+                 "SELECT * FROM rejected RETURNING 1) SELECT count(*) FROM moved")
+
+
+class StagedIngest:
+    """
+    StagedIngest writes batches with COPY into UNLOGGED ingest tables, which
+    skip the write-ahead log, and periodically merges them into the graph
+    tables of the layout in bulk.  Rows staged but not yet merged are lost if
+    the database server crashes, since PostgreSQL empties unlogged tables on
+    recovery.
+
+    Merges run on a timer thread with a connection of its own, and whenever
+    merge() is called (as MProvConnection.flush() does).  Merges of all
+    connections are serialized, and each claims every committed batch with a
+    single statement, so nodes are merged along with their properties and
+    edges.  Properties and edges of nodes that do not exist are moved to the
+    MProv_NodeProp_Rejected and MProv_Edge_Rejected tables, so one bad row
+    cannot fail every later merge.
+    """
+    # One statement, and so one snapshot, moves the staged rows of every table
+    CLAIM = ("WITH nodes AS (DELETE FROM MProv_Node_Ingest RETURNING " + ','.join(_NODE_COLUMNS) + "), "
+             "props AS (DELETE FROM MProv_NodeProp_Ingest RETURNING " + ','.join(WriteBatch.PROP_COLUMNS) + "), "
+             "edges AS (DELETE FROM MProv_Edge_Ingest RETURNING " + ','.join(_EDGE_COLUMNS) + "), "
+             "staged_nodes AS (INSERT INTO MProv_Node_Staging(" + ','.join(_NODE_COLUMNS) + ") "
+             "SELECT * FROM nodes RETURNING 1), "
+             "staged_props AS (INSERT INTO MProv_NodeProp_Staging(" + ','.join(WriteBatch.PROP_COLUMNS) + ") "
+             "SELECT * FROM props RETURNING 1), "
+             "staged_edges AS (INSERT INTO MProv_Edge_Staging(" + ','.join(_EDGE_COLUMNS) + ") "
+             "SELECT * FROM edges RETURNING 1) "
+             "SELECT (SELECT count(*) FROM staged_nodes), (SELECT count(*) FROM staged_props), "
+             "(SELECT count(*) FROM staged_edges)")
+
+    # Rows waiting to be merged, and the age in seconds of the oldest
+    LAG = ("SELECT count(*), EXTRACT(EPOCH FROM now() - min(_staged)) FROM ("
+           "SELECT _staged FROM MProv_Node_Ingest UNION ALL SELECT _staged FROM MProv_NodeProp_Ingest "
+           "UNION ALL SELECT _staged FROM MProv_Edge_Ingest) staged")
+
+    REJECTED = "SELECT (SELECT count(*) FROM MProv_NodeProp_Rejected) + (SELECT count(*) FROM MProv_Edge_Rejected)"
+
+    def __init__(self, layout, merge_conn=None, merge_interval=5.0):
+        # type: (TableLayout, Any, float) -> None
+        """
+        :param layout: Storage layout of the graph tables merged into
+        :param merge_conn: Database connection owned by the timer thread, or None for no timer
+        :param merge_interval: Seconds between merges on the timer thread
+        """
+        self.layout = layout
+        self.merge_interval = merge_interval
+        self.staged = 0
+        self.merged = 0
+        self.rejected = 0
+        self.merges = 0
+        self.last_merge = None  # type: float
+        self.merge_seconds = 0.0
+
+        self._lock = threading.Lock()
+        self._error = None
+        self._stop = threading.Event()
+        self._merge_conn = merge_conn
+        self._thread = None
+        if merge_conn is not None and merge_interval:
+            self._thread = threading.Thread(target=self._run, name='mprov-merger', daemon=True)
+            self._thread.start()
+
+    def stage(self, graph_conn, batch):
+        # type: (Any, WriteBatch) -> None
+        """
+        Write a batch into the ingest tables, and commit it
+        """
+        if len(batch) == 0:
+            return
+        self.layout.prepare_batch(graph_conn, batch)
+        with graph_conn as conn:
+            with conn.cursor() as cursor:
+                batch.stage(cursor, INGEST_TABLES)
+        with self._lock:
+            self.staged += len(batch)
+
+    def merge(self, graph_conn):
+        # type: (Any) -> int
+        """
+        Move every staged row into the graph tables, in one transaction
+        :return: Number of rows merged
+        """
+        start = time.perf_counter()
+        with graph_conn as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(hashtext('MProv_Ingest'))")
+                cursor.execute(WriteBatch.STAGING_TABLES)
+                cursor.execute(self.CLAIM)
+                counts = cursor.fetchone()
+                rejected = 0
+                for i, (count, statement) in enumerate(zip(counts, self.layout.MERGE_STAGING)):
+                    if count and i > 0 and self.layout.NODE_TABLE is not None:
+                        cursor.execute((_REJECT_PROPS, _REJECT_EDGES)[i - 1].format(nodes=self.layout.NODE_TABLE))
+                        rejected += cursor.fetchone()[0]
+                    if count:
+                        cursor.execute(statement)
+
+        if rejected:
+            logging.warning('Rejected %d staged rows of nodes that do not exist', rejected)
+        merged = sum(counts) - rejected
+        with self._lock:
+            self.merged += merged
+            self.rejected += rejected
+            self.merges += 1
+            self.last_merge = time.time()
+            self.merge_seconds += time.perf_counter() - start
+        return merged
+
+    def get_stats(self, graph_conn):
+        # type: (Any) -> Dict[str, Any]
+        """
+        Rows staged, merged and rejected by this connection, merges run and
+        their total seconds, seconds since the last merge, the staging lag:
+        rows waiting in the ingest tables and the age of the oldest, in
+        seconds, and the rows in the rejected tables
+        """
+        self._raise_error()
+        with graph_conn as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(self.LAG)
+                pending, oldest = cursor.fetchone()
+                cursor.execute(self.REJECTED)
+                rejected_rows = cursor.fetchone()[0]
+        with self._lock:
+            return {'staged': self.staged,
+                    'merged': self.merged,
+                    'rejected': self.rejected,
+                    'rejected_rows': rejected_rows,
+                    'merges': self.merges,
+                    'merge_seconds': self.merge_seconds,
+                    'since_merge': None if self.last_merge is None else time.time() - self.last_merge,
+                    'pending': pending,
+                    'lag': float(oldest or 0.0)}
+
+    def close(self):
+        """
+        Stop the timer thread
+        """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        if self._merge_conn is not None:
+            self._merge_conn.close()
+            self._merge_conn = None
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        while not self._stop.wait(self.merge_interval):
+            try:
+                self.merge(self._merge_conn)
+            except Exception as e:
+                logging.error('Provenance merge failed: %s', e)
+                self._error = e
@@ -0,0 +1,53 @@
+"""
+ Copyright 2021 Trustees of the University of Pennsylvania
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import threading
+
+
+class LabelDictionary:
+    """
+    LabelDictionary maps property and edge labels to the SMALLINT codes they
+    are interned under in MProv_Label, caching the mapping client-side so
+    that each label is looked up once per process.  It may be shared by the
+    threads of a connection.
+    """
+    def __init__(self):
+        self._codes = {}  # type: Dict[str, int]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._codes)
+
+    def encode(self, graph_conn, labels):
+        # type: (Any, Iterable[str]) -> Dict[str, int]
+        """
+        Intern any labels not yet in MProv_Label, in a transaction of their
+        own, so the cached codes are committed before they are used
+        :param graph_conn: Database connection, outside of a transaction
+        :param labels: Labels about to be written
+        :return: Map from label to code, covering at least the given labels
+        """
+        missing = set(label for label in labels if label not in self._codes)
+        if missing:
+            missing = list(missing)
+            with graph_conn as conn:
+                with conn.cursor() as cursor:
+                    # Checking first keeps conflicting inserts from using up the sequence
+                    cursor.execute("INSERT INTO MProv_Label(label) SELECT l FROM unnest(%s::VARCHAR[]) l "
+                                   "WHERE NOT EXISTS (SELECT 1 FROM MProv_Label WHERE label = l) "
+                                   "ON CONFLICT DO NOTHING", (missing,))
+                    cursor.execute("SELECT label, _id FROM MProv_Label WHERE label = ANY(%s)", (missing,))
+                    found = cursor.fetchall()
+            with self._lock:
+                self._codes.update(found)
+        return self._codes
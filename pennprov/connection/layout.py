@@ -0,0 +1,712 @@
+"""
+ Copyright 2021 Trustees of the University of Pennsylvania
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import datetime
+import hashlib
+import itertools
+import logging
+import re
+import time
+
+from psycopg2 import sql
+
+from pennprov.connection.batch import WriteBatch
+from pennprov.connection.labels import LabelDictionary
+
+_PROP_VALUES = 'value,ivalue,lvalue,dvalue,fvalue,tvalue,tsvalue,jvalue'
+
+# The columns of a node property, as StorageBackend.node_props returns them
+_NODE_PROPS = 'index,code,value,ivalue,lvalue,fvalue,dvalue,tvalue,tsvalue,label,jvalue'
+
+
+def _prefixed(alias, columns):
+    # type: (str, str) -> str
+    return ','.join(alias + '.' + column for column in columns.split(','))
+
+
+class TableLayout:
+    """
+    The storage layout in which every node, property and edge row carries the
+    graph name and qualified node names it refers to (MProv_Node,
+    MProv_NodeProp and MProv_Edge).
+
+    A layout supplies the SQL that MProvConnection runs against its tables;
+    every process using a database must use the same layout.
+    """
+    name = 'table'
+
+    # The statements run on every capture or traversal, which each session
+    # prepares once (see PreparedStatements)
+    STATEMENTS = {
+        'mprov_write_batch': (WriteBatch.WRITE_SQL, WriteBatch.WRITE_TYPES),
+        'mprov_node_props': ("SELECT index,code,value,ivalue,lvalue,fvalue,dvalue,tvalue,tsvalue,label,jvalue "
+                             "FROM MProv_NodeProp WHERE _resource = %s AND _key = %s",
+                             ('VARCHAR', 'VARCHAR')),
+        'mprov_nodes_props': ("SELECT _key,index,code,value,ivalue,lvalue,fvalue,dvalue,tvalue,tsvalue,label,jvalue "
+                              "FROM MProv_NodeProp WHERE _resource = %s AND _key = ANY(%s)",
+                              ('VARCHAR', 'VARCHAR[]')),
+        'mprov_connected_to': ("SELECT _from FROM MProv_Edge WHERE _resource = %s AND _to = %s",
+                               ('VARCHAR', 'VARCHAR')),
+        # The properties of the nodes with edges of a label to a node, and of
+        # the code entities named by the activities that generated a node
+        'mprov_connected_to_props': ("SELECT e._from," + _prefixed('p', _NODE_PROPS) + " FROM MProv_Edge e "
+                                     "LEFT JOIN MProv_NodeProp p ON p._resource = e._resource AND p._key = e._from "
+                                     "WHERE e._resource = %s AND e._to = %s AND e.label = %s",
+                                     ('VARCHAR', 'VARCHAR', 'VARCHAR')),
+        'mprov_producer_code_props': ("SELECT c._key," + _prefixed('c', _NODE_PROPS) + " FROM MProv_Edge e "
+                                      "JOIN MProv_NodeProp a ON a._resource = e._resource AND a._key = e._to "
+                                      "JOIN MProv_NodeProp c ON c._resource = e._resource AND c._key = a.value "
+                                      "WHERE e._resource = %s AND e._from = %s AND e.label = 'wasGeneratedBy' "
+                                      "AND a.label = %s",
+                                      ('VARCHAR', 'VARCHAR', 'VARCHAR')),
+        'mprov_connected_to_label': ("SELECT _from FROM MProv_Edge WHERE _resource = %s AND _to = %s AND label = %s",
+                                     ('VARCHAR', 'VARCHAR', 'VARCHAR')),
+        'mprov_connected_from': ("SELECT _to FROM MProv_Edge WHERE _resource = %s AND _from = %s",
+                                 ('VARCHAR', 'VARCHAR')),
+        'mprov_connected_from_label': ("SELECT _to FROM MProv_Edge WHERE _resource = %s AND _from = %s AND label = %s",
+                                       ('VARCHAR', 'VARCHAR', 'VARCHAR')),
+    }
+
+    # Merge the staging tables filled by WriteBatch.copy into the graph
+    MERGE_STAGING = WriteBatch.MERGE_STAGING
+
+    # Which of the keys (a list) exist in the graph
+    FIND_NODES = "SELECT _key FROM MProv_Node WHERE _resource = (%s) AND _key = ANY(%s)"
+
+    # Table holding nodes by key, which properties and edges must reference
+    # (None if nothing enforces it); staged rows that do not are set aside
+    NODE_TABLE = 'MProv_Node'
+
+    # Table holding node properties, and so tuples stored as JSONB
+    PROPS_TABLE = 'MProv_NodeProp'
+
+    # Table holding edges, between nodes named by their keys
+    EDGE_TABLE = 'MProv_Edge'
+
+    # The edges reachable from a node, in one recursive query (see
+    # lineage_query).  UNION keeps each edge once, or once per depth when a
+    # depth is carried, so cycles end the recursion.
+    LINEAGE = ("WITH RECURSIVE lineage(_from, _to, label{depth}) AS ("
+               "SELECT _from, _to, label{first} FROM {edges} "
+               "WHERE _resource = %(graph)s AND {near} = %(token)s AND label = ANY(%(labels)s) "
+               "UNION "
+               "SELECT e._from, e._to, e.label{next} FROM lineage l JOIN {edges} e "
+               "ON e._resource = %(graph)s AND e.{near} = l.{far} AND e.label = ANY(%(labels)s){bound}) "
+               "SELECT _from, _to, label FROM lineage{order} LIMIT %(limit)s")
+
+    # The nodes with edges from (or to) a node, one page at a time in key
+    # order (see connected_query), with the conditions on the label and on
+    # the key after which the page starts
+    CONNECTED_PAGE = ("SELECT DISTINCT {far} FROM {edges} WHERE _resource = %(graph)s AND {near} = %(token)s"
+                      "{label}{after} ORDER BY {far} LIMIT %(limit)s")
+    PAGE_LABEL = " AND label = %(label)s"
+    PAGE_AFTER = " AND {far} > %(after)s"
+
+    # Every edge of a graph with one of the labels, as (from, to, label)
+    GRAPH_EDGES = "SELECT _from, _to, label FROM {edges} WHERE _resource = %(graph)s AND label = ANY(%(labels)s)"
+
+    # Tables list-partitioned by graph, in the order they reference each other
+    PARTITIONED_TABLES = ('MProv_Node', 'MProv_NodeProp', 'MProv_Edge', 'MProv_EdgeProp')
+
+    # Key and operator name of the activities of a graph, given the label of the operator property
+    ACTIVITY_OPERATORS = ("SELECT n._key, p.value FROM MProv_Node n JOIN MProv_NodeProp p "
+                          "ON n._resource = p._resource AND n._key = p._key "
+                          "WHERE n._resource = (%s) AND n.label = 'ACTIVITY' AND p.label = (%s)")
+
+    # Move the nodes of a graph listed in the MProv_KeyMap(old_key, new_key)
+    # temporary table to their new keys, with their properties and edges
+    REKEY_NODES = (
+        "INSERT INTO MProv_Node(_key,_resource,label) "
+        "SELECT m.new_key, n._resource, n.label FROM MProv_Node n "
+        "JOIN MProv_KeyMap m ON n._key = m.old_key "
+        "WHERE n._resource = (%s) ON CONFLICT DO NOTHING",
+        "INSERT INTO MProv_NodeProp(_key,_resource,type,label,value,code,ivalue,lvalue,"
+        "dvalue,fvalue,tvalue,tsvalue,jvalue,index) "
+        "SELECT m.new_key,p._resource,p.type,p.label,p.value,p.code,p.ivalue,p.lvalue,"
+        "p.dvalue,p.fvalue,p.tvalue,p.tsvalue,p.jvalue,p.index FROM MProv_NodeProp p "
+        "JOIN MProv_KeyMap m ON p._key = m.old_key "
+        "WHERE p._resource = (%s) ON CONFLICT DO NOTHING",
+        "INSERT INTO MProv_Edge(_resource,_from,_to,label) "
+        "SELECT e._resource, COALESCE(f.new_key, e._from), COALESCE(t.new_key, e._to), e.label "
+        "FROM MProv_Edge e LEFT JOIN MProv_KeyMap f ON e._from = f.old_key "
+        "LEFT JOIN MProv_KeyMap t ON e._to = t.old_key "
+        "WHERE e._resource = (%s) AND (f.old_key IS NOT NULL OR t.old_key IS NOT NULL) "
+        "ON CONFLICT DO NOTHING",
+        # Removing the old nodes cascades to their properties and edges
+        "DELETE FROM MProv_Node n USING MProv_KeyMap m "
+        "WHERE n._resource = (%s) AND n._key = m.old_key",
+    )
+
+    def __init__(self):
+        # Whether each graph seen has partitions of its own
+        self._partitioned = {}  # type: Dict[str, bool]
+
+    @staticmethod
+    def partition_name(table, graph):
+        # type: (str, str) -> str
+        """
+        The name of a graph's partition of a table: the graph name made safe
+        for an identifier, and a digest of it to keep similar names apart
+        """
+        safe = re.sub('[^a-z0-9_]', '_', graph.lower())[:32]
+        return (table + '_' + safe + '_' + hashlib.sha1(graph.encode('utf-8')).hexdigest()[:8]).lower()
+
+    def create_graph(self, graph_conn, graph):
+        # type: (Any, str) -> bool
+        """
+        Create the partitions of a graph, if need be.  A graph with rows in the
+        DEFAULT partitions (written before the tables were partitioned, or
+        before its partitions were created) stays there.
+
+        :return: True if the graph has partitions of its own
+        """
+        partitioned = self._partitioned.get(graph)
+        if partitioned is not None:
+            return partitioned
+
+        with graph_conn as conn:
+            with conn.cursor() as cursor:
+                # Keeps concurrent connections from creating the same partitions
+                cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", ('MProv_Graph ' + graph,))
+                cursor.execute("SELECT to_regclass(%s)", (self.partition_name('MProv_Node', graph),))
+                partitioned = cursor.fetchone()[0] is not None
+                if not partitioned:
+                    cursor.execute("SELECT 1 FROM MProv_Node_Default WHERE _resource = (%s) LIMIT 1", (graph,))
+                    if cursor.fetchone() is None:
+                        for table in self.PARTITIONED_TABLES:
+                            cursor.execute(sql.SQL("CREATE TABLE {} PARTITION OF {} FOR VALUES IN (%s)").format(
+                                sql.Identifier(self.partition_name(table, graph)), sql.Identifier(table.lower())),
+                                (graph,))
+                        partitioned = True
+                    else:
+                        logging.info('Graph %s has rows in the default partitions, and stays there', graph)
+
+        self._partitioned[graph] = partitioned
+        return partitioned
+
+    def reset_graph(self, graph_conn, graph):
+        # type: (Any, str) -> None
+        """
+        Remove every node, property and edge of a graph: by dropping its
+        partitions if it has them, otherwise by deleting its rows from the
+        DEFAULT partitions.  Either way the graph then gets new partitions.
+        """
+        partitioned = self.create_graph(graph_conn, graph)
+        with graph_conn as conn:
+            with conn.cursor() as cursor:
+                if partitioned:
+                    # Every partition references every partition of the table it
+                    # references, so a graph's partitions cannot be truncated on
+                    # their own; they are detached and dropped, referencing first
+                    for table in reversed(self.PARTITIONED_TABLES):
+                        partition = sql.Identifier(self.partition_name(table, graph))
+                        cursor.execute(sql.SQL("ALTER TABLE {} DETACH PARTITION {}").format(
+                            sql.Identifier(table.lower()), partition))
+                        cursor.execute(sql.SQL("DROP TABLE {}").format(partition))
+                else:
+                    # Cascades to properties and edges
+                    cursor.execute("DELETE FROM MProv_Node WHERE _resource = (%s)", (graph,))
+        del self._partitioned[graph]
+        self.create_graph(graph_conn, graph)
+
+    def create_tuple_index(self, graph_conn, field=None):
+        # type: (Any, str) -> str
+        """
+        Index the tuples stored as JSONB: a GIN index over all of their fields
+        (serving containment queries such as jvalue @> '{"unit": "mV"}'), or
+        an expression index on one field (serving jvalue ->> 'field' = ...)
+        :param field: Field to index, or None for every field
+        :return: The name of the index
+        """
+        if field is None:
+            name = (self.PROPS_TABLE + '_Tuple').lower()
+            indexed = sql.SQL("USING GIN (jvalue jsonb_path_ops)")
+        else:
+            name = self.partition_name(self.PROPS_TABLE + '_Tuple', field)
+            indexed = sql.SQL("((jvalue ->> {}))").format(sql.Literal(field))
+        with graph_conn as conn:
+            with conn.cursor() as cursor:
+                # Partial, as properties stored one per row leave jvalue NULL
+                cursor.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} {} WHERE jvalue IS NOT NULL").format(
+                    sql.Identifier(name), sql.Identifier(self.PROPS_TABLE.lower()), indexed))
+        return name
+
+    def connected_query(self, reverse=False, label=False, after=False):
+        # type: (bool, bool, bool) -> str
+        """
+        The query for the nodes with edges from a node, or with reverse=True
+        to it, each once and in key order.  It takes the parameters graph,
+        token, limit (None for no limit) and, if given, label and after (the
+        key the results follow).
+        """
+        near, far = ('_to', '_from') if reverse else ('_from', '_to')
+        return self.CONNECTED_PAGE.format(edges=self.EDGE_TABLE, near=near, far=far,
+                                          label=self.PAGE_LABEL if label else '',
+                                          after=self.PAGE_AFTER.format(far=far) if after else '')
+
+    def edges_query(self):
+        # type: () -> str
+        """
+        The query for every edge of a graph with one of the labels, taking
+        the parameters graph and labels (a list)
+        """
+        return self.GRAPH_EDGES.format(edges=self.EDGE_TABLE)
+
+    def lineage_query(self, reverse=False, bounded=False):
+        # type: (bool, bool) -> str
+        """
+        The query for the (from, to, label) edges reachable from a node,
+        following edges forward, or with reverse=True backward; if bounded,
+        nearest first.  It takes the parameters graph, token, labels (a list),
+        limit (None for no limit) and, if bounded, max_depth (at least 1).
+        """
+        near, far = ('_to', '_from') if reverse else ('_from', '_to')
+        if not bounded:
+            # Without a depth, UNION finds each edge once, and rows are
+            # returned as they are found, so a limit ends the recursion early
+            return self.LINEAGE.format(edges=self.EDGE_TABLE, near=near, far=far,
+                                       depth='', first='', next='', bound='', order='')
+        return self.LINEAGE.format(edges=self.EDGE_TABLE, near=near, far=far,
+                                   depth=', depth', first=', 1', next=', l.depth + 1',
+                                   bound=' WHERE l.depth < %(max_depth)s',
+                                   order=' GROUP BY _from, _to, label ORDER BY min(depth)')
+
+    def write_epoch(self):
+        # type: () -> Any
+        """
+        The period being written to, in layouts that store each period
+        separately.  When it changes, nodes already written are written again.
+        """
+        return None
+
+    def prepare_batch(self, graph_conn, batch):
+        # type: (Any, WriteBatch) -> Any
+        """
+        Get the database ready for a batch, in transactions of its own, before
+        the batch is written or staged
+        """
+        return None
+
+    def columns(self, graph_conn, batch):
+        # type: (Any, WriteBatch) -> List[list]
+        """
+        The arguments of the mprov_write_batch statement for a batch
+        """
+        self.prepare_batch(graph_conn, batch)
+        return batch.columns()
+
+
+class NodeIdLayout(TableLayout):
+    """
+    The storage layout in which each node's graph and qualified name is
+    stored once, in MProv_Key, under a BIGINT surrogate ID; properties
+    (MProv_KeyProp) and edges (MProv_KeyEdge) refer to nodes by that ID.
+    Tokens passed to and returned from MProvConnection are unchanged: they
+    are translated to IDs by joins with MProv_Key.
+
+    Property and edge labels are interned in MProv_Label under SMALLINT
+    codes.  The client encodes them before writing (see LabelDictionary),
+    and reads join MProv_Label to decode them.
+    """
+    name = 'node_ids'
+
+    # Positions of the property and edge label arrays in WriteBatch.columns()
+    _PROP_LABELS = 3 + WriteBatch.PROP_COLUMNS.index('label')
+    _EDGE_LABELS = 3 + len(WriteBatch.PROP_COLUMNS) + 3
+
+    WRITE_TYPES = list(WriteBatch.WRITE_TYPES)
+    WRITE_TYPES[_PROP_LABELS] = WRITE_TYPES[_EDGE_LABELS] = 'SMALLINT[]'
+    WRITE_TYPES = tuple(WRITE_TYPES)
+
+    # MProv_WriteBatchKeys (see migrations.py) takes the same arguments as
+    # MProv_WriteBatch, with label codes in place of property and edge labels.
+    # Properties and edges of unknown nodes get a NULL ID, which fails the NOT
+    # NULL constraint just as the table layout fails its foreign keys.
+    STATEMENTS = {
+        'mprov_write_batch': ("SELECT MProv_WriteBatchKeys(" + ','.join(['%s'] * len(WRITE_TYPES)) + ")",
+                              WRITE_TYPES),
+        'mprov_node_props': ("SELECT p.index,p.code,p.value,p.ivalue,p.lvalue,p.fvalue,p.dvalue,p.tvalue,p.tsvalue,"
+                             "l.label,p.jvalue FROM MProv_Key n JOIN MProv_KeyProp p ON p._id = n._id "
+                             "JOIN MProv_Label l ON l._id = p.label WHERE n._resource = %s AND n._key = %s",
+                             ('VARCHAR', 'VARCHAR')),
+        'mprov_nodes_props': ("SELECT n._key,p.index,p.code,p.value,p.ivalue,p.lvalue,p.fvalue,p.dvalue,p.tvalue,"
+                              "p.tsvalue,l.label,p.jvalue FROM MProv_Key n JOIN MProv_KeyProp p ON p._id = n._id "
+                              "JOIN MProv_Label l ON l._id = p.label WHERE n._resource = %s AND n._key = ANY(%s)",
+                              ('VARCHAR', 'VARCHAR[]')),
+        'mprov_connected_to': ("SELECT f._key FROM MProv_Key t JOIN MProv_KeyEdge e ON e._to = t._id "
+                               "JOIN MProv_Key f ON f._id = e._from WHERE t._resource = %s AND t._key = %s",
+                               ('VARCHAR', 'VARCHAR')),
+        'mprov_connected_to_props': ("SELECT f._key,p.index,p.code,p.value,p.ivalue,p.lvalue,p.fvalue,p.dvalue,"
+                                     "p.tvalue,p.tsvalue,l.label,p.jvalue FROM MProv_Key t "
+                                     "JOIN MProv_KeyEdge e ON e._to = t._id JOIN MProv_Key f ON f._id = e._from "
+                                     "LEFT JOIN MProv_KeyProp p ON p._id = f._id "
+                                     "LEFT JOIN MProv_Label l ON l._id = p.label "
+                                     "WHERE t._resource = %s AND t._key = %s "
+                                     "AND e.label = (SELECT _id FROM MProv_Label WHERE label = %s)",
+                                     ('VARCHAR', 'VARCHAR', 'VARCHAR')),
+        'mprov_producer_code_props': ("SELECT c._key,p.index,p.code,p.value,p.ivalue,p.lvalue,p.fvalue,p.dvalue,"
+                                      "p.tvalue,p.tsvalue,l.label,p.jvalue FROM MProv_Key s "
+                                      "JOIN MProv_KeyEdge e ON e._from = s._id JOIN MProv_KeyProp a ON a._id = e._to "
+                                      "JOIN MProv_Key c ON c._resource = s._resource AND c._key = a.value "
+                                      "JOIN MProv_KeyProp p ON p._id = c._id JOIN MProv_Label l ON l._id = p.label "
+                                      "WHERE s._resource = %s AND s._key = %s "
+                                      "AND e.label = (SELECT _id FROM MProv_Label WHERE label = 'wasGeneratedBy') "
+                                      "AND a.label = (SELECT _id FROM MProv_Label WHERE label = %s)",
+                                      ('VARCHAR', 'VARCHAR', 'VARCHAR')),
+        'mprov_connected_to_label': ("SELECT f._key FROM MProv_Key t JOIN MProv_KeyEdge e ON e._to = t._id "
+                                     "JOIN MProv_Key f ON f._id = e._from JOIN MProv_Label l ON l._id = e.label "
+                                     "WHERE t._resource = %s AND t._key = %s AND l.label = %s",
+                                     ('VARCHAR', 'VARCHAR', 'VARCHAR')),
+        'mprov_connected_from': ("SELECT t._key FROM MProv_Key f JOIN MProv_KeyEdge e ON e._from = f._id "
+                                 "JOIN MProv_Key t ON t._id = e._to WHERE f._resource = %s AND f._key = %s",
+                                 ('VARCHAR', 'VARCHAR')),
+        'mprov_connected_from_label': ("SELECT t._key FROM MProv_Key f JOIN MProv_KeyEdge e ON e._from = f._id "
+                                       "JOIN MProv_Key t ON t._id = e._to JOIN MProv_Label l ON l._id = e.label "
+                                       "WHERE f._resource = %s AND f._key = %s AND l.label = %s",
+                                       ('VARCHAR', 'VARCHAR', 'VARCHAR')),
+    }
+
+    # Labels are interned (see prepare_batch) before the batch is staged
+    MERGE_STAGING = (
+        "INSERT INTO MProv_Key(_key,_resource,label) "
+        "SELECT _key,_resource,label FROM MProv_Node_Staging ON CONFLICT DO NOTHING",
+        "INSERT INTO MProv_KeyProp(_id,label,code,index," + _PROP_VALUES + ") "
+        "SELECT n._id,l._id,s.code,s.index," + _prefixed('s', _PROP_VALUES) + " "
+        "FROM MProv_NodeProp_Staging s LEFT JOIN MProv_Key n ON n._resource = s._resource AND n._key = s._key "
+        "LEFT JOIN MProv_Label l ON l.label = s.label ON CONFLICT DO NOTHING",
+        "INSERT INTO MProv_KeyEdge(_from,_to,label) "
+        "SELECT f._id, t._id, l._id FROM MProv_Edge_Staging s "
+        "LEFT JOIN MProv_Key f ON f._resource = s._resource AND f._key = s._from "
+        "LEFT JOIN MProv_Key t ON t._resource = s._resource AND t._key = s._to "
+        "LEFT JOIN MProv_Label l ON l.label = s.label ON CONFLICT DO NOTHING",
+    )
+
+    NODE_TABLE = 'MProv_Key'
+
+    PROPS_TABLE = 'MProv_KeyProp'
+
+    # Recurses over node IDs and label codes, and looks up the keys and
+    # labels of the edges found at the end
+    LINEAGE = ("WITH RECURSIVE lineage(_from, _to, label{depth}) AS ("
+               "SELECT e._from, e._to, e.label{first} FROM MProv_Key n JOIN MProv_KeyEdge e ON e.{near} = n._id "
+               "WHERE n._resource = %(graph)s AND n._key = %(token)s "
+               "AND e.label IN (SELECT _id FROM MProv_Label WHERE label = ANY(%(labels)s)) "
+               "UNION "
+               "SELECT e._from, e._to, e.label{next} FROM lineage l JOIN MProv_KeyEdge e ON e.{near} = l.{far} "
+               "AND e.label IN (SELECT _id FROM MProv_Label WHERE label = ANY(%(labels)s)){bound}) "
+               "SELECT f._key, t._key, b.label "
+               "FROM (SELECT _from, _to, label FROM lineage{order} LIMIT %(limit)s) l "
+               "JOIN MProv_Key f ON f._id = l._from JOIN MProv_Key t ON t._id = l._to "
+               "JOIN MProv_Label b ON b._id = l.label")
+
+    FIND_NODES = "SELECT _key FROM MProv_Key WHERE _resource = (%s) AND _key = ANY(%s)"
+
+    CONNECTED_PAGE = ("SELECT DISTINCT b._key FROM MProv_Key a JOIN MProv_KeyEdge e ON e.{near} = a._id "
+                      "JOIN MProv_Key b ON b._id = e.{far} WHERE a._resource = %(graph)s AND a._key = %(token)s"
+                      "{label}{after} ORDER BY b._key LIMIT %(limit)s")
+    PAGE_LABEL = " AND e.label = (SELECT _id FROM MProv_Label WHERE label = %(label)s)"
+    PAGE_AFTER = " AND b._key > %(after)s"
+
+    GRAPH_EDGES = ("SELECT a._key, b._key, l.label FROM MProv_Key a JOIN MProv_KeyEdge e ON e._from = a._id "
+                   "JOIN MProv_Key b ON b._id = e._to JOIN MProv_Label l ON l._id = e.label "
+                   "WHERE a._resource = %(graph)s AND l.label = ANY(%(labels)s)")
+
+    ACTIVITY_OPERATORS = ("SELECT n._key, p.value FROM MProv_Key n JOIN MProv_KeyProp p ON p._id = n._id "
+                          "JOIN MProv_Label l ON l._id = p.label "
+                          "WHERE n._resource = (%s) AND n.label = 'ACTIVITY' AND l.label = (%s)")
+
+    REKEY_NODES = (
+        "INSERT INTO MProv_Key(_key,_resource,label) "
+        "SELECT m.new_key, n._resource, n.label FROM MProv_Key n "
+        "JOIN MProv_KeyMap m ON n._key = m.old_key "
+        "WHERE n._resource = (%s) ON CONFLICT DO NOTHING",
+        "INSERT INTO MProv_KeyProp(_id,label,code,index," + _PROP_VALUES + ") "
+        "SELECT t._id,p.label,p.code,p.index," + _prefixed('p', _PROP_VALUES) + " "
+        "FROM MProv_KeyProp p JOIN MProv_Key n ON p._id = n._id "
+        "JOIN MProv_KeyMap m ON n._key = m.old_key "
+        "JOIN MProv_Key t ON t._resource = n._resource AND t._key = m.new_key "
+        "WHERE n._resource = (%s) ON CONFLICT DO NOTHING",
+        "INSERT INTO MProv_KeyEdge(_from,_to,label) "
+        "SELECT COALESCE(nf._id, e._from), COALESCE(nt._id, e._to), e.label "
+        "FROM MProv_KeyEdge e JOIN MProv_Key f ON e._from = f._id JOIN MProv_Key t ON e._to = t._id "
+        "LEFT JOIN MProv_KeyMap mf ON f._key = mf.old_key "
+        "LEFT JOIN MProv_Key nf ON nf._resource = f._resource AND nf._key = mf.new_key "
+        "LEFT JOIN MProv_KeyMap mt ON t._key = mt.old_key "
+        "LEFT JOIN MProv_Key nt ON nt._resource = t._resource AND nt._key = mt.new_key "
+        "WHERE f._resource = (%s) AND (mf.old_key IS NOT NULL OR mt.old_key IS NOT NULL) "
+        "ON CONFLICT DO NOTHING",
+        "DELETE FROM MProv_Key n USING MProv_KeyMap m "
+        "WHERE n._resource = (%s) AND n._key = m.old_key",
+    )
+
+
+    def __init__(self):
+        TableLayout.__init__(self)
+        self.labels = LabelDictionary()
+
+    def create_graph(self, graph_conn, graph):
+        # type: (Any, str) -> bool
+        # Node IDs are not unique per graph, so MProv_Key cannot be partitioned by it
+        return False
+
+    def reset_graph(self, graph_conn, graph):
+        # type: (Any, str) -> None
+        with graph_conn as conn:
+            with conn.cursor() as cursor:
+                # Cascades to properties and edges
+                cursor.execute("DELETE FROM MProv_Key WHERE _resource = (%s)", (graph,))
+
+    def prepare_batch(self, graph_conn, batch):
+        # type: (Any, WriteBatch) -> Dict[str, int]
+        """
+        Intern the property and edge labels of a batch
+        :return: Map from label to code
+        """
+        return self.labels.encode(graph_conn, itertools.chain((prop[2] for prop in batch.props),
+                                                              (edge[3] for edge in batch.edges)))
+
+    def columns(self, graph_conn, batch):
+        # type: (Any, WriteBatch) -> List[list]
+        codes = self.prepare_batch(graph_conn, batch)
+        columns = batch.columns()
+        for i in (self._PROP_LABELS, self._EDGE_LABELS):
+            columns[i] = [codes[label] for label in columns[i]]
+        return columns
+
+
+class TimePartitionedLayout(TableLayout):
+    """
+    The storage layout for graphs whose fine-grained provenance is only kept
+    for a rolling window: nodes, properties and edges (MProv_TimeNode,
+    MProv_TimeNodeProp and MProv_TimeEdge) are range-partitioned by the day
+    they were written, so expired days can be detached and dropped whole
+    (see expire_partitions).
+
+    Each day's partition is self-contained: there are no foreign keys between
+    days, and a node written again on a later day is stored again, so the
+    agent, code and other long-lived nodes outlive the expiry of the day they
+    were first written.  Reads merge the copies, later days taking precedence.
+    """
+    name = 'time'
+
+    # Partitioned tables, by their prefix in the names of daily partitions
+    PARTITIONED_TABLES = ('MProv_TimeNode', 'MProv_TimeNodeProp', 'MProv_TimeEdge')
+
+    # Days ahead of today to create partitions for, so that writes around
+    # midnight, or from a client whose clock is behind the server's, have one
+    DAYS_AHEAD = 1
+
+    # If set, the days of provenance kept, including today: older partitions
+    # are dropped whenever this process creates a new day's partitions
+    retention_days = None  # type: int
+
+    # The server's day, which rows take as their _day, and the seconds until
+    # it ends, in the session's time zone
+    SERVER_DAY = "SELECT CURRENT_DATE, EXTRACT(EPOCH FROM (CURRENT_DATE + 1)::timestamptz - now())"
+
+    # MProv_WriteBatchTimed (see migrations.py) takes the same arguments as
+    # MProv_WriteBatch
+    STATEMENTS = {
+        'mprov_write_batch': ("SELECT MProv_WriteBatchTimed(" + ','.join(['%s'] * len(WriteBatch.WRITE_TYPES)) + ")",
+                              WriteBatch.WRITE_TYPES),
+        'mprov_node_props': ("SELECT index,code,value,ivalue,lvalue,fvalue,dvalue,tvalue,tsvalue,label,jvalue "
+                             "FROM MProv_TimeNodeProp WHERE _resource = %s AND _key = %s ORDER BY _day",
+                             ('VARCHAR', 'VARCHAR')),
+        'mprov_nodes_props': ("SELECT _key,index,code,value,ivalue,lvalue,fvalue,dvalue,tvalue,tsvalue,label,jvalue "
+                              "FROM MProv_TimeNodeProp WHERE _resource = %s AND _key = ANY(%s) ORDER BY _day",
+                              ('VARCHAR', 'VARCHAR[]')),
+        'mprov_connected_to': ("SELECT DISTINCT _from FROM MProv_TimeEdge WHERE _resource = %s AND _to = %s",
+                               ('VARCHAR', 'VARCHAR')),
+        # Edges and activities written on several days are joined once
+        'mprov_connected_to_props': ("SELECT e._from," + _prefixed('p', _NODE_PROPS) + " FROM "
+                                     "(SELECT DISTINCT _resource, _from FROM MProv_TimeEdge "
+                                     "WHERE _resource = %s AND _to = %s AND label = %s) e "
+                                     "LEFT JOIN MProv_TimeNodeProp p ON p._resource = e._resource AND p._key = e._from "
+                                     "ORDER BY p._day",
+                                     ('VARCHAR', 'VARCHAR', 'VARCHAR')),
+        'mprov_producer_code_props': ("SELECT c._key," + _prefixed('c', _NODE_PROPS) + " FROM "
+                                      "(SELECT DISTINCT e._resource, a.value FROM MProv_TimeEdge e "
+                                      "JOIN MProv_TimeNodeProp a ON a._resource = e._resource AND a._key = e._to "
+                                      "WHERE e._resource = %s AND e._from = %s AND e.label = 'wasGeneratedBy' "
+                                      "AND a.label = %s) a "
+                                      "JOIN MProv_TimeNodeProp c ON c._resource = a._resource AND c._key = a.value "
+                                      "ORDER BY c._day",
+                                      ('VARCHAR', 'VARCHAR', 'VARCHAR')),
+        'mprov_connected_to_label': ("SELECT DISTINCT _from FROM MProv_TimeEdge "
+                                     "WHERE _resource = %s AND _to = %s AND label = %s",
+                                     ('VARCHAR', 'VARCHAR', 'VARCHAR')),
+        'mprov_connected_from': ("SELECT DISTINCT _to FROM MProv_TimeEdge WHERE _resource = %s AND _from = %s",
+                                 ('VARCHAR', 'VARCHAR')),
+        'mprov_connected_from_label': ("SELECT DISTINCT _to FROM MProv_TimeEdge "
+                                       "WHERE _resource = %s AND _from = %s AND label = %s",
+                                       ('VARCHAR', 'VARCHAR', 'VARCHAR')),
+    }
+
+    MERGE_STAGING = (
+        "INSERT INTO MProv_TimeNode(_key,_resource,label) "
+        "SELECT _key,_resource,label FROM MProv_Node_Staging ON CONFLICT DO NOTHING",
+        "INSERT INTO MProv_TimeNodeProp(" + ','.join(WriteBatch.PROP_COLUMNS) + ") "
+        "SELECT " + ','.join(WriteBatch.PROP_COLUMNS) + " FROM MProv_NodeProp_Staging ON CONFLICT DO NOTHING",
+        "INSERT INTO MProv_TimeEdge(_resource,_from,_to,label) "
+        "SELECT _resource,_from,_to,label FROM MProv_Edge_Staging ON CONFLICT DO NOTHING",
+    )
+
+    # Properties and edges are partitioned by day apart from their nodes, with
+    # no foreign keys
+    NODE_TABLE = None
+
+    PROPS_TABLE = 'MProv_TimeNodeProp'
+
+    # An edge written on several days is found once, as the query does not
+    # select its day
+    EDGE_TABLE = 'MProv_TimeEdge'
+
+    FIND_NODES = "SELECT _key FROM MProv_TimeNode WHERE _resource = (%s) AND _key = ANY(%s)"
+
+    ACTIVITY_OPERATORS = ("SELECT DISTINCT n._key, p.value FROM MProv_TimeNode n JOIN MProv_TimeNodeProp p "
+                          "ON n._resource = p._resource AND n._key = p._key AND n._day = p._day "
+                          "WHERE n._resource = (%s) AND n.label = 'ACTIVITY' AND p.label = (%s)")
+
+    # Copies keep the day of the row they were copied from
+    REKEY_NODES = (
+        "INSERT INTO MProv_TimeNode(_key,_resource,_day,label) "
+        "SELECT m.new_key, n._resource, n._day, n.label FROM MProv_TimeNode n "
+        "JOIN MProv_KeyMap m ON n._key = m.old_key "
+        "WHERE n._resource = (%s) ON CONFLICT DO NOTHING",
+        "INSERT INTO MProv_TimeNodeProp(_key,_resource,_day,label,code,index," + _PROP_VALUES + ") "
+        "SELECT m.new_key,p._resource,p._day,p.label,p.code,p.index," + _prefixed('p', _PROP_VALUES) + " "
+        "FROM MProv_TimeNodeProp p JOIN MProv_KeyMap m ON p._key = m.old_key "
+        "WHERE p._resource = (%s) ON CONFLICT DO NOTHING",
+        "INSERT INTO MProv_TimeEdge(_resource,_day,_from,_to,label) "
+        "SELECT e._resource, e._day, COALESCE(f.new_key, e._from), COALESCE(t.new_key, e._to), e.label "
+        "FROM MProv_TimeEdge e LEFT JOIN MProv_KeyMap f ON e._from = f.old_key "
+        "LEFT JOIN MProv_KeyMap t ON e._to = t.old_key "
+        "WHERE e._resource = (%s) AND (f.old_key IS NOT NULL OR t.old_key IS NOT NULL) "
+        "ON CONFLICT DO NOTHING",
+        "DELETE FROM MProv_TimeEdge e USING MProv_KeyMap m "
+        "WHERE e._resource = (%s) AND (e._from = m.old_key OR e._to = m.old_key)",
+        "DELETE FROM MProv_TimeNodeProp p USING MProv_KeyMap m "
+        "WHERE p._resource = (%s) AND p._key = m.old_key",
+        "DELETE FROM MProv_TimeNode n USING MProv_KeyMap m "
+        "WHERE n._resource = (%s) AND n._key = m.old_key",
+    )
+
+    def __init__(self):
+        TableLayout.__init__(self)
+        # The server's day when partitions were last created, and the
+        # time.monotonic() at which it ends
+        self._ready = None  # type: datetime.date
+        self._rollover = 0.0
+
+    @staticmethod
+    def day_partition_name(table, day):
+        # type: (str, datetime.date) -> str
+        return (table + '_' + day.strftime('%Y%m%d')).lower()
+
+    def create_partitions(self, graph_conn, today=None):
+        # type: (Any, datetime.date) -> None
+        """
+        Create the partitions for today and DAYS_AHEAD following days, if need be
+        :param today: The day, by default the server's, since rows take their day from it
+        """
+        rollover = None
+        with graph_conn as conn:
+            with conn.cursor() as cursor:
+                # Keeps concurrent connections from creating the same partitions
+                cursor.execute("SELECT pg_advisory_xact_lock(hashtext('MProv_TimePartitions'))")
+                if today is None:
+                    cursor.execute(self.SERVER_DAY)
+                    today, seconds_left = cursor.fetchone()
+                    rollover = time.monotonic() + float(seconds_left)
+                for offset in range(self.DAYS_AHEAD + 1):
+                    day = today + datetime.timedelta(days=offset)
+                    for table in self.PARTITIONED_TABLES:
+                        cursor.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} "
+                                               "FOR VALUES FROM (%s) TO (%s)").format(
+                            sql.Identifier(self.day_partition_name(table, day)), sql.Identifier(table.lower())),
+                            (day, day + datetime.timedelta(days=1)))
+        if rollover is not None:
+            self._ready, self._rollover = today, rollover
+        if self.retention_days:
+            self.expire_partitions(graph_conn, self.retention_days, today)
+
+    def expire_partitions(self, graph_conn, keep_days, today=None):
+        # type: (Any, int, datetime.date) -> List[str]
+        """
+        Detach and drop the partitions of days before the last keep_days,
+        for every graph
+        :param today: The day, by default the server's
+        :return: Names of the dropped partitions
+        """
+        dropped = []
+        with graph_conn as conn:
+            with conn.cursor() as cursor:
+                if today is None:
+                    cursor.execute(self.SERVER_DAY)
+                    today = cursor.fetchone()[0]
+                cutoff = (today - datetime.timedelta(days=keep_days - 1)).strftime('%Y%m%d')
+                for table in self.PARTITIONED_TABLES:
+                    cursor.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                                   "WHERE i.inhparent = %s::regclass", (table.lower(),))
+                    prefix = table.lower() + '_'
+                    for (partition,) in cursor.fetchall():
+                        if partition.startswith(prefix) and partition[len(prefix):] < cutoff:
+                            cursor.execute(sql.SQL("ALTER TABLE {} DETACH PARTITION {}").format(
+                                sql.Identifier(table.lower()), sql.Identifier(partition)))
+                            cursor.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(partition)))
+                            dropped.append(partition)
+        logging.info('Dropped %d expired provenance partitions', len(dropped))
+        return dropped
+
+    def write_epoch(self):
+        # type: () -> Any
+        return self._server_day()
+
+    def _server_day(self):
+        # type: () -> datetime.date
+        """
+        The server's day, counted on from the one read when partitions were
+        last created, or None if they have not been
+        """
+        if self._ready is None:
+            return None
+        elapsed = time.monotonic() - self._rollover
+        if elapsed < 0:
+            return self._ready
+        return self._ready + datetime.timedelta(days=1 + int(elapsed // 86400))
+
+    def create_graph(self, graph_conn, graph):
+        # type: (Any, str) -> bool
+        # Partitions are by day, for all graphs
+        self.create_partitions(graph_conn)
+        return False
+
+    def reset_graph(self, graph_conn, graph):
+        # type: (Any, str) -> None
+        with graph_conn as conn:
+            with conn.cursor() as cursor:
+                for table in reversed(self.PARTITIONED_TABLES):
+                    cursor.execute(sql.SQL("DELETE FROM {} WHERE _resource = (%s)").format(
+                        sql.Identifier(table.lower())), (graph,))
+
+    def prepare_batch(self, graph_conn, batch):
+        # type: (Any, WriteBatch) -> None
+        """
+        Create partitions for the new day, the first time a batch is written on
+        it: once the server's day, as last read, has ended
+        """
+        if self._ready is None or time.monotonic() >= self._rollover:
+            self.create_partitions(graph_conn)
+
+
+LAYOUTS = {layout.name: layout for layout in (TableLayout, NodeIdLayout, TimePartitionedLayout)}
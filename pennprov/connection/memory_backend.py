@@ -0,0 +1,223 @@
+"""
+ Copyright 2021 Trustees of the University of Pennsylvania
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import gzip
+import json
+import os
+import pickle
+import threading
+
+from pennprov.connection.backend import StorageBackend
+from pennprov.connection.batch import WriteBatch
+
+# Version of the snapshot file format
+SNAPSHOT_VERSION = 1
+
+
+class MemoryGraph:
+    """
+    The nodes, properties and edges of one graph.  Edges are indexed both
+    ways, by label: forward[label][from] and reverse[label][to] are dicts
+    used as insertion-ordered sets of the nodes at the other end.
+    """
+    __slots__ = ('nodes', 'props', 'forward', 'reverse')
+
+    def __init__(self):
+        # Label of each node
+        self.nodes = {}  # type: Dict[str, str]
+        # Property rows of each node (in WriteBatch.PROP_COLUMNS order), by label
+        self.props = {}  # type: Dict[str, Dict[str, tuple]]
+        self.forward = {}  # type: Dict[str, Dict[str, Dict[str, None]]]
+        self.reverse = {}  # type: Dict[str, Dict[str, Dict[str, None]]]
+
+    def add_edge(self, from_key, to_key, label):
+        # type: (str, str, str) -> None
+        self.forward.setdefault(label, {}).setdefault(from_key, {})[to_key] = None
+        self.reverse.setdefault(label, {}).setdefault(to_key, {})[from_key] = None
+
+    def edges(self):
+        # type: () -> Iterator[Tuple[str, str, str]]
+        """
+        Every edge, as (from, to, label)
+        """
+        for label, index in self.forward.items():
+            for from_key, targets in index.items():
+                for to_key in targets:
+                    yield from_key, to_key, label
+
+
+class MemoryStore:
+    """
+    The graphs of a MemoryBackend, and the lock that guards them.  It stands
+    in for the database connection, so the background writer can share it.
+    """
+    def __init__(self):
+        self.graphs = {}  # type: Dict[str, MemoryGraph]
+        self.lock = threading.RLock()
+
+    def graph(self, name):
+        # type: (str) -> MemoryGraph
+        ret = self.graphs.get(name)
+        if ret is None:
+            ret = self.graphs[name] = MemoryGraph()
+        return ret
+
+    def close(self):
+        pass
+
+
+class MemoryBackend(StorageBackend):
+    """
+    A graph store held in the memory of the process, for unit tests, notebooks
+    and pipelines that cannot afford a database round trip per write.  Nodes,
+    properties and edges live in dicts keyed by token, with edges indexed
+    forward and in reverse by label, so capture and one-hop traversals cost
+    a few dictionary operations.  The store can be saved to, and loaded from,
+    a snapshot file.
+    """
+    name = 'memory'
+
+    def __init__(self, path=None):
+        # type: (str) -> None
+        """
+        :param path: Snapshot file, loaded if it exists and saved on close(); None to keep
+            the graph in memory only
+        """
+        self.path = path
+        self.graph_conn = MemoryStore()
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def reset_graph(self, graph):
+        # type: (str) -> None
+        with self.graph_conn.lock:
+            self.graph_conn.graphs.pop(graph, None)
+
+    @staticmethod
+    def write_rows(store, batch):
+        # type: (MemoryStore, WriteBatch) -> None
+        """
+        Add the rows of a batch, skipping those already stored, as the other
+        backends do
+        """
+        if len(batch) == 0:
+            return
+        with store.lock:
+            for key, resource, label in batch.nodes:
+                nodes = store.graph(resource).nodes
+                if key not in nodes:
+                    nodes[key] = label
+            for row in batch.props:
+                props = store.graph(row[1]).props.setdefault(row[0], {})
+                if row[2] not in props:
+                    props[row[2]] = tuple(row)
+            for resource, from_key, to_key, label in batch.edges:
+                store.graph(resource).add_edge(from_key, to_key, label)
+
+    def write_batch(self, batch):
+        # type: (WriteBatch) -> None
+        self.write_rows(self.graph_conn, batch)
+
+    def open_writer(self):
+        # type: () -> Tuple[Any, Callable[[Any, WriteBatch], None]]
+        return self.graph_conn, self.write_rows
+
+    def _get_graph(self, graph):
+        # type: (str) -> MemoryGraph
+        return self.graph_conn.graphs.get(graph) or MemoryGraph()
+
+    def node_props(self, graph, token):
+        # type: (str, str) -> List[tuple]
+        with self.graph_conn.lock:
+            rows = list(self._get_graph(graph).props.get(token, {}).values())
+        return [(row[4], row[3], row[5], row[6], row[7], row[9], row[8], row[10], row[11], row[2],
+                 None if row[12] is None else json.loads(row[12])) for row in rows]
+
+    def connected(self, graph, token, label=None, reverse=False):
+        # type: (str, str, str, bool) -> List[str]
+        with self.graph_conn.lock:
+            index = self._get_graph(graph).reverse if reverse else self._get_graph(graph).forward
+            if label is not None:
+                return list(index.get(label, {}).get(token, ()))
+            ret = []
+            for by_label in index.values():
+                ret.extend(by_label.get(token, ()))
+            return ret
+
+    def edges(self, graph, labels, itersize=2000):
+        # type: (str, Sequence[str], int) -> Iterator[Tuple[str, str, str]]
+        with self.graph_conn.lock:
+            forward = self._get_graph(graph).forward
+            return iter([(from_key, to_key, label) for label in labels
+                         for from_key, targets in forward.get(label, {}).items() for to_key in targets])
+
+    def find_nodes(self, graph, keys):
+        # type: (str, Sequence[str]) -> List[str]
+        with self.graph_conn.lock:
+            nodes = self._get_graph(graph).nodes
+            return [key for key in keys if key in nodes]
+
+    def _rows(self, graph):
+        # type: (str) -> Tuple[List[tuple], List[tuple], List[tuple]]
+        """
+        The node, property and edge rows of a graph, as they were written
+        """
+        with self.graph_conn.lock:
+            stored = self._get_graph(graph)
+            return ([(key, graph, label) for key, label in stored.nodes.items()],
+                    [row for props in stored.props.values() for row in props.values()],
+                    [(graph, from_key, to_key, label) for from_key, to_key, label in stored.edges()])
+
+    def read_batches(self, graph, batch_size=10000):
+        # type: (str, int) -> Iterator[WriteBatch]
+        for kind, rows in zip(('nodes', 'props', 'edges'), self._rows(graph)):
+            for i in range(0, len(rows), batch_size):
+                batch = WriteBatch()
+                setattr(batch, kind, rows[i:i + batch_size])
+                yield batch
+
+    def save(self, path=None):
+        # type: (str) -> None
+        """
+        Write every graph to a snapshot file: its node, property and edge
+        rows, pickled and compressed.  The file is replaced atomically.
+        :param path: Snapshot file, by default the one given when connecting
+        """
+        path = path or self.path
+        if path is None:
+            raise ValueError('No snapshot file given')
+        with self.graph_conn.lock:
+            graphs = {name: self._rows(name) for name in self.graph_conn.graphs}
+        temp = path + '.tmp'
+        with gzip.open(temp, 'wb', compresslevel=1) as f:
+            pickle.dump({'version': SNAPSHOT_VERSION, 'graphs': graphs}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, path)
+
+    def load(self, path):
+        # type: (str) -> None
+        """
+        Add the graphs of a snapshot file to the store.  Snapshots are
+        pickles, so only load files this library wrote.
+        """
+        with gzip.open(path, 'rb') as f:
+            snapshot = pickle.load(f)
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            raise RuntimeError('Unsupported snapshot version ' + str(snapshot.get('version')))
+        for nodes, props, edges in snapshot['graphs'].values():
+            batch = WriteBatch()
+            batch.nodes, batch.props, batch.edges = nodes, props, edges
+            self.write_rows(self.graph_conn, batch)
+
+    def close(self):
+        if self.path is not None:
+            self.save()
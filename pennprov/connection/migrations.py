@@ -0,0 +1,763 @@
+"""
+ Copyright 2021 Trustees of the University of Pennsylvania
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import logging
+
+NODE_TABLE = """
+             CREATE TABLE IF NOT EXISTS MProv_Node(_key VARCHAR(80) NOT NULL,
+                                                   _resource VARCHAR(80) NOT NULL,
+                                                   _created SERIAL,
+                                                   label VARCHAR(80),
+                                                   PRIMARY KEY(_resource, _key))
+             """
+
+NODE_PROPS_TABLE = """
+             CREATE TABLE IF NOT EXISTS MProv_NodeProp(_key VARCHAR(80) NOT NULL,
+                                                   _resource VARCHAR(80) NOT NULL,
+                                                   type VARCHAR(80),
+                                                   label VARCHAR(80),
+                                                   value VARCHAR,
+                                                   code CHAR(1),
+                                                   ivalue INTEGER,
+                                                   lvalue BIGINT,
+                                                   dvalue DOUBLE PRECISION,
+                                                   fvalue REAL,
+                                                   tvalue DATE,
+                                                   tsvalue TIMESTAMP,
+                                                   index BIGINT,
+                                                   PRIMARY KEY(_resource, _key, label),
+                                                   UNIQUE(_resource,_key,index),
+                                                   FOREIGN KEY(_resource,_key) REFERENCES MProv_Node
+                                                     ON DELETE CASCADE)
+                   """
+
+EDGE_TABLE = """
+             CREATE TABLE IF NOT EXISTS MProv_Edge(_key SERIAL,
+                                                   _resource VARCHAR(80) NOT NULL,
+                                                   _from VARCHAR(80) NOT NULL,
+                                                   _to VARCHAR(80) NOT NULL,
+                                                   label VARCHAR(80),
+                                                   PRIMARY KEY(_resource, _key),
+                                                   UNIQUE(_resource, _from, _to, label),
+                                                   FOREIGN KEY(_resource, _from) REFERENCES MProv_Node
+                                                    ON DELETE CASCADE,
+                                                   FOREIGN KEY(_resource, _to) REFERENCES MProv_Node
+                                                    ON DELETE CASCADE)
+             """
+
+EDGE_PROPS_TABLE = """
+             CREATE TABLE IF NOT EXISTS MProv_EdgeProp(_key INTEGER NOT NULL,
+                                                   _resource VARCHAR(80) NOT NULL,
+                                                   _created SERIAL,
+                                                   type VARCHAR(80),
+                                                   label VARCHAR(80),
+                                                   value VARCHAR,
+                                                   code CHAR(1),
+                                                   ivalue INTEGER,
+                                                   lvalue BIGINT,
+                                                   dvalue DOUBLE PRECISION,
+                                                   fvalue REAL,
+                                                   tvalue DATE,
+                                                   tsvalue TIMESTAMP,
+                                                   index BIGINT,
+                                                   PRIMARY KEY(_resource, _key, label),
+                                                   UNIQUE(_resource,_key,index),
+                                                   FOREIGN KEY(_resource,_key) REFERENCES MProv_Edge
+                                                     ON DELETE CASCADE)
+                   """
+
+SCHEMA_TABLE = """
+             CREATE TABLE IF NOT EXISTS MProv_Schema(_key VARCHAR(80) NOT NULL,
+                                                   _resource VARCHAR(80) NOT NULL,
+                                                   name VARCHAR(80) NOT NULL,
+                                                   value VARCHAR,
+                                                   PRIMARY KEY(_resource, _key),
+                                                   UNIQUE(_resource, name))
+               """
+
+
+# Tables of the NodeIdLayout: nodes are interned once in MProv_Key, and
+# properties and edges refer to them by ID
+KEY_TABLE = """
+            CREATE TABLE IF NOT EXISTS MProv_Key(_id BIGSERIAL,
+                                                 _resource VARCHAR(80) NOT NULL,
+                                                 _key VARCHAR(80) NOT NULL,
+                                                 label VARCHAR(80),
+                                                 PRIMARY KEY(_id),
+                                                 UNIQUE(_resource, _key))
+            """
+
+KEY_PROPS_TABLE = """
+            CREATE TABLE IF NOT EXISTS MProv_KeyProp(_id BIGINT NOT NULL,
+                                                     label VARCHAR(80) NOT NULL,
+                                                     code CHAR(1),
+                                                     index BIGINT,
+                                                     value VARCHAR,
+                                                     ivalue INTEGER,
+                                                     lvalue BIGINT,
+                                                     dvalue DOUBLE PRECISION,
+                                                     fvalue REAL,
+                                                     tvalue DATE,
+                                                     tsvalue TIMESTAMP,
+                                                     PRIMARY KEY(_id, label),
+                                                     UNIQUE(_id, index),
+                                                     FOREIGN KEY(_id) REFERENCES MProv_Key
+                                                       ON DELETE CASCADE)
+            """
+
+KEY_EDGE_TABLE = """
+            CREATE TABLE IF NOT EXISTS MProv_KeyEdge(_from BIGINT NOT NULL,
+                                                     _to BIGINT NOT NULL,
+                                                     label VARCHAR(80) NOT NULL,
+                                                     PRIMARY KEY(_from, label, _to),
+                                                     FOREIGN KEY(_from) REFERENCES MProv_Key
+                                                       ON DELETE CASCADE,
+                                                     FOREIGN KEY(_to) REFERENCES MProv_Key
+                                                       ON DELETE CASCADE)
+            """
+
+# Interned property and edge labels of the NodeIdLayout
+LABEL_TABLE = """
+              CREATE TABLE IF NOT EXISTS MProv_Label(_id SMALLSERIAL,
+                                                     label VARCHAR NOT NULL,
+                                                     PRIMARY KEY(_id),
+                                                     UNIQUE(label))
+              """
+
+
+# Argument types of the write functions before tuples could be stored as
+# JSONB (version 7), needed to drop them
+_ROW_WRITE_TYPES = ('VARCHAR[]', 'VARCHAR[]', 'VARCHAR[]',
+                    'VARCHAR[]', 'VARCHAR[]', 'VARCHAR[]', 'CHAR(1)[]', 'BIGINT[]',
+                    'VARCHAR[]', 'INTEGER[]', 'BIGINT[]', 'DOUBLE PRECISION[]', 'REAL[]', 'DATE[]', 'TIMESTAMP[]',
+                    'VARCHAR[]', 'VARCHAR[]', 'VARCHAR[]', 'VARCHAR[]')
+_ROW_KEY_WRITE_TYPES = _ROW_WRITE_TYPES[:5] + ('SMALLINT[]',) + _ROW_WRITE_TYPES[6:18] + ('SMALLINT[]',)
+
+
+def _intern_column(table, key):
+    # type: (str, str) -> List[str]
+    """
+    Replace the label column of a table with its MProv_Label code.  Dropping
+    the column drops the primary key and indexes on it, which are then rebuilt.
+    """
+    return ["ALTER TABLE " + table + " ADD COLUMN label_code SMALLINT",
+            "UPDATE " + table + " t SET label_code = l._id FROM MProv_Label l WHERE l.label = t.label",
+            "ALTER TABLE " + table + " DROP COLUMN label",
+            "ALTER TABLE " + table + " RENAME COLUMN label_code TO label",
+            "ALTER TABLE " + table + " ALTER COLUMN label SET NOT NULL, ADD PRIMARY KEY(" + key + "), "
+            "ADD FOREIGN KEY(label) REFERENCES MProv_Label"]
+
+
+TRAVERSAL_INDEXES = [
+    # Backward traversals (get_connected_to) look edges up by their target
+    "CREATE INDEX IF NOT EXISTS MProv_Edge_To ON MProv_Edge(_resource, _to, label)",
+    # Forward traversals by label, without scanning every _to of the source
+    "CREATE INDEX IF NOT EXISTS MProv_Edge_From ON MProv_Edge(_resource, _from, label)",
+    # Property lookups by label across nodes, e.g. all nodes with a given annotation
+    "CREATE INDEX IF NOT EXISTS MProv_NodeProp_Label ON MProv_NodeProp(_resource, label)",
+]
+
+# The tables of the TableLayout, list-partitioned by graph.  The tables of
+# earlier versions become the DEFAULT partitions, keeping their rows and
+# sequences; constraints are named so as not to collide with theirs.
+PARTITIONED_NODE_TABLE = """
+             CREATE TABLE MProv_Node(_key VARCHAR(80) NOT NULL,
+                                     _resource VARCHAR(80) NOT NULL,
+                                     _created INTEGER NOT NULL DEFAULT nextval('mprov_node__created_seq'),
+                                     label VARCHAR(80),
+                                     CONSTRAINT MProv_Node_Key PRIMARY KEY(_resource, _key))
+               PARTITION BY LIST(_resource)
+             """
+
+PARTITIONED_NODE_PROPS_TABLE = """
+             CREATE TABLE MProv_NodeProp(_key VARCHAR(80) NOT NULL,
+                                         _resource VARCHAR(80) NOT NULL,
+                                         type VARCHAR(80),
+                                         label VARCHAR(80) NOT NULL,
+                                         value VARCHAR,
+                                         code CHAR(1),
+                                         ivalue INTEGER,
+                                         lvalue BIGINT,
+                                         dvalue DOUBLE PRECISION,
+                                         fvalue REAL,
+                                         tvalue DATE,
+                                         tsvalue TIMESTAMP,
+                                         index BIGINT,
+                                         CONSTRAINT MProv_NodeProp_Key PRIMARY KEY(_resource, _key, label),
+                                         CONSTRAINT MProv_NodeProp_Index UNIQUE(_resource, _key, index),
+                                         CONSTRAINT MProv_NodeProp_Node FOREIGN KEY(_resource, _key)
+                                           REFERENCES MProv_Node ON DELETE CASCADE)
+               PARTITION BY LIST(_resource)
+             """
+
+PARTITIONED_EDGE_TABLE = """
+             CREATE TABLE MProv_Edge(_key INTEGER NOT NULL DEFAULT nextval('mprov_edge__key_seq'),
+                                     _resource VARCHAR(80) NOT NULL,
+                                     _from VARCHAR(80) NOT NULL,
+                                     _to VARCHAR(80) NOT NULL,
+                                     label VARCHAR(80),
+                                     CONSTRAINT MProv_Edge_Key PRIMARY KEY(_resource, _key),
+                                     CONSTRAINT MProv_Edge_Ends UNIQUE(_resource, _from, _to, label),
+                                     CONSTRAINT MProv_Edge_FromNode FOREIGN KEY(_resource, _from)
+                                       REFERENCES MProv_Node ON DELETE CASCADE,
+                                     CONSTRAINT MProv_Edge_ToNode FOREIGN KEY(_resource, _to)
+                                       REFERENCES MProv_Node ON DELETE CASCADE)
+               PARTITION BY LIST(_resource)
+             """
+
+PARTITIONED_EDGE_PROPS_TABLE = """
+             CREATE TABLE MProv_EdgeProp(_key INTEGER NOT NULL,
+                                         _resource VARCHAR(80) NOT NULL,
+                                         _created INTEGER NOT NULL DEFAULT nextval('mprov_edgeprop__created_seq'),
+                                         type VARCHAR(80),
+                                         label VARCHAR(80) NOT NULL,
+                                         value VARCHAR,
+                                         code CHAR(1),
+                                         ivalue INTEGER,
+                                         lvalue BIGINT,
+                                         dvalue DOUBLE PRECISION,
+                                         fvalue REAL,
+                                         tvalue DATE,
+                                         tsvalue TIMESTAMP,
+                                         index BIGINT,
+                                         CONSTRAINT MProv_EdgeProp_Key PRIMARY KEY(_resource, _key, label),
+                                         CONSTRAINT MProv_EdgeProp_Index UNIQUE(_resource, _key, index),
+                                         CONSTRAINT MProv_EdgeProp_Edge FOREIGN KEY(_resource, _key)
+                                           REFERENCES MProv_Edge ON DELETE CASCADE)
+               PARTITION BY LIST(_resource)
+             """
+
+
+# The tables of the TimePartitionedLayout, range-partitioned by the day rows
+# are written.  Keys include the day, and there are no foreign keys, so that
+# each day's partitions can be dropped on their own.
+TIME_NODE_TABLE = """
+             CREATE TABLE IF NOT EXISTS MProv_TimeNode(_key VARCHAR(80) NOT NULL,
+                                                       _resource VARCHAR(80) NOT NULL,
+                                                       _day DATE NOT NULL DEFAULT CURRENT_DATE,
+                                                       label VARCHAR(80),
+                                                       PRIMARY KEY(_resource, _key, _day))
+               PARTITION BY RANGE(_day)
+             """
+
+TIME_NODE_PROPS_TABLE = """
+             CREATE TABLE IF NOT EXISTS MProv_TimeNodeProp(_key VARCHAR(80) NOT NULL,
+                                                           _resource VARCHAR(80) NOT NULL,
+                                                           _day DATE NOT NULL DEFAULT CURRENT_DATE,
+                                                           label VARCHAR(80) NOT NULL,
+                                                           value VARCHAR,
+                                                           code CHAR(1),
+                                                           ivalue INTEGER,
+                                                           lvalue BIGINT,
+                                                           dvalue DOUBLE PRECISION,
+                                                           fvalue REAL,
+                                                           tvalue DATE,
+                                                           tsvalue TIMESTAMP,
+                                                           index BIGINT,
+                                                           PRIMARY KEY(_resource, _key, label, _day))
+               PARTITION BY RANGE(_day)
+             """
+
+TIME_EDGE_TABLE = """
+             CREATE TABLE IF NOT EXISTS MProv_TimeEdge(_resource VARCHAR(80) NOT NULL,
+                                                       _day DATE NOT NULL DEFAULT CURRENT_DATE,
+                                                       _from VARCHAR(80) NOT NULL,
+                                                       _to VARCHAR(80) NOT NULL,
+                                                       label VARCHAR(80) NOT NULL,
+                                                       PRIMARY KEY(_resource, _from, label, _to, _day))
+               PARTITION BY RANGE(_day)
+             """
+
+
+# UNLOGGED tables that connections in staged mode write into, for
+# StagedIngest to merge into the graph tables
+UNLOGGED_INGEST_TABLES = """
+             CREATE UNLOGGED TABLE IF NOT EXISTS MProv_Node_Ingest(_key VARCHAR(80),
+                                                                   _resource VARCHAR(80),
+                                                                   label VARCHAR(80),
+                                                                   _staged TIMESTAMP NOT NULL DEFAULT now());
+             CREATE UNLOGGED TABLE IF NOT EXISTS MProv_NodeProp_Ingest(_key VARCHAR(80),
+                                                                       _resource VARCHAR(80),
+                                                                       label VARCHAR(80),
+                                                                       code CHAR(1),
+                                                                       index BIGINT,
+                                                                       value VARCHAR,
+                                                                       ivalue INTEGER,
+                                                                       lvalue BIGINT,
+                                                                       dvalue DOUBLE PRECISION,
+                                                                       fvalue REAL,
+                                                                       tvalue DATE,
+                                                                       tsvalue TIMESTAMP,
+                                                                       jvalue JSONB,
+                                                                       _staged TIMESTAMP NOT NULL DEFAULT now());
+             CREATE UNLOGGED TABLE IF NOT EXISTS MProv_Edge_Ingest(_resource VARCHAR(80),
+                                                                   _from VARCHAR(80),
+                                                                   _to VARCHAR(80),
+                                                                   label VARCHAR(80),
+                                                                   _staged TIMESTAMP NOT NULL DEFAULT now())
+             """
+
+
+# Staged properties and edges whose nodes did not exist when they were
+# merged, which StagedIngest sets aside rather than failing the merge
+REJECTED_INGEST_TABLES = """
+             CREATE TABLE IF NOT EXISTS MProv_NodeProp_Rejected(_key VARCHAR(80),
+                                                                _resource VARCHAR(80),
+                                                                label VARCHAR(80),
+                                                                code CHAR(1),
+                                                                index BIGINT,
+                                                                value VARCHAR,
+                                                                ivalue INTEGER,
+                                                                lvalue BIGINT,
+                                                                dvalue DOUBLE PRECISION,
+                                                                fvalue REAL,
+                                                                tvalue DATE,
+                                                                tsvalue TIMESTAMP,
+                                                                jvalue JSONB,
+                                                                _rejected TIMESTAMP NOT NULL DEFAULT now());
+             CREATE TABLE IF NOT EXISTS MProv_Edge_Rejected(_resource VARCHAR(80),
+                                                            _from VARCHAR(80),
+                                                            _to VARCHAR(80),
+                                                            label VARCHAR(80),
+                                                            _rejected TIMESTAMP NOT NULL DEFAULT now())
+             """
+
+
+def _partition_by_graph():
+    # type: () -> List[str]
+    """
+    Swap the TableLayout tables for partitioned ones, attaching the old tables
+    (and their indexes) as the DEFAULT partitions
+    """
+    tables = ('MProv_Node', 'MProv_NodeProp', 'MProv_Edge', 'MProv_EdgeProp')
+    statements = ["ALTER TABLE " + table + " RENAME TO " + table + "_Default" for table in tables]
+    statements += ["ALTER INDEX IF EXISTS MProv_Edge_To RENAME TO MProv_Edge_Default_To",
+                   "ALTER INDEX IF EXISTS MProv_Edge_From RENAME TO MProv_Edge_Default_From",
+                   "ALTER INDEX IF EXISTS MProv_NodeProp_Label RENAME TO MProv_NodeProp_Default_Label"]
+    statements += [PARTITIONED_NODE_TABLE, PARTITIONED_NODE_PROPS_TABLE, PARTITIONED_EDGE_TABLE,
+                   PARTITIONED_EDGE_PROPS_TABLE]
+    statements += TRAVERSAL_INDEXES
+    for table in tables:
+        statements.append("ALTER TABLE " + table + " ATTACH PARTITION " + table + "_Default DEFAULT")
+    # The partitioned tables' foreign keys now cover the old tables
+    statements += ["ALTER TABLE MProv_NodeProp_Default DROP CONSTRAINT IF EXISTS mprov_nodeprop__resource__key_fkey",
+                   "ALTER TABLE MProv_Edge_Default DROP CONSTRAINT IF EXISTS mprov_edge__resource__from_fkey",
+                   "ALTER TABLE MProv_Edge_Default DROP CONSTRAINT IF EXISTS mprov_edge__resource__to_fkey",
+                   "ALTER TABLE MProv_EdgeProp_Default DROP CONSTRAINT IF EXISTS mprov_edgeprop__resource__key_fkey"]
+    statements += ["ALTER SEQUENCE mprov_node__created_seq OWNED BY MProv_Node._created",
+                   "ALTER SEQUENCE mprov_edge__key_seq OWNED BY MProv_Edge._key",
+                   "ALTER SEQUENCE mprov_edgeprop__created_seq OWNED BY MProv_EdgeProp._created"]
+    return statements
+
+
+# The write functions as each migration defined them.  They are frozen here,
+# rather than taken from WriteBatch and the layouts, so that a migration means
+# the same thing whenever it runs; a change to a write function is a new
+# migration re-creating it.
+WRITE_BATCH_V1 = """
+                     CREATE OR REPLACE FUNCTION MProv_WriteBatch(node_keys VARCHAR[],
+                                                                 node_resources VARCHAR[],
+                                                                 node_labels VARCHAR[],
+                                                                 prop_keys VARCHAR[],
+                                                                 prop_resources VARCHAR[],
+                                                                 prop_labels VARCHAR[],
+                                                                 prop_codes CHAR(1)[],
+                                                                 prop_indexes BIGINT[],
+                                                                 prop_values VARCHAR[],
+                                                                 prop_ivalues INTEGER[],
+                                                                 prop_lvalues BIGINT[],
+                                                                 prop_dvalues DOUBLE PRECISION[],
+                                                                 prop_fvalues REAL[],
+                                                                 prop_tvalues DATE[],
+                                                                 prop_tsvalues TIMESTAMP[],
+                                                                 edge_resources VARCHAR[],
+                                                                 edge_froms VARCHAR[],
+                                                                 edge_tos VARCHAR[],
+                                                                 edge_labels VARCHAR[])
+                     RETURNS void AS $$
+                     BEGIN
+                         INSERT INTO MProv_Node(_key,_resource,label)
+                           SELECT * FROM unnest(node_keys, node_resources, node_labels)
+                           ON CONFLICT DO NOTHING;
+                         INSERT INTO MProv_NodeProp(_key,_resource,label,code,index,
+                                                    value,ivalue,lvalue,dvalue,fvalue,tvalue,tsvalue)
+                           SELECT * FROM unnest(prop_keys, prop_resources, prop_labels, prop_codes, prop_indexes,
+                                                prop_values, prop_ivalues, prop_lvalues, prop_dvalues,
+                                                prop_fvalues, prop_tvalues, prop_tsvalues)
+                           ON CONFLICT DO NOTHING;
+                         INSERT INTO MProv_Edge(_resource,_from,_to,label)
+                           SELECT * FROM unnest(edge_resources, edge_froms, edge_tos, edge_labels)
+                           ON CONFLICT DO NOTHING;
+                     END;
+                     $$ LANGUAGE plpgsql
+                     """
+
+WRITE_BATCH_KEYS_V3 = """
+                     CREATE OR REPLACE FUNCTION MProv_WriteBatchKeys(node_keys VARCHAR[],
+                                                                     node_resources VARCHAR[],
+                                                                     node_labels VARCHAR[],
+                                                                     prop_keys VARCHAR[],
+                                                                     prop_resources VARCHAR[],
+                                                                     prop_labels VARCHAR[],
+                                                                     prop_codes CHAR(1)[],
+                                                                     prop_indexes BIGINT[],
+                                                                     prop_values VARCHAR[],
+                                                                     prop_ivalues INTEGER[],
+                                                                     prop_lvalues BIGINT[],
+                                                                     prop_dvalues DOUBLE PRECISION[],
+                                                                     prop_fvalues REAL[],
+                                                                     prop_tvalues DATE[],
+                                                                     prop_tsvalues TIMESTAMP[],
+                                                                     edge_resources VARCHAR[],
+                                                                     edge_froms VARCHAR[],
+                                                                     edge_tos VARCHAR[],
+                                                                     edge_labels VARCHAR[])
+                     RETURNS void AS $$
+                     BEGIN
+                         INSERT INTO MProv_Key(_key,_resource,label)
+                           SELECT * FROM unnest(node_keys, node_resources, node_labels)
+                           ON CONFLICT DO NOTHING;
+                         INSERT INTO MProv_KeyProp(_id,label,code,index,
+                                                   value,ivalue,lvalue,dvalue,fvalue,tvalue,tsvalue)
+                           SELECT n._id, p.label, p.code, p.index, p.value, p.ivalue, p.lvalue, p.dvalue,
+                                  p.fvalue, p.tvalue, p.tsvalue
+                           FROM unnest(prop_keys, prop_resources, prop_labels, prop_codes, prop_indexes,
+                                       prop_values, prop_ivalues, prop_lvalues, prop_dvalues,
+                                       prop_fvalues, prop_tvalues, prop_tsvalues)
+                                AS p(_key,_resource,label,code,index,
+                                     value,ivalue,lvalue,dvalue,fvalue,tvalue,tsvalue)
+                           LEFT JOIN MProv_Key n ON n._resource = p._resource AND n._key = p._key
+                           ON CONFLICT DO NOTHING;
+                         INSERT INTO MProv_KeyEdge(_from,_to,label)
+                           SELECT f._id, t._id, e.label
+                           FROM unnest(edge_resources, edge_froms, edge_tos, edge_labels)
+                                AS e(_resource,_from,_to,label)
+                           LEFT JOIN MProv_Key f ON f._resource = e._resource AND f._key = e._from
+                           LEFT JOIN MProv_Key t ON t._resource = e._resource AND t._key = e._to
+                           ON CONFLICT DO NOTHING;
+                     END;
+                     $$ LANGUAGE plpgsql
+                     """
+
+# Labels are passed as MProv_Label codes
+WRITE_BATCH_KEYS_V4 = """
+                     CREATE OR REPLACE FUNCTION MProv_WriteBatchKeys(node_keys VARCHAR[],
+                                                                     node_resources VARCHAR[],
+                                                                     node_labels VARCHAR[],
+                                                                     prop_keys VARCHAR[],
+                                                                     prop_resources VARCHAR[],
+                                                                     prop_labels SMALLINT[],
+                                                                     prop_codes CHAR(1)[],
+                                                                     prop_indexes BIGINT[],
+                                                                     prop_values VARCHAR[],
+                                                                     prop_ivalues INTEGER[],
+                                                                     prop_lvalues BIGINT[],
+                                                                     prop_dvalues DOUBLE PRECISION[],
+                                                                     prop_fvalues REAL[],
+                                                                     prop_tvalues DATE[],
+                                                                     prop_tsvalues TIMESTAMP[],
+                                                                     edge_resources VARCHAR[],
+                                                                     edge_froms VARCHAR[],
+                                                                     edge_tos VARCHAR[],
+                                                                     edge_labels SMALLINT[])
+                     RETURNS void AS $$
+                     BEGIN
+                         INSERT INTO MProv_Key(_key,_resource,label)
+                           SELECT * FROM unnest(node_keys, node_resources, node_labels)
+                           ON CONFLICT DO NOTHING;
+                         INSERT INTO MProv_KeyProp(_id,label,code,index,
+                                                   value,ivalue,lvalue,dvalue,fvalue,tvalue,tsvalue)
+                           SELECT n._id, p.label, p.code, p.index, p.value, p.ivalue, p.lvalue, p.dvalue,
+                                  p.fvalue, p.tvalue, p.tsvalue
+                           FROM unnest(prop_keys, prop_resources, prop_labels, prop_codes, prop_indexes,
+                                       prop_values, prop_ivalues, prop_lvalues, prop_dvalues,
+                                       prop_fvalues, prop_tvalues, prop_tsvalues)
+                                AS p(_key,_resource,label,code,index,
+                                     value,ivalue,lvalue,dvalue,fvalue,tvalue,tsvalue)
+                           LEFT JOIN MProv_Key n ON n._resource = p._resource AND n._key = p._key
+                           ON CONFLICT DO NOTHING;
+                         INSERT INTO MProv_KeyEdge(_from,_to,label)
+                           SELECT f._id, t._id, e.label
+                           FROM unnest(edge_resources, edge_froms, edge_tos, edge_labels)
+                                AS e(_resource,_from,_to,label)
+                           LEFT JOIN MProv_Key f ON f._resource = e._resource AND f._key = e._from
+                           LEFT JOIN MProv_Key t ON t._resource = e._resource AND t._key = e._to
+                           ON CONFLICT DO NOTHING;
+                     END;
+                     $$ LANGUAGE plpgsql
+                     """
+
+WRITE_BATCH_TIMED_V6 = """
+                     CREATE OR REPLACE FUNCTION MProv_WriteBatchTimed(node_keys VARCHAR[],
+                                                                      node_resources VARCHAR[],
+                                                                      node_labels VARCHAR[],
+                                                                      prop_keys VARCHAR[],
+                                                                      prop_resources VARCHAR[],
+                                                                      prop_labels VARCHAR[],
+                                                                      prop_codes CHAR(1)[],
+                                                                      prop_indexes BIGINT[],
+                                                                      prop_values VARCHAR[],
+                                                                      prop_ivalues INTEGER[],
+                                                                      prop_lvalues BIGINT[],
+                                                                      prop_dvalues DOUBLE PRECISION[],
+                                                                      prop_fvalues REAL[],
+                                                                      prop_tvalues DATE[],
+                                                                      prop_tsvalues TIMESTAMP[],
+                                                                      edge_resources VARCHAR[],
+                                                                      edge_froms VARCHAR[],
+                                                                      edge_tos VARCHAR[],
+                                                                      edge_labels VARCHAR[])
+                     RETURNS void AS $$
+                     BEGIN
+                         INSERT INTO MProv_TimeNode(_key,_resource,label)
+                           SELECT * FROM unnest(node_keys, node_resources, node_labels)
+                           ON CONFLICT DO NOTHING;
+                         INSERT INTO MProv_TimeNodeProp(_key,_resource,label,code,index,
+                                                        value,ivalue,lvalue,dvalue,fvalue,tvalue,tsvalue)
+                           SELECT * FROM unnest(prop_keys, prop_resources, prop_labels, prop_codes, prop_indexes,
+                                                prop_values, prop_ivalues, prop_lvalues, prop_dvalues,
+                                                prop_fvalues, prop_tvalues, prop_tsvalues)
+                           ON CONFLICT DO NOTHING;
+                         INSERT INTO MProv_TimeEdge(_resource,_from,_to,label)
+                           SELECT * FROM unnest(edge_resources, edge_froms, edge_tos, edge_labels)
+                           ON CONFLICT DO NOTHING;
+                     END;
+                     $$ LANGUAGE plpgsql
+                     """
+
+# Each function takes the JSONB values of tuple properties
+WRITE_BATCH_V7 = """
+                     CREATE OR REPLACE FUNCTION MProv_WriteBatch(node_keys VARCHAR[],
+                                                                 node_resources VARCHAR[],
+                                                                 node_labels VARCHAR[],
+                                                                 prop_keys VARCHAR[],
+                                                                 prop_resources VARCHAR[],
+                                                                 prop_labels VARCHAR[],
+                                                                 prop_codes CHAR(1)[],
+                                                                 prop_indexes BIGINT[],
+                                                                 prop_values VARCHAR[],
+                                                                 prop_ivalues INTEGER[],
+                                                                 prop_lvalues BIGINT[],
+                                                                 prop_dvalues DOUBLE PRECISION[],
+                                                                 prop_fvalues REAL[],
+                                                                 prop_tvalues DATE[],
+                                                                 prop_tsvalues TIMESTAMP[],
+                                                                 prop_jvalues JSONB[],
+                                                                 edge_resources VARCHAR[],
+                                                                 edge_froms VARCHAR[],
+                                                                 edge_tos VARCHAR[],
+                                                                 edge_labels VARCHAR[])
+                     RETURNS void AS $$
+                     BEGIN
+                         INSERT INTO MProv_Node(_key,_resource,label)
+                           SELECT * FROM unnest(node_keys, node_resources, node_labels)
+                           ON CONFLICT DO NOTHING;
+                         INSERT INTO MProv_NodeProp(_key,_resource,label,code,index,
+                                                    value,ivalue,lvalue,dvalue,fvalue,tvalue,tsvalue,jvalue)
+                           SELECT * FROM unnest(prop_keys, prop_resources, prop_labels, prop_codes, prop_indexes,
+                                                prop_values, prop_ivalues, prop_lvalues, prop_dvalues,
+                                                prop_fvalues, prop_tvalues, prop_tsvalues, prop_jvalues)
+                           ON CONFLICT DO NOTHING;
+                         INSERT INTO MProv_Edge(_resource,_from,_to,label)
+                           SELECT * FROM unnest(edge_resources, edge_froms, edge_tos, edge_labels)
+                           ON CONFLICT DO NOTHING;
+                     END;
+                     $$ LANGUAGE plpgsql
+                     """
+
+WRITE_BATCH_KEYS_V7 = """
+                     CREATE OR REPLACE FUNCTION MProv_WriteBatchKeys(node_keys VARCHAR[],
+                                                                     node_resources VARCHAR[],
+                                                                     node_labels VARCHAR[],
+                                                                     prop_keys VARCHAR[],
+                                                                     prop_resources VARCHAR[],
+                                                                     prop_labels SMALLINT[],
+                                                                     prop_codes CHAR(1)[],
+                                                                     prop_indexes BIGINT[],
+                                                                     prop_values VARCHAR[],
+                                                                     prop_ivalues INTEGER[],
+                                                                     prop_lvalues BIGINT[],
+                                                                     prop_dvalues DOUBLE PRECISION[],
+                                                                     prop_fvalues REAL[],
+                                                                     prop_tvalues DATE[],
+                                                                     prop_tsvalues TIMESTAMP[],
+                                                                     prop_jvalues JSONB[],
+                                                                     edge_resources VARCHAR[],
+                                                                     edge_froms VARCHAR[],
+                                                                     edge_tos VARCHAR[],
+                                                                     edge_labels SMALLINT[])
+                     RETURNS void AS $$
+                     BEGIN
+                         INSERT INTO MProv_Key(_key,_resource,label)
+                           SELECT * FROM unnest(node_keys, node_resources, node_labels)
+                           ON CONFLICT DO NOTHING;
+                         INSERT INTO MProv_KeyProp(_id,label,code,index,
+                                                   value,ivalue,lvalue,dvalue,fvalue,tvalue,tsvalue,jvalue)
+                           SELECT n._id, p.label, p.code, p.index, p.value, p.ivalue, p.lvalue, p.dvalue,
+                                  p.fvalue, p.tvalue, p.tsvalue, p.jvalue
+                           FROM unnest(prop_keys, prop_resources, prop_labels, prop_codes, prop_indexes,
+                                       prop_values, prop_ivalues, prop_lvalues, prop_dvalues,
+                                       prop_fvalues, prop_tvalues, prop_tsvalues, prop_jvalues)
+                                AS p(_key,_resource,label,code,index,
+                                     value,ivalue,lvalue,dvalue,fvalue,tvalue,tsvalue,jvalue)
+                           LEFT JOIN MProv_Key n ON n._resource = p._resource AND n._key = p._key
+                           ON CONFLICT DO NOTHING;
+                         INSERT INTO MProv_KeyEdge(_from,_to,label)
+                           SELECT f._id, t._id, e.label
+                           FROM unnest(edge_resources, edge_froms, edge_tos, edge_labels)
+                                AS e(_resource,_from,_to,label)
+                           LEFT JOIN MProv_Key f ON f._resource = e._resource AND f._key = e._from
+                           LEFT JOIN MProv_Key t ON t._resource = e._resource AND t._key = e._to
+                           ON CONFLICT DO NOTHING;
+                     END;
+                     $$ LANGUAGE plpgsql
+                     """
+
+WRITE_BATCH_TIMED_V7 = """
+                     CREATE OR REPLACE FUNCTION MProv_WriteBatchTimed(node_keys VARCHAR[],
+                                                                      node_resources VARCHAR[],
+                                                                      node_labels VARCHAR[],
+                                                                      prop_keys VARCHAR[],
+                                                                      prop_resources VARCHAR[],
+                                                                      prop_labels VARCHAR[],
+                                                                      prop_codes CHAR(1)[],
+                                                                      prop_indexes BIGINT[],
+                                                                      prop_values VARCHAR[],
+                                                                      prop_ivalues INTEGER[],
+                                                                      prop_lvalues BIGINT[],
+                                                                      prop_dvalues DOUBLE PRECISION[],
+                                                                      prop_fvalues REAL[],
+                                                                      prop_tvalues DATE[],
+                                                                      prop_tsvalues TIMESTAMP[],
+                                                                      prop_jvalues JSONB[],
+                                                                      edge_resources VARCHAR[],
+                                                                      edge_froms VARCHAR[],
+                                                                      edge_tos VARCHAR[],
+                                                                      edge_labels VARCHAR[])
+                     RETURNS void AS $$
+                     BEGIN
+                         INSERT INTO MProv_TimeNode(_key,_resource,label)
+                           SELECT * FROM unnest(node_keys, node_resources, node_labels)
+                           ON CONFLICT DO NOTHING;
+                         INSERT INTO MProv_TimeNodeProp(_key,_resource,label,code,index,
+                                                        value,ivalue,lvalue,dvalue,fvalue,tvalue,tsvalue,jvalue)
+                           SELECT * FROM unnest(prop_keys, prop_resources, prop_labels, prop_codes, prop_indexes,
+                                                prop_values, prop_ivalues, prop_lvalues, prop_dvalues,
+                                                prop_fvalues, prop_tvalues, prop_tsvalues, prop_jvalues)
+                           ON CONFLICT DO NOTHING;
+                         INSERT INTO MProv_TimeEdge(_resource,_from,_to,label)
+                           SELECT * FROM unnest(edge_resources, edge_froms, edge_tos, edge_labels)
+                           ON CONFLICT DO NOTHING;
+                     END;
+                     $$ LANGUAGE plpgsql
+                     """
+
+
+# The schema version of a graph database is recorded in MProv_Meta, one row
+# per migration applied
+META_TABLE = """
+             CREATE TABLE IF NOT EXISTS MProv_Meta(version INTEGER NOT NULL,
+                                                   description VARCHAR,
+                                                   applied TIMESTAMP NOT NULL DEFAULT now(),
+                                                   PRIMARY KEY(version))
+             """
+
+# Ordered (version, description, statements) of every schema change.  Migrations
+# are only ever appended: a new index, table or MProv_WriteBatch definition gets
+# a new version, rather than an edit to an earlier one.  The latest definition of
+# each write function is the one in use; there is no other copy.  Statements
+# should be safe to run against a database created before MProv_Meta existed.
+MIGRATIONS = [
+    (1, 'Graph tables and the MProv_WriteBatch function',
+     [NODE_TABLE, NODE_PROPS_TABLE, EDGE_TABLE, EDGE_PROPS_TABLE, SCHEMA_TABLE, WRITE_BATCH_V1]),
+    (2, 'Reverse edge and label indexes', TRAVERSAL_INDEXES),
+    (3, 'Node ID layout tables and the MProv_WriteBatchKeys function',
+     [KEY_TABLE, KEY_PROPS_TABLE, KEY_EDGE_TABLE,
+      "CREATE INDEX IF NOT EXISTS MProv_KeyEdge_To ON MProv_KeyEdge(_to, label, _from)",
+      "CREATE INDEX IF NOT EXISTS MProv_KeyProp_Label ON MProv_KeyProp(label)",
+      WRITE_BATCH_KEYS_V3]),
+    (4, 'Interned labels in the node ID layout',
+     [LABEL_TABLE,
+      "INSERT INTO MProv_Label(label) SELECT label FROM MProv_KeyProp UNION SELECT label FROM MProv_KeyEdge"] +
+     _intern_column('MProv_KeyProp', '_id, label') +
+     _intern_column('MProv_KeyEdge', '_from, label, _to') +
+     ["CREATE INDEX IF NOT EXISTS MProv_KeyEdge_To ON MProv_KeyEdge(_to, label, _from)",
+      "CREATE INDEX IF NOT EXISTS MProv_KeyProp_Label ON MProv_KeyProp(label)",
+      # The arguments change type, so replacing the function would add an overload
+      "DROP FUNCTION IF EXISTS MProv_WriteBatchKeys(" + ','.join(_ROW_WRITE_TYPES) + ")",
+      WRITE_BATCH_KEYS_V4]),
+    (5, 'Partition the table layout by graph', _partition_by_graph()),
+    (6, 'Time partitioned layout tables and the MProv_WriteBatchTimed function',
+     [TIME_NODE_TABLE, TIME_NODE_PROPS_TABLE, TIME_EDGE_TABLE,
+      "CREATE INDEX IF NOT EXISTS MProv_TimeEdge_To ON MProv_TimeEdge(_resource, _to, label)",
+      WRITE_BATCH_TIMED_V6]),
+    (7, 'JSONB tuple properties',
+     ["ALTER TABLE " + table + " ADD COLUMN IF NOT EXISTS jvalue JSONB"
+      for table in ('MProv_NodeProp', 'MProv_KeyProp', 'MProv_TimeNodeProp')] +
+     ["DROP FUNCTION IF EXISTS MProv_WriteBatch(" + ','.join(_ROW_WRITE_TYPES) + ")",
+      "DROP FUNCTION IF EXISTS MProv_WriteBatchKeys(" + ','.join(_ROW_KEY_WRITE_TYPES) + ")",
+      "DROP FUNCTION IF EXISTS MProv_WriteBatchTimed(" + ','.join(_ROW_WRITE_TYPES) + ")",
+      WRITE_BATCH_V7, WRITE_BATCH_KEYS_V7, WRITE_BATCH_TIMED_V7]),
+    # A schema gains an ID per version, so its name is no longer unique
+    (8, 'Schema registry',
+     ["ALTER TABLE MProv_Schema DROP CONSTRAINT IF EXISTS mprov_schema__resource_name_key",
+      "CREATE INDEX IF NOT EXISTS MProv_Schema_Name ON MProv_Schema(_resource, name)"]),
+    (9, 'Unlogged ingest tables', [UNLOGGED_INGEST_TABLES]),
+    (10, 'Tables for rejected staged rows', [REJECTED_INGEST_TABLES]),
+]  # type: List[Tuple[int, str, Sequence[str]]]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_version(cursor):
+    # type: (Any) -> int
+    """
+    The schema version of the graph database, 0 if no migration has been applied
+    """
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM MProv_Meta")
+    return cursor.fetchone()[0]
+
+
+def upgrade(graph_conn, migrations=None):
+    # type: (Any, Sequence[Tuple[int, str, Sequence[str]]]) -> int
+    """
+    Bring the graph database up to the latest schema version, applying each
+    missing migration once, in one transaction.  An up-to-date database costs
+    a single version check.
+    :param graph_conn: Database connection
+    :param migrations: Ordered (version, description, statements), MIGRATIONS by default
+    :return: The schema version of the database
+    """
+    if migrations is None:
+        migrations = MIGRATIONS
+
+    with graph_conn as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(META_TABLE)
+            version = get_version(cursor)
+            if version >= migrations[-1][0]:
+                return version
+
+            # Other connections wait here until the upgrade commits, then see the new version
+            cursor.execute("LOCK TABLE MProv_Meta IN EXCLUSIVE MODE")
+            version = get_version(cursor)
+            for number, description, statements in migrations:
+                if number <= version:
+                    continue
+                logging.info('Upgrading the provenance schema to version %d: %s', number, description)
+                for statement in statements:
+                    cursor.execute(statement)
+                cursor.execute("INSERT INTO MProv_Meta(version, description) VALUES (%s, %s)",
+                               (number, description))
+                version = number
+    return version
@@ -13,147 +13,210 @@
 from __future__ import print_function
 
 from typing import List, Any, Dict
+from contextlib import contextmanager
+import functools
 import hashlib
 import binascii
 import logging
 import re
+import time
 import pennprov
 import datetime
 from pennprov.metadata.stream_metadata import BasicTuple
-
-#from pennprov.cache.graph import GraphCache
+from pennprov.connection.batch import WriteBatch
+from pennprov.connection.writer import BackgroundWriter
+from pennprov.connection.ingest import StagedIngest
+from pennprov.connection.dedupe import WrittenSet
+from pennprov.connection.schemas import SchemaRegistry
+from pennprov.connection.tokens import Blake2bTokenGenerator, Pbkdf2TokenGenerator
+from pennprov.connection.layout import LAYOUTS, TimePartitionedLayout
+from pennprov.connection.backend import PostgresBackend
+from pennprov.connection.sqlite_backend import SqliteBackend
+from pennprov.connection.memory_backend import MemoryBackend
+
+from pennprov.cache.graph import GraphCache
+from pennprov.cache.reachability import ReachabilityIndex
 
 import psycopg2
+from psycopg2.extras import execute_values
 from pennprov.config import config
 
 class MProvConnection:
     cache = None
+    reachability = None
     graph_name = None
     namespace = 'http://mprov.md2k.org'
     default_host = "localhost"
     QNAME_REGEX = re.compile('{([^}]*)}(.*)')
+    _buffer = None
+    # Keys of the nodes and edges in the buffer, which is yet to be written
+    _pending = None
+    _writer = None
+    _ingest = None
+    _written = None
+    _epoch = None
+    backend = None
+    layout = None
+    schema_version = 0
+
+    # Code ID version written by store_code (see get_code_id); set to 1 to keep
+    # writing the IDs of older releases
+    code_id_version = 2
+    CODE_ID_VERSIONS = (2, 1)
+
+    # Creates activity IDs (see get_activity_id).  Tokens must be the same for
+    # every process writing a graph, so this is set per class, not per connection
+    token_generator = Blake2bTokenGenerator()
+
+    # Graph stores, by name
+    BACKENDS = {backend.name: backend for backend in (PostgresBackend, SqliteBackend, MemoryBackend)}
+
+    # Edge labels get_lineage follows by default: from a node to what it was
+    # derived from, the activity that generated it, the inputs that activity
+    # used, and the members of a collection
+    LINEAGE_LABELS = ('wasDerivedFrom', 'wasGeneratedBy', 'used', 'hadMember')
+
+    # How tuples are stored: a property row per field, a JSONB property, or a
+    # property holding a registered schema's ID and the values in field order
+    TUPLE_STORAGE = ('properties', 'jsonb', 'schema')
 
     """
     MProvConnection is a high-level API to the PennProvenance framework, with
     a streaming emphasis (i.e., tuples are stored with positions or timestamps,
     and derivations are recorded each time an action is invoked).
     """
-    def __init__(self, user=None, password=None, host=None):
-        # type: (str, str, str) -> None
+    def __init__(self, user=None, password=None, host=None, buffered=False, buffer_size=1000, flush_interval=1.0,
+                 asynchronous=False, queue_size=10000, queue_policy=BackgroundWriter.BLOCK, dedupe_size=0,
+                 prepare_statements=True, layout=None, retention_days=None, tuple_storage=None, staged=False,
+                 merge_interval=5.0, backend=None, path=None, cache=None, itersize=2000, reachability=None):
+        # type: (str, str, str, bool, int, float, bool, int, str, int, bool, str, int, str, bool, float, str, str, GraphCache, int, ReachabilityIndex) -> None
         """
         Establish a connection to a PennProvenance server
         :param user: User ID
         :param password: Password for connection
         :param host: Host URL, or None to use localhost
+        :param buffered: Hold writes in memory until flush(), close() or a threshold is hit
+        :param buffer_size: In buffered mode, the number of pending rows that triggers a write
+        :param flush_interval: In buffered mode, the seconds since the last write that trigger a write
+        :param asynchronous: Hand writes to a background writer thread, with its own connection
+        :param queue_size: In asynchronous mode, the number of pending writes before queue_policy applies
+        :param queue_policy: In asynchronous mode, BackgroundWriter.BLOCK or BackgroundWriter.DROP writes
+            when the queue is full
+        :param dedupe_size: Number of written node and edge keys remembered, so that
+            rewriting them can be skipped, or 0 to always write.  Only for a single writer: a
+            connection does not see another connection reset or rewrite the graph, and would go
+            on skipping nodes its edges and properties need.
+        :param prepare_statements: PREPARE the hot statements once per session; turn off
+            for poolers that do not keep sessions, such as pgbouncer in transaction mode
+        :param layout: Storage layout, 'table' or 'node_ids' (see pennprov.connection.layout), or None
+            to use the configured layout.  Every process using a database must use the same layout.
+        :param retention_days: In the 'time' layout, the days of provenance to keep; older days are
+            dropped each day (see expire_partitions)
+        :param tuple_storage: 'properties' to store each field of a tuple as a property row, 'jsonb'
+            to store the whole tuple as one JSONB property, or 'schema' to store BasicTuples as the ID
+            of their registered schema and an array of values; None to use the configured mode.
+            get_node reads any of them.
+        :param staged: Write into UNLOGGED ingest tables, merged into the graph every merge_interval
+            seconds and on flush(); rows not yet merged are lost if the database server crashes
+        :param merge_interval: In staged mode, the seconds between merges on a background thread,
+            or 0 to merge only on flush()
+        :param backend: Graph store, 'postgres', 'sqlite' or 'memory' (see pennprov.connection.backend),
+            or None to use the configured backend.  Layouts, retention, staged ingest and 'schema' tuple
+            storage need PostgreSQL.
+        :param path: For the sqlite backend, the database file; for the memory backend, a snapshot
+            file loaded when connecting and saved on close(), or None for none
+        :param cache: A GraphCache that get_node, get_connected_to and get_connected_from read
+            through, or None to always read the graph store
+        :param itersize: Rows the iter_* methods read from the graph store at a time
+        :param reachability: A ReachabilityIndex that depends_on and ancestors answer from, kept up
+            to date as edges are stored, or None to trace lineage in the graph store each time
         """
-        if user is None:
-            user = config.dbms.user
-
-        if password is None:
-            password = config.dbms.password
-
-        if host is None:
-            host = config.dbms.host
-
-        #self.auth_conn = psycopg2.connect(host=host, database=config.dbms.auth_db, user=user, password=password)
-        self.graph_conn = psycopg2.connect(host=host, database=config.dbms.graph_db, user=user, password=password)
+        if backend is None:
+            backend = config.dbms.get('backend', 'postgres')
+        if backend not in self.BACKENDS:
+            raise ValueError('Unknown storage backend ' + str(backend))
+
+        if tuple_storage is None:
+            tuple_storage = config.dbms.get('tuple_storage', 'properties')
+        if tuple_storage not in self.TUPLE_STORAGE:
+            raise ValueError('Unknown tuple storage ' + str(tuple_storage))
+        self.tuple_storage = tuple_storage
+        self.schemas = SchemaRegistry()
+
+        if backend == 'postgres':
+            if user is None:
+                user = config.dbms.user
+
+            if password is None:
+                password = config.dbms.password
+
+            if host is None:
+                host = config.dbms.host
+
+            if layout is None:
+                layout = config.dbms.get('layout', 'table')
+            if layout not in LAYOUTS:
+                raise ValueError('Unknown storage layout ' + str(layout))
+            layout = LAYOUTS[layout]()
+            if retention_days is not None:
+                if not isinstance(layout, TimePartitionedLayout):
+                    raise ValueError('Retention requires the time layout')
+                layout.retention_days = retention_days
+
+            #self.auth_conn = psycopg2.connect(host=host, database=config.dbms.auth_db, user=user, password=password)
+            self.backend = PostgresBackend(host, config.dbms.graph_db, user, password, layout,
+                                           prepare_statements)  # type: StorageBackend
+            self.layout = layout
+            self.schema_version = self.backend.schema_version
+        else:
+            if layout not in (None, 'table') or retention_days is not None or staged or tuple_storage == 'schema':
+                raise ValueError('Storage layouts, retention, staged ingest and registered schemas '
+                                 'need the postgres backend')
+            if path is None and backend == 'sqlite':
+                path = config.dbms.get('path', 'mprov.db')
+            self.backend = self.BACKENDS[backend](path)
+        self.graph_conn = self.backend.graph_conn
 
         self.user_token = self.get_username()
 
-        self._create_tables()
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self._last_flush = time.time()
+        self.cache = cache
+        self.itersize = itersize
+        self.reachability = reachability
+        if dedupe_size:
+            self._written = WrittenSet(dedupe_size)
+        if buffered:
+            self._buffer = WriteBatch()
+            self._pending = set()
+        if staged:
+            merge_conn = None
+            if merge_interval:
+                merge_conn = self.backend.connect()
+            self._ingest = StagedIngest(self.layout, merge_conn, merge_interval)
+        if asynchronous:
+            writer_conn, write = self.backend.open_writer()
+            if staged:
+                write = self._ingest.stage
+            self._writer = BackgroundWriter(writer_conn, write, queue_size, queue_policy,
+                                            on_written=self._record_written)
+
         self.graph_name = config.provenance.graph
+        # Writes to the configured graph go to its own partitions
+        self.backend.create_graph(self.graph_name)
         return
 
-    def _create_tables(self):
-        """
-        Create the graph relations if need be
-        """
-
-        node_table = """
-                     CREATE TABLE IF NOT EXISTS MProv_Node(_key VARCHAR(80) NOT NULL,
-                                                           _resource VARCHAR(80) NOT NULL,
-                                                           _created SERIAL,
-                                                           label VARCHAR(80),
-                                                           PRIMARY KEY(_resource, _key))
-                     """
-
-        node_props_table = """
-                     CREATE TABLE IF NOT EXISTS MProv_NodeProp(_key VARCHAR(80) NOT NULL,
-                                                           _resource VARCHAR(80) NOT NULL,
-                                                           type VARCHAR(80),
-                                                           label VARCHAR(80),
-                                                           value VARCHAR,
-                                                           code CHAR(1),
-                                                           ivalue INTEGER,
-                                                           lvalue BIGINT,
-                                                           dvalue DOUBLE PRECISION,
-                                                           fvalue REAL,
-                                                           tvalue DATE,
-                                                           tsvalue TIMESTAMP,
-                                                           index BIGINT,
-                                                           PRIMARY KEY(_resource, _key, label),
-                                                           UNIQUE(_resource,_key,index),
-                                                           FOREIGN KEY(_resource,_key) REFERENCES MProv_Node
-                                                             ON DELETE CASCADE)
-                           """
-
-        edge_table = """
-                     CREATE TABLE IF NOT EXISTS MProv_Edge(_key SERIAL,
-                                                           _resource VARCHAR(80) NOT NULL,
-                                                           _from VARCHAR(80) NOT NULL,
-                                                           _to VARCHAR(80) NOT NULL,
-                                                           label VARCHAR(80),
-                                                           PRIMARY KEY(_resource, _key),
-                                                           UNIQUE(_resource, _from, _to, label),
-                                                           FOREIGN KEY(_resource, _from) REFERENCES MProv_Node
-                                                            ON DELETE CASCADE,
-                                                           FOREIGN KEY(_resource, _to) REFERENCES MProv_Node
-                                                            ON DELETE CASCADE)
-                     """
-
-        edge_props_table = """
-                     CREATE TABLE IF NOT EXISTS MProv_EdgeProp(_key INTEGER NOT NULL,
-                                                           _resource VARCHAR(80) NOT NULL,
-                                                           _created SERIAL,
-                                                           type VARCHAR(80),
-                                                           label VARCHAR(80),
-                                                           value VARCHAR,
-                                                           code CHAR(1),
-                                                           ivalue INTEGER,
-                                                           lvalue BIGINT,
-                                                           dvalue DOUBLE PRECISION,
-                                                           fvalue REAL,
-                                                           tvalue DATE,
-                                                           tsvalue TIMESTAMP,
-                                                           index BIGINT,
-                                                           PRIMARY KEY(_resource, _key, label),
-                                                           UNIQUE(_resource,_key,index),
-                                                           FOREIGN KEY(_resource,_key) REFERENCES MProv_Edge
-                                                             ON DELETE CASCADE)
-                           """
-
-        schema_table = """
-                     CREATE TABLE IF NOT EXISTS MProv_Schema(_key VARCHAR(80) NOT NULL,
-                                                           _resource VARCHAR(80) NOT NULL,
-                                                           name VARCHAR(80) NOT NULL,
-                                                           value VARCHAR,
-                                                           PRIMARY KEY(_resource, _key),
-                                                           UNIQUE(_resource, name))
-                       """
-
-        with self.graph_conn as conn:
-            with conn.cursor() as cursor:
-                cursor.execute(node_table)
-                cursor.execute(node_props_table)
-                cursor.execute(edge_table)
-                cursor.execute(edge_props_table)
-                cursor.execute(schema_table)
-        return
-    
     def create_or_reset_graph(self):
-        with self.graph_conn as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("DELETE FROM MProv_Edge WHERE _resource = (%s)", (self.get_graph(),))
+        self.flush()
+        self.backend.reset_graph(self.get_graph())
+        if self._written is not None:
+            self._written.clear()
+        if self.cache is not None:
+            self.cache.clear()
+        if self.reachability is not None:
+            # Empty now, so there is nothing to load
+            self.reachability.load(self.get_graph(), ())
         try:
             self.store_agent(self.get_username())
         except psycopg2.errors.UniqueViolation:
@@ -161,6 +224,7 @@ class MProvConnection:
         self.flush()
 
     def create_or_reuse_graph(self):
+        self.backend.create_graph(self.get_graph())
         try:
             self.store_agent(self.get_username())
         except psycopg2.errors.UniqueViolation:
@@ -176,15 +240,87 @@ class MProvConnection:
 
     def set_graph(self, name):
         """
-        Set the name of the graph in the graph store
+        Set the name of the graph in the graph store, creating its partitions
+        if need be
         :param name:
         :return:
         """
         self.graph_name = name
+        self.backend.create_graph(name)
 
     def get_username(self):
         return config.provenance.user
 
+    @contextmanager
+    def _batch(self):
+        """
+        Collect the rows written by a store_* call.  Unbuffered, they are
+        submitted when the block exits; buffered, they are appended to the
+        pending buffer, which is submitted once it reaches buffer_size rows or
+        flush_interval seconds.
+        """
+        batch = WriteBatch(self._get_written(), self._pending)
+        yield batch
+
+        if self._buffer is None:
+            self._submit(batch)
+        else:
+            self._buffer.extend(batch)
+            self._pending.update(batch.new_keys)
+            if len(self._buffer) >= self.buffer_size or \
+                    time.time() - self._last_flush >= self.flush_interval:
+                self.flush()
+
+    def _get_written(self):
+        # type: () -> WrittenSet
+        """
+        The set of nodes and edges written, forgotten whenever the backend
+        starts storing a new period (see StorageBackend.write_epoch)
+        """
+        if self._written is not None:
+            epoch = self.backend.write_epoch()
+            if epoch != self._epoch:
+                self._written.clear()
+                self._epoch = epoch
+        return self._written
+
+    def _submit(self, batch):
+        # type: (WriteBatch) -> None
+        """
+        Write a batch in its own transaction, or queue it for the background
+        writer, which records it once committed
+        """
+        if self.cache is not None:
+            self.cache.invalidate_batch(batch)
+        if self._writer is not None:
+            self._writer.submit(batch)
+        elif self._ingest is not None:
+            self._ingest.stage(self.graph_conn, batch)
+            self._record_written(batch)
+        else:
+            self.backend.write_batch(batch)
+            self._record_written(batch)
+
+    def _copy_batch(self, batch):
+        # type: (WriteBatch) -> None
+        if self.cache is not None:
+            self.cache.invalidate_batch(batch)
+        self.backend.bulk_write(batch)
+        self._record_written(batch)
+
+    def _record_written(self, batch):
+        # type: (WriteBatch) -> None
+        """
+        Remember the nodes and edges of a committed batch, so they are not
+        written again, and add its edges to the reachability index.  Batches
+        that are dropped or fail are never recorded, so storing their rows
+        again writes them.
+        """
+        if self._written is not None:
+            self._written.update(batch.new_keys)
+        if self.reachability is not None:
+            self.reachability.add_batch(batch)
+
     # Create a unique ID for an operator stream window
     @staticmethod
     def get_window_id(stream_operator, wid):
@@ -229,17 +365,7 @@ class MProvConnection:
     @staticmethod
     def get_activity_id(operator, aid):
         # type: (str, Any) -> str
-        if aid:
-            dk = hashlib.pbkdf2_hmac('sha256', (operator+aid).encode('utf-8'), b'prov', 20)
-
-            stream = binascii.hexlify(dk).decode('utf-8')
-
-            return stream#operator + '._a' + str(aid)
-        else:
-            dk = hashlib.pbkdf2_hmac('sha256', (operator).encode('utf-8'), b'prov', 20)
-
-            stream = binascii.hexlify(dk).decode('utf-8')
-            return stream#'a_' + operator
+        return MProvConnection.token_generator.activity_id(operator, aid)
 
     def get_agent_token(self, agent_name):
         # type (str) -> str
@@ -248,16 +374,12 @@ class MProvConnection:
     def store_agent(self, agent_name):
         # type: (str) -> str
         agent_key = self._get_qname(self.user_token)
-        with self.graph_conn as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("INSERT INTO MProv_Node(_key,_resource,label) VALUES(%s,%s,'AGENT') ON CONFLICT DO NOTHING", \
-                    (agent_key,self.get_graph()))
-
+        with self._batch() as batch:
+            if batch.add_node(self.get_graph(), agent_key, 'AGENT'):
                 key = self._get_qname('agent_name')
                 value = self.user_token
 
-                cursor.execute("INSERT INTO MProv_NodeProp(_key,_resource,label,value,code,index) VALUES(%s,%s,%s,%s,'S',0) ON CONFLICT DO NOTHING", \
-                    (agent_key, self.get_graph(), key, value))
+                batch.add_prop(self.get_graph(), agent_key, key, value, code='S', index=0)
 
         logging.debug('Storing AGENT %s' % str(self.user_token))
 
@@ -278,78 +400,50 @@ class MProvConnection:
         :param location: Index position etc
         :return:
         """
-        node_key = self.get_activity_id(activity,location)#self._get_qname(self.get_activity_id(activity,location))
-        with self.graph_conn as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("INSERT INTO MProv_Node(_key,_resource,label) VALUES(%s,%s,'ACTIVITY') ON CONFLICT DO NOTHING", \
-                    (node_key,self.get_graph()))
+        with self._batch() as batch:
+            token = self._add_activity(batch, activity, start, end, location)
 
-                key = self._get_qname('hash')
-                value = activity
+        logging.debug('Storing ACTIVITY %s with ASSOCIATION %s', str(token), str(self.user_token))
 
-                cursor.execute("INSERT INTO MProv_NodeProp(_key,_resource,label,value,code,index) VALUES(%s,%s,%s,%s,'S',0) ON CONFLICT DO NOTHING", \
-                    (node_key, self.get_graph(), key, value))
+        return token
 
-                key = self._get_qname('agent')
-                value = self.get_username()
+    def _add_activity(self, batch, activity, start, end, location):
+        # type: (WriteBatch, str, int, int, Any) -> str
+        node_key = self.get_activity_id(activity,location)#self._get_qname(self.get_activity_id(activity,location))
 
-                cursor.execute("INSERT INTO MProv_NodeProp(_key,_resource,label,value,code,index) VALUES(%s,%s,%s,%s,'S',1) ON CONFLICT DO NOTHING", \
-                    (node_key, self.get_graph(), key, value))
+        # An activity's properties are only written with its node, so an
+        # activity already written needs nothing more
+        if batch.add_node(self.get_graph(), node_key, 'ACTIVITY'):
+            key = self._get_qname('hash')
+            value = activity
 
-                cursor.execute("INSERT INTO MProv_Edge(_resource,_from,_to,label) VALUES((%s),(%s),(%s),'wasAssociatedWith') ON CONFLICT DO NOTHING", \
-                    (self.get_graph(),node_key,self._get_qname(value)))
+            batch.add_prop(self.get_graph(), node_key, key, value, code='S', index=0)
 
-                key = self._get_qname('provDmStartTime')
-                value = datetime.datetime.now()
-                cursor.execute("INSERT INTO MProv_NodeProp(_key,_resource,label,tsvalue,code,index) VALUES(%s,%s,%s,%s,'S',2) ON CONFLICT DO NOTHING", \
-                    (node_key, self.get_graph(), key, value))
-                key = self._get_qname('provDmEndTime')
-                value = datetime.datetime.now()
-                cursor.execute("INSERT INTO MProv_NodeProp(_key,_resource,label,tsvalue,code,index) VALUES(%s,%s,%s,%s,'S',3) ON CONFLICT DO NOTHING", \
-                    (node_key, self.get_graph(), key, value))
+            key = self._get_qname('agent')
+            value = self.get_username()
 
+            batch.add_prop(self.get_graph(), node_key, key, value, code='S', index=1)
 
-        token = node_key
+            batch.add_edge(self.get_graph(), node_key, self._get_qname(value), 'wasAssociatedWith')
 
-        logging.debug('Storing ACTIVITY %s with ASSOCIATION %s', str(token), str(self.user_token))
+            key = self._get_qname('provDmStartTime')
+            value = datetime.datetime.now()
+            batch.add_prop(self.get_graph(), node_key, key, value, 'tsvalue', code='S', index=2)
+            key = self._get_qname('provDmEndTime')
+            value = datetime.datetime.now()
+            batch.add_prop(self.get_graph(), node_key, key, value, 'tsvalue', code='S', index=3)
 
-        return token
+        return node_key
 
-    def _write_tuple(self, cursor, resource, node, tuple):
-        if isinstance(tuple, BasicTuple):
-            for i, k in enumerate(tuple.schema.fields):
-                v = tuple[k]
-                if isinstance(v, int):
-                    cursor.execute("INSERT INTO MProv_NodeProp(_key,_resource,label,ivalue) VALUES(%s,%s,%s,%s) ON CONFLICT DO NOTHING", \
-                        (node, resource, k, v))
-                elif isinstance(v, float):
-                    cursor.execute("INSERT INTO MProv_NodeProp(_key,_resource,label,fvalue) VALUES(%s,%s,%s,%s) ON CONFLICT DO NOTHING", \
-                        (node, resource, k, v))
-                elif isinstance(v, datetime.datetime):
-                    cursor.execute("INSERT INTO MProv_NodeProp(_key,_resource,label,tsvalue) VALUES(%s,%s,%s,%s) ON CONFLICT DO NOTHING", \
-                        (node, resource, k, v))
-                else:
-                    cursor.execute("INSERT INTO MProv_NodeProp(_key,_resource,label,value) VALUES(%s,%s,%s,%s) ON CONFLICT DO NOTHING", \
-                        (node, resource, k, v))
-
-                i = i + 1
+    def _write_tuple(self, batch, resource, node, tuple):
+        # type: (WriteBatch, str, str, Any) -> None
+        if self.tuple_storage == 'jsonb':
+            batch.add_json(resource, node, tuple)
+        elif self.tuple_storage == 'schema' and isinstance(tuple, BasicTuple):
+            schema_id = self.schemas.register(self.graph_conn, resource, tuple.schema)
+            batch.add_positional(resource, node, schema_id, tuple)
         else:
-            i = 0
-            for k,v in tuple.items():
-                if isinstance(v, int):
-                    cursor.execute("INSERT INTO MProv_NodeProp(_key,_resource,label,ivalue) VALUES(%s,%s,%s,%s) ON CONFLICT DO NOTHING", \
-                        (node, resource, k, v))
-                elif isinstance(v, float):
-                    cursor.execute("INSERT INTO MProv_NodeProp(_key,_resource,label,fvalue) VALUES(%s,%s,%s,%s) ON CONFLICT DO NOTHING", \
-                        (node, resource, k, v))
-                elif isinstance(v, datetime.datetime):
-                    cursor.execute("INSERT INTO MProv_NodeProp(_key,_resource,label,tsvalue) VALUES(%s,%s,%s,%s) ON CONFLICT DO NOTHING", \
-                        (node, resource, k, v))
-                else:
-                    cursor.execute("INSERT INTO MProv_NodeProp(_key,_resource,label,value) VALUES(%s,%s,%s,%s) ON CONFLICT DO NOTHING", \
-                        (node, resource, k, v))
-
-                i = i + 1
+            batch.add_tuple(resource, node, tuple)
 
     def store_stream_tuple(self, stream_name, stream_index, input_tuple):
         # type: (str, int, BasicTuple) -> str
@@ -362,7 +456,47 @@ class MProvConnection:
         :param input_tuple: The actual stream value
         :return: token for the new node
         """
+        with self._batch() as batch:
+            token = self._add_stream_tuple(batch, stream_name, stream_index, input_tuple)
+
+        logging.debug('Storing ENTITY ' + str(token))
+
+        return token
+
+    def store_stream_tuples(self, stream_name, indexed_tuples, batch_size=10000):
+        # type: (str, Iterable[Tuple[int, BasicTuple]], int) -> List[str]
+
+        """
+        Bulk-load entity nodes for a sequence of stream tuples.  The rows are
+        streamed to the server with COPY into temporary staging tables and then
+        merged into the graph, batch_size tuples per transaction.
 
+        :param stream_name: The name of the stream itself
+        :param indexed_tuples: Iterable of (stream_index, tuple) pairs, as for store_stream_tuple
+        :param batch_size: Number of tuples to stage per transaction
+        :return: tokens for the new nodes, in input order
+        """
+        # Keep buffered writes ahead of the bulk load
+        self.flush()
+
+        tokens = []
+        batch = WriteBatch(self._get_written())
+        for stream_index, input_tuple in indexed_tuples:
+            tokens.append(self._add_stream_tuple(batch, stream_name, stream_index, input_tuple))
+
+            if len(tokens) % batch_size == 0:
+                self._copy_batch(batch)
+                batch.clear()
+
+        if len(batch) > 0:
+            self._copy_batch(batch)
+
+        logging.debug('Storing %d ENTITY nodes for %s', len(tokens), stream_name)
+
+        return tokens
+
+    def _add_stream_tuple(self, batch, stream_name, stream_index, input_tuple):
+        # type: (WriteBatch, str, Any, BasicTuple) -> str
         # The "token" for the tuple will be the node ID
         if isinstance(stream_index, int):
             token = self.get_token_qname(self.get_entity_id(stream_name, stream_index - 1))
@@ -376,14 +510,9 @@ class MProvConnection:
         else:
             input_tuple[self._get_qname("prov")] = self.get_entity_id(stream_name, stream_index)
 
-        with self.graph_conn as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("INSERT INTO MProv_Node(_key,_resource,label) VALUES(%s,%s,'ENTITY') ON CONFLICT DO NOTHING", \
-                    (token,self.get_graph()))
-
-                self._write_tuple(cursor, self.get_graph(), token, input_tuple)
+        batch.add_node(self.get_graph(), token, 'ENTITY')
 
-        logging.debug('Storing ENTITY ' + str(token))
+        self._write_tuple(batch, self.get_graph(), token, input_tuple)
 
         return token
 
@@ -397,26 +526,110 @@ class MProvConnection:
         :return: String ID (local part of QName) for the node
         """
 
-        dk = hashlib.pbkdf2_hmac('sha256', code.encode('utf-8'), b'mprov', 10000)
-
-        stream = binascii.hexlify(dk).decode('utf-8')
-
         # The "token" for the tuple will be the node ID
-        token = self.get_entity_id(stream)
+        token = self.get_code_id(code, self.code_id_version)
 
         # Now we'll create a tuple within the provenance node, to capture the data
         data = {self._get_qname("prov"): token, 'code': code, 'type': 'python3'}
 
+        with self._batch() as batch:
+            # The code node is content-addressed, so if it was written, so was its data
+            if batch.add_node(self.get_graph(), token, 'ENTITY'):
+                self._write_tuple(batch, self.get_graph(), token, data)
+
+        logging.debug('Storing ENTITY ' + str(token))
+
+        return token
+
+    # Create a content-addressed ID for a code definition.  Version 1 hashes the
+    # code with 10,000 rounds of PBKDF2, as store_code originally did; version 2
+    # uses a single BLAKE2b digest, with a prefix that keeps the two apart.
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def get_code_id(code, version=2):
+        # type: (str, int) -> str
+        if version == 1:
+            dk = hashlib.pbkdf2_hmac('sha256', code.encode('utf-8'), b'mprov', 10000)
+            return MProvConnection.get_entity_id(binascii.hexlify(dk).decode('utf-8'))
+        elif version == 2:
+            digest = hashlib.blake2b(code.encode('utf-8'), digest_size=20).hexdigest()
+            return MProvConnection.get_entity_id('v2.' + digest)
+        else:
+            raise ValueError('Unknown code ID version ' + str(version))
+
+    def find_code(self, code):
+        # type: (str) -> str
+        """
+        Look up the token of a stored code definition, whichever code ID
+        version it was stored under
+
+        :param code: Source code definition
+        :return: String ID (local part of QName) for the node, or None if the code was not stored
+        """
+        self.flush()
+        # Prefer the version we write
+        versions = [self.code_id_version] + [v for v in self.CODE_ID_VERSIONS if v != self.code_id_version]
+        tokens = [self.get_code_id(code, version) for version in versions]
+        found = set(self.backend.find_nodes(self.get_graph(), tokens))
+
+        for token in tokens:
+            if token in found:
+                return token
+        return None
+
+    def migrate_activity_keys(self, activities=(), from_generator=None):
+        # type: (Iterable[Tuple[str, Any]], TokenGenerator) -> Dict[str, str]
+        """
+        Rewrite the keys of activity nodes created under another token generator
+        (by default, the PBKDF2 IDs of earlier releases) to the current
+        token_generator, moving their properties and edges along with them.
+
+        Activities stored without a location are found from their stored operator
+        name.  Located activity IDs cannot be recomputed from the graph, so the
+        (operator, location) pairs used to store them must be passed in.
+
+        :param activities: Iterable of (operator, location) pairs, as passed to store_activity
+        :param from_generator: Generator the existing keys were created with
+        :return: Map from old to new activity key
+        """
+        if self.layout is None:
+            raise ValueError('Migrating activity keys needs the postgres backend')
+        if from_generator is None:
+            from_generator = Pbkdf2TokenGenerator()
+
+        self.flush()
+        key_map = {}
+        for operator, location in activities:
+            key_map[from_generator.activity_id(operator, location)] = self.get_activity_id(operator, location)
+
         with self.graph_conn as conn:
             with conn.cursor() as cursor:
-                cursor.execute("INSERT INTO MProv_Node(_key,_resource,label) VALUES(%s,%s,'ENTITY') ON CONFLICT DO NOTHING", \
-                    (token,self.get_graph()))
+                cursor.execute(self.layout.ACTIVITY_OPERATORS, (self.get_graph(), self._get_qname('hash')))
+                for key, operator in cursor.fetchall():
+                    if operator is not None and key == from_generator.activity_id(operator, None):
+                        key_map[key] = self.get_activity_id(operator, None)
 
-                self._write_tuple(cursor, self.get_graph(), token, data)
+                key_map = {old: new for old, new in key_map.items() if old != new}
+                if not key_map:
+                    return key_map
 
-        logging.debug('Storing ENTITY ' + str(token))
+                cursor.execute("CREATE TEMP TABLE MProv_KeyMap(old_key VARCHAR(80) PRIMARY KEY, "
+                               "new_key VARCHAR(80)) ON COMMIT DROP")
+                execute_values(cursor, "INSERT INTO MProv_KeyMap(old_key,new_key) VALUES %s", list(key_map.items()))
 
-        return token
+                # Removes the old nodes, with their properties and edges
+                for statement in self.layout.REKEY_NODES:
+                    cursor.execute(statement, (self.get_graph(),))
+
+        if self._written is not None:
+            self._written.clear()
+        if self.cache is not None:
+            self.cache.clear()
+        if self.reachability is not None:
+            self.reachability.clear()
+
+        logging.debug('Migrated %d ACTIVITY keys', len(key_map))
+        return key_map
 
     def store_annotations(self,
                           node_token,
@@ -443,17 +656,14 @@ class MProvConnection:
         return ann_tokens
 
     def _write_annot(self, ann_token, node_token, attributes):
-        with self.graph_conn as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("INSERT INTO MProv_Node(_key,_resource,label) VALUES(%s,%s,'ENTITY') ON CONFLICT DO NOTHING", \
-                    (ann_token,self.get_graph()))
-                # Then we add a relationship edge (of type ANNOTATED)
-                cursor.execute("INSERT INTO MProv_Edge(_resource,_from,_to,label) VALUES(%s,%s,%s,'_annotated') ON CONFLICT DO NOTHING", \
-                    (self.get_graph(),ann_token,node_token))
-                logging.debug('Wrote ANNOT edge %s' % ann_token)
+        with self._batch() as batch:
+            batch.add_node(self.get_graph(), ann_token, 'ENTITY')
+            # Then we add a relationship edge (of type ANNOTATED)
+            batch.add_edge(self.get_graph(), ann_token, node_token, '_annotated')
+            logging.debug('Wrote ANNOT edge %s' % ann_token)
 
-                # Write the annotation tuple
-                self._write_tuple(cursor, self.get_graph(), ann_token, attributes)
+            # Write the annotation tuple
+            self._write_tuple(batch, self.get_graph(), ann_token, attributes)
 
 
     def store_annotation(self,
@@ -501,27 +711,30 @@ class MProvConnection:
         :param input_tokens_list:
         :return:
         """
+        with self._batch() as batch:
+            window_token = self._add_window_and_inputs(batch, output_stream_name, output_stream_index,
+                                                       input_tokens_list)
 
+        return window_token
+
+    def _add_window_and_inputs(self, batch, output_stream_name, output_stream_index, input_tokens_list):
+        # type: (WriteBatch, str, Any, list) -> str
         # The "token" for the tuple will be the node ID
         if isinstance(output_stream_index, int):
             window_token = self.get_token_qname(self.get_window_id(output_stream_name, output_stream_index - 1))
         else:
             window_token = self.get_token_qname(self.get_window_id(output_stream_name, output_stream_index))
 
-        with self.graph_conn as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("INSERT INTO MProv_Node(_key,_resource,label) VALUES(%s,%s,'COLLECTION') ON CONFLICT DO NOTHING", \
-                    (window_token,self.get_graph()))
+        batch.add_node(self.get_graph(), window_token, 'COLLECTION')
 
-                logging.debug('Storing COLLECTION %s' % str(window_token))
+        logging.debug('Storing COLLECTION %s' % str(window_token))
 
-                for token in input_tokens_list:
-                    # Add a relationship edge (of type ANNOTATED)
-                    # from window to its inputs
-                    token_qname = self.get_token_qname(token)
+        for token in input_tokens_list:
+            # Add a relationship edge (of type ANNOTATED)
+            # from window to its inputs
+            token_qname = self.get_token_qname(token)
 
-                    cursor.execute("INSERT INTO MProv_Edge(_resource,_from,_to,label) VALUES(%s,%s,%s,'hadMember') ON CONFLICT DO NOTHING", \
-                        (self.get_graph(), window_token, token_qname))
+            batch.add_edge(self.get_graph(), window_token, token_qname, 'hadMember')
 
         return window_token
 
@@ -548,20 +761,17 @@ class MProvConnection:
         :param end: End time
         :return:
         """
-        result_token = self.store_stream_tuple(output_stream_name, output_stream_index, output_tuple)
+        # The whole subgraph is written in one transaction
+        with self._batch() as batch:
+            result_token = self._add_stream_tuple(batch, output_stream_name, output_stream_index, output_tuple)
 
-        activity_token = self.store_activity(activity, start, end, output_stream_index)
+            activity_token = self._add_activity(batch, activity, start, end, output_stream_index)
 
-        with self.graph_conn as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("INSERT INTO MProv_Edge(_resource,_from,_to,label) VALUES(%s,%s,%s,'wasDerivedFrom') ON CONFLICT DO NOTHING", \
-                    (self.get_graph(), result_token, input_token))
+            batch.add_edge(self.get_graph(), result_token, input_token, 'wasDerivedFrom')
 
-                cursor.execute("INSERT INTO MProv_Edge(_resource,_from,_to,label) VALUES(%s,%s,%s,'used') ON CONFLICT DO NOTHING", \
-                    (self.get_graph(), activity_token, input_token))
+            batch.add_edge(self.get_graph(), activity_token, input_token, 'used')
 
-                cursor.execute("INSERT INTO MProv_Edge(_resource,_from,_to,label) VALUES(%s,%s,%s,'wasGeneratedBy') ON CONFLICT DO NOTHING", \
-                    (self.get_graph(), result_token, activity_token))
+            batch.add_edge(self.get_graph(), result_token, activity_token, 'wasGeneratedBy')
 
         logging.debug('Storing DERIVATION %s', result_token)
         return result_token
@@ -581,16 +791,11 @@ class MProvConnection:
         token = self.get_token_qname(self.get_entity_id(collection_name, collection_version))
 
         # Create a node for the collection
-        with self.graph_conn as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("INSERT INTO MProv_Node(_key,_resource,label) VALUES(%s,%s,'COLLECTION') ON CONFLICT DO NOTHING", \
-                    (token,self.get_graph()))
+        with self._batch() as batch:
+            batch.add_node(self.get_graph(), token, 'COLLECTION')
 
-        if prior_token:
-            with self.graph_conn as conn:
-                with conn.cursor() as cursor:
-                    cursor.execute("INSERT INTO MProv_Edge(_resource,_from,_to,label) VALUES(%s,%s,%s,'wasDerivedFrom') ON CONFLICT DO NOTHING", \
-                        (self.get_graph(), token, prior_token))
+            if prior_token:
+                batch.add_edge(self.get_graph(), token, prior_token, 'wasDerivedFrom')
 
         return token
 
@@ -603,10 +808,8 @@ class MProvConnection:
         :param collection_token:
         :return:
         """
-        with self.graph_conn as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("INSERT INTO MProv_Edge(_resource,_from,_to,label) VALUES(%s,%s,%s,'hadMember') ON CONFLICT DO NOTHING", \
-                    (self.get_graph(), collection_token, tuple_token))
+        with self._batch() as batch:
+            batch.add_edge(self.get_graph(), collection_token, tuple_token, 'hadMember')
 
     def store_windowed_result(self,
                               output_stream_name,
@@ -631,20 +834,18 @@ class MProvConnection:
         :param end: End time
         :return:
         """
-        result_token = self.store_stream_tuple(output_stream_name, output_stream_index, output_tuple)
-        window_token = self.store_window_and_inputs(output_stream_name, output_stream_index, input_tokens_list)
+        # The whole subgraph is written in one transaction
+        with self._batch() as batch:
+            result_token = self._add_stream_tuple(batch, output_stream_name, output_stream_index, output_tuple)
+            window_token = self._add_window_and_inputs(batch, output_stream_name, output_stream_index,
+                                                       input_tokens_list)
 
-        activity_token = self.store_activity(activity, start, end, output_stream_index)
+            activity_token = self._add_activity(batch, activity, start, end, output_stream_index)
 
-        with self.graph_conn as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("INSERT INTO MProv_Edge(_resource,_from,_to,label) VALUES(%s,%s,%s,'wasDerivedFrom') ON CONFLICT DO NOTHING", \
-                    (self.get_graph(), result_token, window_token))
-                cursor.execute("INSERT INTO MProv_Edge(_resource,_from,_to,label) VALUES(%s,%s,%s,'used') ON CONFLICT DO NOTHING", \
-                    (self.get_graph(), activity_token, window_token))
+            batch.add_edge(self.get_graph(), result_token, window_token, 'wasDerivedFrom')
+            batch.add_edge(self.get_graph(), activity_token, window_token, 'used')
 
-                cursor.execute("INSERT INTO MProv_Edge(_resource,_from,_to,label) VALUES(%s,%s,%s,'wasGeneratedBy') ON CONFLICT DO NOTHING", \
-                    (self.get_graph(), result_token, activity_token))
+            batch.add_edge(self.get_graph(), result_token, activity_token, 'wasGeneratedBy')
 
         return result_token
 
@@ -656,10 +857,8 @@ class MProvConnection:
         :param source_node:
         :return:
         """
-        with self.graph_conn as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("INSERT INTO MProv_Edge(_resource,_from,_to,label) VALUES(%s,%s,%s,'wasDerivedFrom') ON CONFLICT DO NOTHING", \
-                    (self.get_graph(), derived_node, source_node))
+        with self._batch() as batch:
+            batch.add_edge(self.get_graph(), derived_node, source_node, 'wasDerivedFrom')
 
     def store_used(self, activity_node, input_node):
         # types: (str, str) -> str
@@ -669,10 +868,8 @@ class MProvConnection:
         :param input_node:
         :return:
         """
-        with self.graph_conn as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("INSERT INTO MProv_Edge(_resource,_from,_to,label) VALUES(%s,%s,%s,'used') ON CONFLICT DO NOTHING", \
-                    (self.get_graph(), activity_node, input_node))
+        with self._batch() as batch:
+            batch.add_edge(self.get_graph(), activity_node, input_node, 'used')
 
     def store_generated_by(self, output_node, activity_node):
         # types: (str, str) -> str
@@ -683,10 +880,8 @@ class MProvConnection:
         :param activity_node:
         :return:
         """
-        with self.graph_conn as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("INSERT INTO MProv_Edge(_resource,_from,_to,label) VALUES(%s,%s,%s,'wasGeneratedBy') ON CONFLICT DO NOTHING", \
-                    (self.get_graph(), output_node, activity_node))
+        with self._batch() as batch:
+            batch.add_edge(self.get_graph(), output_node, activity_node, 'wasGeneratedBy')
 
     def _get_qname(self, local_part):
         # types: (str) -> str
@@ -718,9 +913,17 @@ class MProvConnection:
         :param entity_id:
         :return:
         """
-        result = self.get_provenance_data(self.get_graph(), (entity_id))
+        return [self.get_nodes([entity_id])[entity_id]]
 
-        return result
+    def get_nodes(self, entity_ids):
+        # type: (Iterable[str]) -> Dict[str, Dict]
+        """
+        Returns the tuple data associated with several node IDs, fetched with
+        one query rather than one per node
+        :param entity_ids:
+        :return: The data of each node (empty if it has none), by node ID, in the order given
+        """
+        return self.get_provenance_nodes(self.get_graph(), entity_ids)
 
     def get_source_entities(self, entity_id):
         # type: (str) -> List[str]
@@ -763,6 +966,16 @@ class MProvConnection:
         # results = [self.parse_qname(tok.token_value) for tok in results.tokens]
         return results
 
+    def iter_child_entities(self, entity_id, after=None, limit=None):
+        # type: (str, str, int) -> Iterator[str]
+        """
+        The child (member) nodes one at a time, in token order, e.g. to page
+        through the members of a stream collection
+        :param after: Token the members follow, typically the last one of the previous page
+        :param limit: Most members returned, or None for all of them
+        """
+        return self.iter_connected_from(self.get_graph(), entity_id, 'hadMember', after, limit)
+
     def get_creating_activities(self, entity_id):
         # type: (str) -> List[str]
         """
@@ -802,9 +1015,11 @@ class MProvConnection:
         :param node_id:
         :return:
         """
-        results = self.get_connected_to(self.get_graph(), (node_id), '_annotated')
+        # Annotation nodes and their properties, in one query
+        self.flush()
+        results = self.backend.connected_props(self.get_graph(), node_id, '_annotated')
 
-        results = [self.get_node(eid) for eid in results]
+        results = [[self._decode_props(self.get_graph(), rows)] for rows in results.values()]
 
         return results
 
@@ -822,17 +1037,91 @@ class MProvConnection:
         producers = []
         stream_node = self.get_token_qname(self.get_entity_id(stream_name))
 
-        for node in self.get_creating_activities(stream_node):
-            code = self.get_node(node)
+        # The code entities the stream's activities were running, in one query
+        self.flush()
+        codes = self.backend.producer_code_props(self.get_graph(), stream_node, self._get_qname('hash'))
 
-            if len(code) > 0:
-                code_id  = code[0][0]#[self._get_qname('hash')]
-                #print(code_id)
-                code = self.get_node(code_id)#self.get_token_qname(code_id))
-                producers.append(self._get_qname(code[0]['code']))
+        for rows in codes.values():
+            producers.append(self._get_qname(self._decode_props(self.get_graph(), rows)['code']))
 
         return producers
 
+    def get_lineage(self, token, direction='up', labels=None, max_depth=None, limit=None):
+        # type: (str, str, Iterable[str], int, int) -> Dict[str, list]
+        """
+        Trace a node's lineage transitively, in one query on PostgreSQL: 'up'
+        follows edges to what the node was derived from, generated by, used
+        or made of, back to the raw inputs; 'down' follows them in reverse, to
+        everything derived from the node
+
+        :param token: Node to start from
+        :param direction: 'up' or 'down'
+        :param labels: Edge labels to follow, by default LINEAGE_LABELS
+        :param max_depth: Most edges to follow from the node, at least 1, or None for no bound
+        :param limit: Most edges to return, or None for all; with max_depth, the nearest are kept
+        :return: 'nodes', a list of (token, depth) pairs, nearest first, and
+            'edges', a list of (from, to, label) triples
+        """
+        if direction not in ('up', 'down'):
+            raise ValueError('Unknown lineage direction ' + str(direction))
+        if max_depth is not None and max_depth < 1:
+            raise ValueError('The lineage depth must be at least 1')
+        if labels is None:
+            labels = self.LINEAGE_LABELS
+        self.flush()
+        reverse = direction == 'down'
+        edges = self.backend.lineage(self.get_graph(), token, list(labels), reverse, max_depth, limit)
+
+        # Depth of each node: its fewest edges from the start in the subgraph found
+        following = {}  # type: Dict[str, List[str]]
+        for from_key, to_key, _ in edges:
+            near, far = (to_key, from_key) if reverse else (from_key, to_key)
+            following.setdefault(near, []).append(far)
+        depths = {token: 0}
+        frontier = [token]
+        while frontier:
+            reached = []
+            for node in frontier:
+                for other in following.get(node, ()):
+                    if other not in depths:
+                        depths[other] = depths[node] + 1
+                        reached.append(other)
+            frontier = reached
+        del depths[token]
+        return {'nodes': sorted(depths.items(), key=lambda item: (item[1], item[0])), 'edges': edges}
+
+    def depends_on(self, token, source):
+        # type: (str, str) -> bool
+        """
+        Whether a node was transitively derived from, generated by, used or
+        made of another, e.g. whether an output depends on an input.  With a
+        reachability index this is a set lookup.
+        """
+        if self.reachability is None:
+            return source in self.ancestors(token)
+        return self.reachability.depends_on(self._load_reachability(), token, source)
+
+    def ancestors(self, token):
+        # type: (str) -> Set[str]
+        """
+        Every node a node transitively depends on (see depends_on)
+        """
+        if self.reachability is None:
+            return {node for node, _ in self.get_lineage(token, labels=ReachabilityIndex.LABELS)['nodes']}
+        return self.reachability.ancestors(self._load_reachability(), token)
+
+    def _load_reachability(self):
+        # type: () -> str
+        """
+        Write any pending edges and load the graph's closure if it is not
+        loaded, returning the graph
+        """
+        self.flush()
+        graph = self.get_graph()
+        if not self.reachability.is_loaded(graph):
+            self.reachability.load(graph, self.backend.edges(graph, self.reachability.labels, self.itersize))
+        return graph
+
     @classmethod
     def get_local_part(cls, token_value):
         # types (str) -> str
@@ -848,69 +1137,269 @@ class MProvConnection:
 
     def get_provenance_data(self, resource, token):
         # type: (str, str) -> List[Dict]
-        ret = []
-        with self.graph_conn as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("SELECT index,code,value,ivalue,lvalue,fvalue,dvalue,tvalue,tsvalue,label FROM MProv_NodeProp WHERE _resource = (%s) AND _key = (%s)", (resource,token))
-
-                results = cursor.fetchall()
-                ret = {}#[None for i in range(0,len(results))]
-                for res in results:
-                    #print(res)
-                    inx = res[0]
-                    if inx is None:
-                        inx = res[9]
-                    if res[1] is None or res[1] == 'S':
-                        ret[inx] = res[2]
-                    elif res[1] == 'I':
-                        ret[inx] = res[3]
-                    elif res[1] == 'L':
-                        ret[inx] = res[4]
-                    elif res[1] == 'F':
-                        ret[inx] = res[5]
-                    elif res[1] == 'D':
-                        ret[inx] = res[6]
-                    elif res[1] == 'T':
-                        ret[inx] = res[7]
-                    elif res[1] == 't':
-                        ret[inx] = res[8]
-                    else:
-                        raise RuntimeError('Unknown code ' + res[1])
-
-
-                #print ("Results:", token, cursor.fetchall())
-
-        return [ret]
+        return [self.get_provenance_nodes(resource, [token])[token]]
+
+    def get_provenance_nodes(self, resource, tokens):
+        # type: (str, Iterable[str]) -> Dict[str, Dict]
+        """
+        The data of several nodes, fetched with one query
+        :return: The fields of each node, by token, in the order given
+        """
+        self.flush()
+        tokens = list(tokens)
+        if self.cache is None:
+            results = self.backend.nodes_props(resource, tokens)
+            return {token: self._decode_props(resource, rows) for token, rows in results.items()}
+
+        ret = {token: self.cache.get(GraphCache.node_key(resource, token)) for token in tokens}
+        missing = [token for token, data in ret.items() if data is None]
+        if missing:
+            for token, rows in self.backend.nodes_props(resource, missing).items():
+                ret[token] = self._decode_props(resource, rows)
+                self.cache.put(GraphCache.node_key(resource, token), ret[token])
+        # Copies, so callers cannot change what is cached
+        return {token: dict(data) for token, data in ret.items()}
+
+    def _decode_props(self, resource, results):
+        # type: (str, List[tuple]) -> Dict
+        ret = {}#[None for i in range(0,len(results))]
+        for res in results:
+            #print(res)
+            inx = res[0]
+            if inx is None:
+                inx = res[9]
+            if res[1] is None or res[1] == 'S':
+                ret[inx] = res[2]
+            elif res[1] == 'I':
+                ret[inx] = res[3]
+            elif res[1] == 'L':
+                ret[inx] = res[4]
+            elif res[1] == 'F':
+                ret[inx] = res[5]
+            elif res[1] == 'D':
+                ret[inx] = res[6]
+            elif res[1] == 'T':
+                ret[inx] = res[7]
+            elif res[1] == 't':
+                ret[inx] = res[8]
+            elif res[1] == WriteBatch.TUPLE_CODE:
+                # A whole tuple, stored as JSONB
+                ret.update(res[10])
+            elif res[1] == WriteBatch.POSITIONAL_CODE:
+                # A whole tuple, stored as its schema ID and values
+                ret.update(self.schemas.decode(self.graph_conn, resource, res[2], res[10]))
+            else:
+                raise RuntimeError('Unknown code ' + res[1])
+
+        return ret
 
     def get_connected_to(self, resource, token, label1):
         # type: (str, str, str) -> List[pennprov.ProvTokenSetModel]
-        with self.graph_conn as conn:
-            with conn.cursor() as cursor:
-                if label1 is None:
-                    cursor.execute("SELECT _from FROM MProv_Edge WHERE _resource = (%s) AND _to = (%s)", (resource,token))
-                else:
-                    cursor.execute("SELECT _from FROM MProv_Edge WHERE _resource = (%s) AND _to = (%s) AND label = (%s)",
-                                   (self.get_graph(), token, label1))
-                return [x[0] for x in cursor.fetchall()]
-        return []
+        return self._get_connected(resource, token, label1, True)
 
     def get_connected_from(self, resource, token, label1):
         # type: (str, str, str) -> List[pennprov.ProvTokenSetModel]
-        with self.graph_conn as conn:
-            with conn.cursor() as cursor:
-                if label1 is None:
-                    cursor.execute("SELECT _to FROM MProv_Edge WHERE _resource = (%s) AND _from = (%s)", (resource,token))
-                else:
-                    cursor.execute("SELECT _to FROM MProv_Edge WHERE _resource = (%s) AND _from = (%s) AND label = (%s)",
-                                   (self.get_graph(), token, label1))
-                return [x[0] for x in cursor.fetchall()]
-        return []
+        return self._get_connected(resource, token, label1, False)
+
+    def _get_connected(self, resource, token, label, reverse):
+        # type: (str, str, str, bool) -> List[str]
+        self.flush()
+        if self.cache is None:
+            return self.backend.connected(resource, token, label, reverse)
+        key = GraphCache.edges_key(resource, token, label, reverse)
+        nodes = self.cache.get(key)
+        if nodes is None:
+            nodes = self.backend.connected(resource, token, label, reverse)
+            self.cache.put(key, nodes)
+        return list(nodes)
+
+    def iter_connected_to(self, resource, token, label1, after=None, limit=None, itersize=None):
+        # type: (str, str, str, str, int, int) -> Iterator[str]
+        """
+        Like get_connected_to, but streamed, and paged by token (see iter_connected_from)
+        """
+        return self._iter_connected(resource, token, label1, True, after, limit, itersize)
+
+    def iter_connected_from(self, resource, token, label1, after=None, limit=None, itersize=None):
+        # type: (str, str, str, str, int, int) -> Iterator[str]
+        """
+        Like get_connected_from, but yielding the nodes one at a time, each
+        once and in token order, as they are read from the graph store, so
+        memory use does not grow with the number of edges.  The read cache
+        is not used.
+        :param after: Token the results follow, typically the last one of the previous page
+        :param limit: Most nodes returned, or None for all of them
+        :param itersize: Rows read from the graph store at a time, by default the connection's
+        """
+        return self._iter_connected(resource, token, label1, False, after, limit, itersize)
+
+    def _iter_connected(self, resource, token, label, reverse, after, limit, itersize):
+        # type: (str, str, str, bool, str, int, int) -> Iterator[str]
+        self.flush()
+        return self.backend.iter_connected(resource, token, label, reverse, after, limit,
+                                           itersize or self.itersize)
+
+    def iter_provenance_data(self, resource, token, itersize=None):
+        # type: (str, str, int) -> Iterator[Tuple[Any, Any]]
+        """
+        The fields of a node as (field, value) pairs, streamed from the graph
+        store rather than gathered into a dict, for nodes with many properties
+        :param itersize: Rows read from the graph store at a time, by default the connection's
+        """
+        self.flush()
+        for row in self.backend.iter_node_props(resource, token, itersize or self.itersize):
+            for field in self._decode_props(resource, [row]).items():
+                yield field
 
     def flush(self):
-        return
+        """
+        Write any buffered nodes, properties and edges to the graph store,
+        wait until the background writer (if any) has committed them, and in
+        staged mode merge the staged rows into the graph
+        """
+        if self._buffer is not None:
+            if len(self._buffer) > 0:
+                self._submit(self._buffer)
+                self._buffer = WriteBatch()
+                self._pending.clear()
+            self._last_flush = time.time()
+
+        if self._writer is not None:
+            self._writer.flush()
+
+        if self._ingest is not None:
+            self._ingest.merge(self.graph_conn)
+
+    def export_graph(self, target, batch_size=10000):
+        # type: (MProvConnection, int) -> int
+        """
+        Copy every node, property and edge of this connection's graph into the
+        same graph of another connection, e.g. from a local SQLite capture to
+        PostgreSQL, in bulk (see store_stream_tuples)
+
+        :param target: Connection to write into
+        :param batch_size: Rows per transaction
+        :return: Number of rows copied
+        """
+        self.flush()
+        target.flush()
+        graph = self.get_graph()
+        target.backend.create_graph(graph)
+        rows = 0
+        for batch in self.backend.read_batches(graph, batch_size):
+            target._copy_batch(batch)
+            rows += len(batch)
+        return rows
+
+    def save_snapshot(self, path=None):
+        # type: (str) -> None
+        """
+        With the memory backend, write every graph to a snapshot file, which
+        MProvConnection(backend='memory', path=path) loads back
+
+        :param path: Snapshot file, by default the one given when connecting
+        """
+        if not isinstance(self.backend, MemoryBackend):
+            raise ValueError('Only the memory backend keeps snapshots')
+        self.flush()
+        self.backend.save(path)
+
+    def get_cache_stats(self):
+        # type: () -> Dict[str, Any]
+        """
+        Hits, misses, hit rate, evictions, expirations, invalidations and size
+        of the read cache, if any
+        """
+        if self.cache is None:
+            return {}
+        return self.cache.get_stats()
+
+    def get_dedupe_stats(self):
+        # type: () -> Dict[str, Any]
+        """
+        Hits, misses, hit rate and size of the cache of written nodes and edges
+        """
+        if self._written is None:
+            return {}
+        return self._written.get_stats()
+
+    def get_statement_stats(self):
+        # type: () -> Dict[str, Dict[str, float]]
+        """
+        Calls, total, mean and maximum seconds of each hot statement, including
+        those run by the background writer
+        """
+        return self.backend.get_statement_stats()
+
+    def create_tuple_index(self, field=None):
+        # type: (str) -> str
+        """
+        Index the tuples stored as JSONB (tuple_storage='jsonb') on one field,
+        or with a GIN index on all of them
+
+        :param field: Field to index, or None for every field
+        :return: The name of the index
+        """
+        if self.layout is None:
+            raise ValueError('Tuple indexes need the postgres backend')
+        return self.layout.create_tuple_index(self.graph_conn, field)
+
+    def expire_partitions(self, keep_days=None):
+        # type: (int) -> List[str]
+        """
+        In the time partitioned layout, detach and drop the partitions holding
+        provenance written before the last keep_days days, for every graph
+
+        :param keep_days: Days to keep, including today; retention_days by default
+        :return: Names of the partitions dropped
+        """
+        if not isinstance(self.layout, TimePartitionedLayout):
+            raise ValueError('Only the time layout stores provenance by day')
+        if keep_days is None:
+            keep_days = self.layout.retention_days
+        if not keep_days:
+            raise ValueError('No retention period given')
+        self.flush()
+        if self.cache is not None:
+            self.cache.clear()
+        if self.reachability is not None:
+            self.reachability.clear()
+        return self.layout.expire_partitions(self.graph_conn, keep_days)
+
+    def get_writer_stats(self):
+        # type: () -> Dict[str, int]
+        """
+        In asynchronous mode, the number of rows written, transactions committed,
+        batches still queued and batches dropped by the background writer
+        """
+        if self._writer is None:
+            return {}
+        return self._writer.get_stats()
+
+    def get_staging_stats(self):
+        # type: () -> Dict[str, Any]
+        """
+        In staged mode, the rows this connection staged, merged and rejected
+        (properties and edges of nodes that do not exist), the merges it ran
+        and their total seconds, the seconds since its last merge, the staging
+        lag: rows waiting to be merged and the age of the oldest, and the rows
+        in the rejected tables
+        """
+        if self._ingest is None:
+            return {}
+        return self._ingest.get_stats(self.graph_conn)
 
     def close(self):
-        return
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._ingest is not None:
+            self._ingest.close()
+            self._ingest = None
+        if self.backend is not None:
+            self.backend.close()
+            self.backend = None
 
     def __del__(self):
         self.close()
@@ -0,0 +1,70 @@
+"""
+ Copyright 2021 Trustees of the University of Pennsylvania
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import time
+
+
+class PreparedStatements:
+    """
+    PreparedStatements runs a fixed set of named SQL statements on one database
+    session.  Each is PREPAREd the first time it is run, and EXECUTEd from then
+    on, so the server parses and plans it only once.  The latency of every
+    execution is recorded per statement.
+    """
+    def __init__(self, statements, prepare=True):
+        # type: (Dict[str, Tuple[str, Sequence[str]]], bool) -> None
+        """
+        :param statements: Map from statement name to (SQL with %s parameters, parameter types)
+        :param prepare: If False, send the SQL each time, to compare against
+        """
+        self.statements = statements
+        self.prepare = prepare
+        self._prepared = set()
+        self._latency = {}
+
+    def execute(self, cursor, name, params):
+        # type: (Any, str, Sequence) -> None
+        """
+        Run the named statement through the cursor
+        """
+        sql, types = self.statements[name]
+        args = tuple('%s::' + t for t in types)
+
+        start = time.perf_counter()
+        if self.prepare:
+            if name not in self._prepared:
+                numbered = sql % tuple('$' + str(i + 1) for i in range(len(types)))
+                cursor.execute('PREPARE ' + name + '(' + ','.join(types) + ') AS ' + numbered)
+                # Prepared statements belong to the session, and outlive a rollback
+                self._prepared.add(name)
+            cursor.execute('EXECUTE ' + name + '(' + ','.join(args) + ')', params)
+        else:
+            cursor.execute(sql % args, params)
+        self._record(name, time.perf_counter() - start)
+
+    def _record(self, name, seconds):
+        # type: (str, float) -> None
+        stats = self._latency.get(name)
+        if stats is None:
+            stats = self._latency[name] = {'calls': 0, 'total': 0.0, 'max': 0.0}
+        stats['calls'] += 1
+        stats['total'] += seconds
+        stats['max'] = max(stats['max'], seconds)
+
+    def get_stats(self):
+        # type: () -> Dict[str, Dict[str, float]]
+        """
+        Calls, total and maximum seconds, and mean seconds of each statement run so far
+        """
+        return {name: dict(stats, mean=stats['total'] / stats['calls'])
+                for name, stats in self._latency.items()}
@@ -0,0 +1,124 @@
+"""
+ Copyright 2021 Trustees of the University of Pennsylvania
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import datetime
+import hashlib
+import json
+import threading
+import weakref
+
+# For declared types JSON does not keep, the JSON type their values are read
+# back as, and how to restore them
+_DECODERS = {
+    'float': (int, float),
+    'real': (int, float),
+    'double': (int, float),
+    'date': (str, datetime.date.fromisoformat),
+    'datetime': (str, datetime.datetime.fromisoformat),
+    'timestamp': (str, datetime.datetime.fromisoformat),
+}
+
+
+class SchemaRegistry:
+    """
+    SchemaRegistry records each BasicSchema in MProv_Schema, once per graph,
+    under an ID derived from its name, fields and types, so every process
+    gives a schema the same ID without asking the database.  Tuples of a
+    registered schema are stored as the ID and a positional array of values
+    (see WriteBatch.add_positional), and decoded from a cached copy of the
+    schema.  It may be shared by the threads of a connection.
+    """
+    def __init__(self):
+        # ID of each schema, and the number of fields it had when computed
+        self._ids = weakref.WeakKeyDictionary()
+        # (graph, ID) of the schemas known to be in MProv_Schema
+        self._registered = set()
+        # Fields and declared types of each schema ID
+        self._definitions = {}  # type: Dict[str, Tuple[List[str], List[str]]]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def definition(schema):
+        # type: (BasicSchema) -> str
+        """
+        The JSON definition of a schema, as stored in MProv_Schema.value
+        """
+        return json.dumps({'name': schema.name, 'fields': list(schema.fields),
+                           'types': [str(t) for t in schema.types]})
+
+    def schema_id(self, schema):
+        # type: (BasicSchema) -> str
+        """
+        The ID of a schema, recomputed if fields have been added
+        """
+        cached = self._ids.get(schema)
+        if cached is None or cached[0] != len(schema.fields):
+            definition = self.definition(schema)
+            digest = hashlib.blake2b(definition.encode('utf-8'), digest_size=10, person=b'mprov-schema')
+            cached = (len(schema.fields), 's.' + digest.hexdigest())
+            self._ids[schema] = cached
+            with self._lock:
+                self._definitions[cached[1]] = (list(schema.fields), [str(t) for t in schema.types])
+        return cached[1]
+
+    def register(self, graph_conn, graph, schema):
+        # type: (Any, str, BasicSchema) -> str
+        """
+        Record a schema in MProv_Schema for a graph, in a transaction of its
+        own, unless it is known to be there already
+        :param graph_conn: Database connection, outside of a transaction
+        :return: The schema ID
+        """
+        sid = self.schema_id(schema)
+        if (graph, sid) not in self._registered:
+            with graph_conn as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("INSERT INTO MProv_Schema(_key,_resource,name,value) VALUES (%s,%s,%s,%s) "
+                                   "ON CONFLICT DO NOTHING", (sid, graph, schema.name, self.definition(schema)))
+            with self._lock:
+                self._registered.add((graph, sid))
+        return sid
+
+    def decode(self, graph_conn, graph, sid, values):
+        # type: (Any, str, str, List[Any]) -> Dict[str, Any]
+        """
+        The fields of a tuple stored as a schema ID and positional values,
+        looking the schema up in MProv_Schema if it is not cached
+        :param graph_conn: Database connection, outside of a transaction
+        """
+        definition = self._definitions.get(sid)
+        if definition is None:
+            with graph_conn as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT value FROM MProv_Schema WHERE _resource = %s AND _key = %s",
+                                   (graph, sid))
+                    row = cursor.fetchone()
+            if row is None:
+                raise RuntimeError('Unknown schema ' + sid)
+            stored = json.loads(row[0])
+            definition = (stored['fields'], stored['types'])
+            with self._lock:
+                self._definitions[sid] = definition
+
+        fields, types = definition
+        ret = {}
+        for field, declared, value in zip(fields, types, values):
+            decoder = _DECODERS.get(declared.lower())
+            if decoder is not None and type(value) is decoder[0]:
+                try:
+                    value = decoder[1](value)
+                except ValueError:
+                    # Not of the declared type when written, so kept as it was
+                    pass
+            ret[field] = value
+        return ret
@@ -0,0 +1,243 @@
+"""
+ Copyright 2021 Trustees of the University of Pennsylvania
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import datetime
+import json
+import sqlite3
+
+from pennprov.connection.backend import StorageBackend
+from pennprov.connection.batch import WriteBatch
+
+TABLES = """
+         CREATE TABLE IF NOT EXISTS MProv_Node(_key TEXT NOT NULL,
+                                               _resource TEXT NOT NULL,
+                                               label TEXT,
+                                               PRIMARY KEY(_resource, _key)) WITHOUT ROWID;
+         CREATE TABLE IF NOT EXISTS MProv_NodeProp(_key TEXT NOT NULL,
+                                                   _resource TEXT NOT NULL,
+                                                   label TEXT NOT NULL,
+                                                   code TEXT,
+                                                   "index" INTEGER,
+                                                   value TEXT,
+                                                   ivalue INTEGER,
+                                                   lvalue INTEGER,
+                                                   dvalue REAL,
+                                                   fvalue REAL,
+                                                   tvalue TEXT,
+                                                   tsvalue TEXT,
+                                                   jvalue TEXT,
+                                                   PRIMARY KEY(_resource, _key, label),
+                                                   FOREIGN KEY(_resource, _key) REFERENCES MProv_Node
+                                                     ON DELETE CASCADE) WITHOUT ROWID;
+         CREATE TABLE IF NOT EXISTS MProv_Edge(_resource TEXT NOT NULL,
+                                               _from TEXT NOT NULL,
+                                               _to TEXT NOT NULL,
+                                               label TEXT NOT NULL,
+                                               PRIMARY KEY(_resource, _from, label, _to),
+                                               FOREIGN KEY(_resource, _from) REFERENCES MProv_Node
+                                                 ON DELETE CASCADE,
+                                               FOREIGN KEY(_resource, _to) REFERENCES MProv_Node
+                                                 ON DELETE CASCADE) WITHOUT ROWID;
+         CREATE INDEX IF NOT EXISTS MProv_Edge_To ON MProv_Edge(_resource, _to, label);
+         """
+
+_PROP_COLUMNS = ','.join('"index"' if column == 'index' else column for column in WriteBatch.PROP_COLUMNS)
+
+_INSERTS = ("INSERT OR IGNORE INTO MProv_Node(_key,_resource,label) VALUES (?,?,?)",
+            "INSERT OR IGNORE INTO MProv_NodeProp(" + _PROP_COLUMNS + ") VALUES (" +
+            ','.join('?' * len(WriteBatch.PROP_COLUMNS)) + ")",
+            "INSERT OR IGNORE INTO MProv_Edge(_resource,_from,_to,label) VALUES (?,?,?,?)")
+
+# Positions of the date, timestamp and JSON columns in a property row
+_TVALUE = WriteBatch.PROP_COLUMNS.index('tvalue')
+_TSVALUE = WriteBatch.PROP_COLUMNS.index('tsvalue')
+
+# Most keys looked up per statement
+_MAX_KEYS = 500
+
+
+def _encode_prop(row):
+    # type: (tuple) -> tuple
+    """
+    A property row with its date and timestamp as ISO 8601 text, which
+    sqlite3 has no type for
+    """
+    if row[_TVALUE] is None and row[_TSVALUE] is None:
+        return row
+    row = list(row)
+    for i in (_TVALUE, _TSVALUE):
+        if row[i] is not None:
+            row[i] = row[i].isoformat()
+    return tuple(row)
+
+
+class SqliteBackend(StorageBackend):
+    """
+    A graph store in a single local SQLite file, for edge devices and local
+    pipelines: no server and no network round trip.  The file is in WAL mode,
+    so readers do not block the writer, and commits only wait for the log to
+    reach the OS (synchronous=NORMAL).  Graphs captured locally can be
+    shipped to PostgreSQL in bulk (see MProvConnection.export_graph).
+    """
+    name = 'sqlite'
+
+    def __init__(self, path):
+        # type: (str) -> None
+        """
+        :param path: Database file, created if need be
+        """
+        self.path = path
+        self.graph_conn = self.connect()
+        with self.graph_conn:
+            self.graph_conn.executescript(TABLES)
+
+    def connect(self):
+        """
+        A new connection to the database file, which any one thread may use
+        """
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def reset_graph(self, graph):
+        # type: (str) -> None
+        with self.graph_conn:
+            # Cascades to properties and edges
+            self.graph_conn.execute("DELETE FROM MProv_Node WHERE _resource = ?", (graph,))
+
+    @staticmethod
+    def write_rows(graph_conn, batch):
+        # type: (Any, WriteBatch) -> None
+        """
+        Write a batch in one transaction, nodes first, since the property and
+        edge tables reference them
+        """
+        if len(batch) == 0:
+            return
+        with graph_conn:
+            graph_conn.executemany(_INSERTS[0], batch.nodes)
+            graph_conn.executemany(_INSERTS[1], [_encode_prop(row) for row in batch.props])
+            graph_conn.executemany(_INSERTS[2], batch.edges)
+
+    def write_batch(self, batch):
+        # type: (WriteBatch) -> None
+        self.write_rows(self.graph_conn, batch)
+
+    def open_writer(self):
+        # type: () -> Tuple[Any, Callable[[Any, WriteBatch], None]]
+        return self.connect(), self.write_rows
+
+    def node_props(self, graph, token):
+        # type: (str, str) -> List[tuple]
+        rows = self.graph_conn.execute('SELECT "index",code,value,ivalue,lvalue,fvalue,dvalue,tvalue,tsvalue,'
+                                       'label,jvalue FROM MProv_NodeProp WHERE _resource = ? AND _key = ?',
+                                       (graph, token)).fetchall()
+        return [self._decode_prop(row) for row in rows]
+
+    @staticmethod
+    def _decode_prop(row):
+        # type: (tuple) -> tuple
+        if row[7] is None and row[8] is None and row[10] is None:
+            return row
+        row = list(row)
+        if row[7] is not None:
+            row[7] = datetime.date.fromisoformat(row[7])
+        if row[8] is not None:
+            row[8] = datetime.datetime.fromisoformat(row[8])
+        if row[10] is not None:
+            row[10] = json.loads(row[10])
+        return tuple(row)
+
+    def nodes_props(self, graph, tokens):
+        # type: (str, Sequence[str]) -> Dict[str, List[tuple]]
+        ret = {token: [] for token in tokens}
+        keys = list(ret)
+        # Within SQLite's limit on the number of parameters of a statement
+        for i in range(0, len(keys), _MAX_KEYS):
+            chunk = keys[i:i + _MAX_KEYS]
+            rows = self.graph_conn.execute('SELECT _key,"index",code,value,ivalue,lvalue,fvalue,dvalue,tvalue,'
+                                           'tsvalue,label,jvalue FROM MProv_NodeProp WHERE _resource = ? AND _key IN ('
+                                           + ','.join('?' * len(chunk)) + ')', [graph] + chunk).fetchall()
+            for row in rows:
+                ret[row[0]].append(self._decode_prop(row[1:]))
+        return ret
+
+    def connected(self, graph, token, label=None, reverse=False):
+        # type: (str, str, str, bool) -> List[str]
+        found, given = ('_from', '_to') if reverse else ('_to', '_from')
+        query = "SELECT " + found + " FROM MProv_Edge WHERE _resource = ? AND " + given + " = ?"
+        if label is None:
+            rows = self.graph_conn.execute(query, (graph, token))
+        else:
+            rows = self.graph_conn.execute(query + " AND label = ?", (graph, token, label))
+        return [x[0] for x in rows.fetchall()]
+
+    def find_nodes(self, graph, keys):
+        # type: (str, Sequence[str]) -> List[str]
+        keys = list(keys)
+        ret = []
+        # Within SQLite's limit on the number of parameters of a statement
+        for i in range(0, len(keys), _MAX_KEYS):
+            chunk = keys[i:i + _MAX_KEYS]
+            rows = self.graph_conn.execute("SELECT _key FROM MProv_Node WHERE _resource = ? AND _key IN (" +
+                                           ','.join('?' * len(chunk)) + ")", [graph] + chunk)
+            ret.extend(x[0] for x in rows.fetchall())
+        return ret
+
+    def edges(self, graph, labels, itersize=2000):
+        # type: (str, Sequence[str], int) -> Iterator[Tuple[str, str, str]]
+        labels = list(labels)
+        cursor = self.graph_conn.execute("SELECT _from, _to, label FROM MProv_Edge WHERE _resource = ? AND label IN (" +
+                                         ','.join('?' * len(labels)) + ")", [graph] + labels)
+        while True:
+            rows = cursor.fetchmany(itersize)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
+    def read_batches(self, graph, batch_size=10000):
+        # type: (str, int) -> Iterator[WriteBatch]
+        queries = (("SELECT _key,_resource,label FROM MProv_Node WHERE _resource = ?", 'nodes'),
+                   ("SELECT " + _PROP_COLUMNS + " FROM MProv_NodeProp WHERE _resource = ?", 'props'),
+                   ("SELECT _resource,_from,_to,label FROM MProv_Edge WHERE _resource = ?", 'edges'))
+        for query, kind in queries:
+            cursor = self.graph_conn.execute(query, (graph,))
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                batch = WriteBatch()
+                if kind == 'props':
+                    rows = [self._decode_row(row) for row in rows]
+                setattr(batch, kind, rows)
+                yield batch
+
+    @staticmethod
+    def _decode_row(row):
+        # type: (tuple) -> tuple
+        """
+        A stored property row, with its values restored to the Python types
+        a WriteBatch holds
+        """
+        row = list(row)
+        if row[_TVALUE] is not None:
+            row[_TVALUE] = datetime.date.fromisoformat(row[_TVALUE])
+        if row[_TSVALUE] is not None:
+            row[_TSVALUE] = datetime.datetime.fromisoformat(row[_TSVALUE])
+        return tuple(row)
+
+    def close(self):
+        self.graph_conn.close()
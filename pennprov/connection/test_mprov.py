@@ -1,7 +1,15 @@
 import pytest
 import logging
+import datetime
+import sqlite3
+import time
+import threading
 
 import pennprov.connection.mprov as mprov
+from pennprov.cache.graph import GraphCache
+from pennprov.cache.reachability import ReachabilityIndex
+from pennprov.connection import migrations
+from pennprov.metadata.stream_metadata import BasicSchema
 
 class TestMProv:
     conn = None
@@ -19,5 +27,720 @@ class TestMProv:
         self.conn.store_activity('area_circle', 0, 1, 0)
         self.conn.store_code('import pytest\nimport logging\n')
 
+    def test_buffered(self):
+        conn = mprov.MProvConnection(buffered=True, buffer_size=10000, flush_interval=3600)
+        conn.create_or_reuse_graph()
 
+        token = conn.store_stream_tuple('buffered_stream', 1, {'start': 1, 'end': 2})
+        conn.store_annotation('buffered_stream', 1, 'ann1', 'value')
+        assert len(conn._buffer) > 0
 
+        conn.flush()
+        assert len(conn._buffer) == 0
+        assert conn.get_annotations(token) == [[{'ann1': 'value'}]]
+
+    def test_bulk_tuples(self):
+        conn = mprov.MProvConnection()
+        conn.create_or_reuse_graph()
+
+        tuples = [(i, {'name': 'tuple\t%d\n' % i}) for i in range(2, 102)]
+        tokens = conn.store_stream_tuples('bulk_stream', tuples, batch_size=30)
+        assert len(tokens) == 100
+        assert tokens[0] == conn.get_token_qname(conn.get_entity_id('bulk_stream', 1))
+        assert conn.get_node(tokens[4])[0]['name'] == 'tuple\t6\n'
+
+    def test_asynchronous(self):
+        conn = mprov.MProvConnection(asynchronous=True, queue_size=10)
+        conn.create_or_reuse_graph()
+
+        tokens = [conn.store_stream_tuple('async_stream', i, {'name': 'tuple %d' % i}) for i in range(2, 52)]
+        window = conn.store_window_and_inputs('async_window', 2,
+                                              [conn.get_entity_id('async_stream', i - 1) for i in range(2, 52)])
+
+        conn.flush()
+        assert conn.get_writer_stats()['queued'] == 0
+        assert len(conn.get_child_entities(window)) == 50
+        assert conn.get_node(tokens[0])[0]['name'] == 'tuple 2'
+        conn.close()
+
+    def test_dropped_batches_are_rewritten(self):
+        conn = mprov.MProvConnection(asynchronous=True, queue_size=1, queue_policy=mprov.BackgroundWriter.DROP,
+                                     dedupe_size=1000)
+        conn.set_graph('dropped-graph')
+        conn.create_or_reset_graph()
+
+        # Hold the writer in its first transaction, so the queue fills up
+        writing, release = threading.Event(), threading.Event()
+        write = conn._writer.write
+
+        def held_write(graph_conn, batch):
+            writing.set()
+            release.wait()
+            write(graph_conn, batch)
+        conn._writer.write = held_write
+        conn.store_stream_tuple('held', 2, {'name': 'held'})
+        writing.wait()
+        conn.store_stream_tuple('held', 3, {'name': 'queued'})
+        dropped = conn.store_stream_tuple('dropped', 2, {'name': 'dropped'})
+        release.set()
+        conn.flush()
+        assert conn.get_writer_stats()['dropped'] == 1
+        assert conn.get_node(dropped) == [{}]
+
+        # Not remembered as written, so storing it again writes the node
+        assert conn.store_stream_tuple('dropped', 2, {'name': 'dropped'}) == dropped
+        conn.flush()
+        assert conn.get_node(dropped)[0]['name'] == 'dropped'
+        conn.create_or_reset_graph()
+        conn.close()
+
+    def test_dedupe(self):
+        assert mprov.MProvConnection().get_dedupe_stats() == {}
+        conn = mprov.MProvConnection(dedupe_size=1000)
+        conn.create_or_reuse_graph()
+
+        collection = conn.create_collection('dedupe_stream')
+        token = conn.store_stream_tuple('dedupe_stream', 2, {'name': 'first'})
+        conn.add_to_collection(token, collection)
+        conn.add_to_collection(token, collection)
+        conn.store_code('def f(x):\n    return x\n')
+        conn.store_code('def f(x):\n    return x\n')
+
+        stats = conn.get_dedupe_stats()
+        assert stats['hits'] == 2
+        assert conn.get_child_entities(collection) == [token]
+
+    def test_code_ids(self):
+        conn = mprov.MProvConnection()
+        conn.create_or_reuse_graph()
+
+        code = 'def g(x):\n    return x + 1\n'
+        token = conn.store_code(code)
+        assert token == mprov.MProvConnection.get_code_id(code)
+        assert conn.find_code(code) == token
+
+        # Code stored under the original PBKDF2 IDs can still be found
+        legacy_code = 'def h(x):\n    return x - 1\n'
+        conn.code_id_version = 1
+        legacy_token = conn.store_code(legacy_code)
+        conn.code_id_version = 2
+        assert legacy_token == mprov.MProvConnection.get_code_id(legacy_code, 1)
+        assert conn.find_code(legacy_code) == legacy_token
+        assert conn.find_code('not stored') is None
+
+    def test_migrate_activity_keys(self):
+        conn = mprov.MProvConnection()
+        conn.create_or_reuse_graph()
+
+        # Write activities with the original PBKDF2 IDs
+        mprov.MProvConnection.token_generator = mprov.Pbkdf2TokenGenerator()
+        try:
+            output = conn.store_stream_tuple('migrate_stream', 2, {'name': 'output'})
+            unlocated = conn.store_activity('migrate_op', None, None)
+            located = conn.store_activity('migrate_op', None, None, 'w2')
+            conn.store_generated_by(output, located)
+            # At a stream index, as store_stream_tuple callers pass them
+            indexed = conn.store_activity('migrate_op', None, None, 3)
+        finally:
+            mprov.MProvConnection.token_generator = mprov.Blake2bTokenGenerator()
+        assert mprov.Pbkdf2TokenGenerator().activity_id('migrate_op', 3) == \
+            mprov.Pbkdf2TokenGenerator().activity_id('migrate_op', '3')
+
+        key_map = conn.migrate_activity_keys([('migrate_op', 'w2'), ('migrate_op', 3)])
+        assert key_map[unlocated] == conn.get_activity_id('migrate_op', None)
+        assert key_map[located] == conn.get_activity_id('migrate_op', 'w2')
+        assert key_map[indexed] == conn.get_activity_id('migrate_op', 3)
+        assert conn.get_node(key_map[indexed])[0][0] == 'migrate_op'
+        assert conn.get_creating_activities(output) == [key_map[located]]
+        assert conn.get_node(key_map[located])[0][0] == 'migrate_op'
+
+    def test_derivation_subgraph(self):
+        conn = mprov.MProvConnection()
+        conn.create_or_reuse_graph()
+
+        inputs = [conn.store_stream_tuple('subgraph_in', i, {'name': 'in %d' % i}) for i in (2, 3)]
+        result = conn.store_windowed_result('subgraph_out', 2, {'name': 'out'},
+                                            [conn.get_entity_id('subgraph_in', i) for i in (1, 2)],
+                                            'subgraph_op', None, None)
+        window = conn.get_source_entities(result)
+        assert len(window) == 1
+        assert sorted(conn.get_child_entities(window[0])) == sorted(inputs)
+        activity = conn.get_creating_activities(result)
+        assert conn.get_activity_inputs(activity[0]) == window
+
+        derived = conn.store_derived_result('subgraph_map', 2, {'name': 'mapped'}, result, 'map_op', None, None)
+        assert conn.get_source_entities(derived) == [result]
+        assert conn.get_activity_inputs(conn.get_creating_activities(derived)[0]) == [result]
+
+    def test_prepared_statements(self):
+        for prepare in (True, False):
+            conn = mprov.MProvConnection(prepare_statements=prepare)
+            conn.create_or_reuse_graph()
+
+            collection = conn.create_collection('prepared_stream')
+            token = conn.store_stream_tuple('prepared_stream', 2, {'name': 'first'})
+            conn.add_to_collection(token, collection)
+            assert conn.get_child_entities(collection) == [token]
+            assert conn.get_parent_entities(token) == [collection]
+            assert conn.get_node(token)[0]['name'] == 'first'
+
+            stats = conn.get_statement_stats()
+            assert stats['mprov_write_batch']['calls'] >= 2
+            assert stats['mprov_connected_from_label']['calls'] == 1
+            assert stats['mprov_nodes_props']['mean'] > 0
+
+    def test_typed_tuples(self):
+        conn = mprov.MProvConnection()
+        conn.set_graph('typed-graph')
+        conn.create_or_reset_graph()
+
+        schema = BasicSchema('Sensor', {'id': 'int', 'reading': 'float', 'at': 'timestamp', 'unit': 'str'})
+        at = datetime.datetime(2021, 3, 1, 12, 30)
+        token = conn.store_stream_tuple('typed_stream', 2, schema.create_tuple([7, 1.5, at, 'mV']))
+        assert conn.get_node(token) == [{'id': 7, 'reading': 1.5, 'at': at, 'unit': 'mV'}]
+
+        token = conn.store_stream_tuple('typed_stream', 3, {'id': 8, 'reading': 2.5, 'at': at, 'unit': None})
+        node = conn.get_node(token)[0]
+        assert (node['id'], node['reading'], node['at'], node['unit']) == (8, 2.5, at, None)
+
+        # Booleans are stored as integers, whether declared or not
+        schema = BasicSchema('Flag', {'id': 'int', 'valid': 'int'})
+        declared = conn.store_stream_tuple('typed_stream', 4, schema.create_tuple([9, True]))
+        assert conn.get_node(declared) == [{'id': 9, 'valid': 1}]
+        token = conn.store_stream_tuple('typed_stream', 5, {'id': 10, 'valid': False})
+        assert conn.get_node(token)[0]['valid'] == 0
+        with conn.graph_conn.cursor() as cursor:
+            cursor.execute("SELECT code, ivalue, value FROM " + conn.layout.PROPS_TABLE +
+                           " WHERE label = 'valid' AND _key IN (%s, %s)", (declared, token))
+            assert sorted(cursor.fetchall()) == [('I', 0, None), ('I', 1, None)]
+        conn.graph_conn.rollback()
+
+    def test_jsonb_tuples(self):
+        schema = BasicSchema('Sensor', {'id': 'int', 'reading': 'float', 'unit': 'str'})
+        for layout in ('table', 'node_ids', 'time'):
+            conn = mprov.MProvConnection(layout=layout, tuple_storage='jsonb')
+            conn.set_graph('jsonb-graph')
+            conn.create_or_reset_graph()
+
+            token = conn.store_stream_tuple('json_stream', 2, schema.create_tuple([7, 1.5, 'mV']))
+            assert conn.get_node(token) == [{'id': 7, 'reading': 1.5, 'unit': 'mV'}]
+            tokens = conn.store_stream_tuples('json_stream', [(i, {'id': i, 'unit': 'mV'}) for i in (3, 4)])
+            assert conn.get_node(tokens[1])[0]['id'] == 4
+
+            # One row per tuple, which a connection storing properties reads too
+            with conn.graph_conn.cursor() as cursor:
+                cursor.execute('SELECT count(*) FROM ' + conn.layout.PROPS_TABLE + " WHERE code = 'J'")
+                assert cursor.fetchone()[0] == 3
+            conn.graph_conn.rollback()
+            reader = mprov.MProvConnection(layout=layout)
+            reader.set_graph('jsonb-graph')
+            assert reader.get_node(token) == conn.get_node(token)
+
+            assert conn.create_tuple_index() == conn.create_tuple_index()
+            assert conn.create_tuple_index('id').startswith(conn.layout.PROPS_TABLE.lower())
+            conn.close()
+            reader.close()
+
+        with pytest.raises(ValueError):
+            mprov.MProvConnection(tuple_storage='columns')
+
+    def test_schema_tuples(self):
+        conn = mprov.MProvConnection(tuple_storage='schema')
+        conn.set_graph('schema-graph')
+        conn.create_or_reset_graph()
+
+        schema = BasicSchema('Sensor', {'id': 'int', 'reading': 'float', 'at': 'timestamp', 'unit': 'str'})
+        at = datetime.datetime(2021, 3, 1, 12, 30)
+        token = conn.store_stream_tuple('schema_stream', 2, schema.create_tuple([7, 2, at, 'mV']))
+        tokens = conn.store_stream_tuples('schema_stream', [(i, schema.create_tuple([i, 0.5, at, 'mV']))
+                                                            for i in (3, 4)])
+        assert conn.get_node(token) == [{'id': 7, 'reading': 2.0, 'at': at, 'unit': 'mV'}]
+
+        # A new version of the schema gets an ID of its own
+        schema.add_field('status', 'str')
+        later = conn.store_stream_tuple('schema_stream', 5, schema.create_tuple([5, 0.5, at, 'mV', 'ok']))
+        with conn.graph_conn.cursor() as cursor:
+            cursor.execute("SELECT name FROM MProv_Schema WHERE _resource = 'schema-graph'")
+            assert [row[0] for row in cursor.fetchall()] == ['Sensor', 'Sensor']
+        conn.graph_conn.rollback()
+
+        # Another process looks schemas up by their ID
+        reader = mprov.MProvConnection()
+        reader.set_graph('schema-graph')
+        assert reader.get_node(tokens[1]) == [{'id': 4, 'reading': 0.5, 'at': at, 'unit': 'mV'}]
+        assert reader.get_node(later)[0]['status'] == 'ok'
+
+        # Tuples without a schema are stored as properties
+        token = conn.store_stream_tuple('schema_stream', 6, {'id': 6})
+        assert conn.get_node(token)[0]['id'] == 6
+        conn.close()
+        reader.close()
+
+    def test_staged_ingest(self):
+        for layout in ('table', 'node_ids'):
+            conn = mprov.MProvConnection(layout=layout, staged=True, merge_interval=0)
+            conn.set_graph('staged-graph')
+            conn.create_or_reset_graph()
+
+            inputs = [conn.store_stream_tuple('staged_in', i, {'name': 'in %d' % i}) for i in (2, 3)]
+            stats = conn.get_staging_stats()
+            assert stats['staged'] > 0 and stats['pending'] >= stats['staged'] - stats['merged']
+            assert stats['lag'] >= 0
+
+            # Queries merge first
+            result = conn.store_windowed_result('staged_out', 2, {'name': 'out'},
+                                                [conn.get_entity_id('staged_in', i) for i in (1, 2)],
+                                                'staged_op', None, None)
+            window = conn.get_source_entities(result)
+            assert sorted(conn.get_child_entities(window[0])) == sorted(inputs)
+            stats = conn.get_staging_stats()
+            assert stats['pending'] == 0 and stats['merged'] >= stats['staged']
+
+            # An edge to a missing node is set aside, and later rows still merge
+            missing = conn.get_token_qname(conn.get_entity_id('staged_in', 100))
+            conn.store_derived_from(result, missing)
+            later = conn.store_stream_tuple('staged_in', 5, {'name': 'in 5'})
+            conn.store_derived_from(later, inputs[0])
+            assert conn.get_source_entities(later) == [inputs[0]]
+            assert conn.get_node(later)[0]['name'] == 'in 5'
+            stats = conn.get_staging_stats()
+            assert stats['pending'] == 0 and stats['rejected'] == 1 and stats['rejected_rows'] >= 1
+            conn.flush()
+            conn.close()
+
+        # Merged on a timer, here by an asynchronous writer's batches
+        conn = mprov.MProvConnection(staged=True, merge_interval=0.05, asynchronous=True)
+        conn.set_graph('staged-graph')
+        token = conn.store_stream_tuple('staged_in', 4, {'name': 'in 4'})
+        conn._writer.flush()
+        for i in range(100):
+            if conn._ingest.merged > 0:
+                break
+            time.sleep(0.05)
+        assert conn._ingest.merges > 0
+        assert conn.get_node(token)[0]['name'] == 'in 4'
+        conn.close()
+
+    def test_migrations(self):
+        conn = mprov.MProvConnection()
+        assert conn.schema_version == migrations.LATEST_VERSION
+
+        with conn.graph_conn.cursor() as cursor:
+            cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'mprov_edge'")
+            indexes = [row[0] for row in cursor.fetchall()]
+        conn.graph_conn.rollback()
+        assert 'mprov_edge_to' in indexes
+
+        # Applied migrations are not run again
+        applied = [(version, description, ['SELECT missing FROM nowhere'])
+                   for version, description, statements in migrations.MIGRATIONS]
+        assert migrations.upgrade(conn.graph_conn, applied) == migrations.LATEST_VERSION
+
+        # The write functions installed are the ones the latest migrations create
+        for name, function in (('mprov_writebatch', migrations.WRITE_BATCH_V7),
+                               ('mprov_writebatchkeys', migrations.WRITE_BATCH_KEYS_V7),
+                               ('mprov_writebatchtimed', migrations.WRITE_BATCH_TIMED_V7)):
+            created = [statement for _, _, statements in migrations.MIGRATIONS for statement in statements
+                       if 'create or replace function ' + name + '(' in statement.lower()]
+            assert created[-1] == function
+            with conn.graph_conn.cursor() as cursor:
+                cursor.execute("SELECT prosrc FROM pg_proc WHERE proname = %s", (name,))
+                assert [row[0] for row in cursor.fetchall()] == [function.split('$$')[1]]
+            conn.graph_conn.rollback()
+
+    def test_node_id_layout(self):
+        conn = mprov.MProvConnection(layout='node_ids')
+        conn.create_or_reset_graph()
+
+        inputs = conn.store_stream_tuples('key_in', [(i, {'name': 'in %d' % i}) for i in (2, 3)])
+        result = conn.store_windowed_result('key_out', 2, {'name': 'out'},
+                                            [conn.get_entity_id('key_in', i) for i in (1, 2)],
+                                            'key_op', None, None)
+        window = conn.get_source_entities(result)
+        assert sorted(conn.get_child_entities(window[0])) == sorted(inputs)
+        assert conn.get_parent_entities(inputs[0]) == window
+        assert conn.get_node(result)[0]['name'] == 'out'
+        # Labels are interned once, and their codes cached
+        assert 'name' in conn.layout.labels.encode(conn.graph_conn, [])
+
+        code = conn.store_code('def key_op(): pass')
+        assert conn.find_code('def key_op(): pass') == code
+
+        mprov.MProvConnection.token_generator = mprov.Pbkdf2TokenGenerator()
+        try:
+            located = conn.store_activity('key_op', None, None, 'w2')
+            conn.store_generated_by(result, located)
+        finally:
+            mprov.MProvConnection.token_generator = mprov.Blake2bTokenGenerator()
+        key_map = conn.migrate_activity_keys([('key_op', 'w2')])
+        assert key_map[located] in conn.get_creating_activities(result)
+        assert located not in conn.get_creating_activities(result)
+
+    def test_graph_partitions(self):
+        conn = mprov.MProvConnection()
+        conn.set_graph('partitioned-graph')
+        conn.create_or_reset_graph()
+
+        token = conn.store_stream_tuple('partitioned_stream', 2, {'name': 'first'})
+        partition = conn.layout.partition_name('MProv_Node', 'partitioned-graph')
+        with conn.graph_conn.cursor() as cursor:
+            cursor.execute('SELECT count(*) FROM "' + partition + '" WHERE _key = %s', (token,))
+            assert cursor.fetchone()[0] == 1
+            cursor.execute("EXPLAIN SELECT * FROM MProv_Node WHERE _resource = 'partitioned-graph'")
+            plan = ' '.join(row[0] for row in cursor.fetchall())
+        conn.graph_conn.rollback()
+        assert partition in plan and 'mprov_node_default' not in plan
+
+        # Resetting removes nodes and properties, not just edges
+        conn.create_or_reset_graph()
+        assert conn.get_node(token) == [{}]
+        conn.close()
+        assert conn.graph_conn.closed
+
+        # The configured graph has its partitions as soon as a connection is made
+        conn = mprov.MProvConnection()
+        partition = conn.layout.partition_name('MProv_Edge', conn.get_graph())
+        with conn.graph_conn.cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s)", ('"' + partition + '"',))
+            assert cursor.fetchone()[0] is not None
+        conn.graph_conn.rollback()
+        conn.close()
+
+    def test_time_layout(self):
+        conn = mprov.MProvConnection(layout='time')
+        conn.set_graph('time-graph')
+        conn.create_or_reset_graph()
+
+        inputs = [conn.store_stream_tuple('timed_in', i, {'name': 'in %d' % i}) for i in (2, 3)]
+        result = conn.store_windowed_result('timed_out', 2, {'name': 'out'},
+                                            [conn.get_entity_id('timed_in', i) for i in (1, 2)],
+                                            'timed_op', None, None)
+        window = conn.get_source_entities(result)
+        assert sorted(conn.get_child_entities(window[0])) == sorted(inputs)
+        assert conn.get_node(inputs[0])[0]['name'] == 'in 2'
+
+        # Nodes are written again on a new day, and still read as one node
+        conn._epoch = None
+        conn.store_stream_tuple('timed_in', 2, {'name': 'in 2'})
+        assert len(conn.get_node(inputs[0])) == 1
+        assert conn.get_parent_entities(inputs[0]) == window
+
+        # Days outside the retention period are dropped, today's are kept
+        past = datetime.date.today() - datetime.timedelta(days=30)
+        conn.layout.create_partitions(conn.graph_conn, past)
+        dropped = conn.expire_partitions(7)
+        assert conn.layout.day_partition_name('MProv_TimeNode', past) in dropped
+        assert conn.get_node(inputs[0])[0]['name'] == 'in 2'
+        with pytest.raises(ValueError):
+            mprov.MProvConnection(retention_days=7)
+
+        # Days are the server's, wherever the client is: at least one of these
+        # time zones is on a different date from the client's
+        for index, zone in enumerate(('Etc/GMT-14', 'Etc/GMT+12')):
+            with conn.graph_conn as graph_conn:
+                with graph_conn.cursor() as cursor:
+                    cursor.execute("SET TimeZone = %s", (zone,))
+            conn.layout.create_partitions(conn.graph_conn)
+            with conn.graph_conn as graph_conn:
+                with graph_conn.cursor() as cursor:
+                    cursor.execute("SELECT CURRENT_DATE")
+                    assert conn.layout.write_epoch() == cursor.fetchone()[0]
+            token = conn.store_stream_tuple('zoned_in', index, {'name': zone})
+            assert conn.get_node(token)[0]['name'] == zone
+        conn.graph_conn.reset()
+        conn.close()
+
+    def test_sqlite_backend(self, tmp_path):
+        path = str(tmp_path / 'mprov.db')
+        conn = mprov.MProvConnection(backend='sqlite', path=path)
+        conn.set_graph('sqlite-graph')
+        conn.create_or_reset_graph()
+
+        inputs = [conn.store_stream_tuple('local_in', i, {'name': 'in %d' % i,
+                                                          'seen': datetime.datetime(2021, 1, i, 12)})
+                  for i in (2, 3)]
+        result = conn.store_windowed_result('local_out', 2, {'name': 'out'},
+                                            [conn.get_entity_id('local_in', i) for i in (1, 2)],
+                                            'local_op', None, None)
+        window = conn.get_source_entities(result)
+        assert sorted(conn.get_child_entities(window[0])) == sorted(inputs)
+        assert conn.get_node(inputs[0])[0]['seen'] == datetime.datetime(2021, 1, 2, 12)
+        conn.store_code('def g(x):\n    return x\n')
+        assert conn.find_code('def g(x):\n    return x\n') is not None
+        # More keys than a statement can have parameters on older SQLite builds
+        if hasattr(conn.graph_conn, 'setlimit'):
+            conn.graph_conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+        keys = ['missing %d' % i for i in range(2000)] + inputs
+        assert sorted(conn.backend.find_nodes('sqlite-graph', keys)) == sorted(inputs)
+
+        # The background writer has a connection of its own to the same file
+        writer = mprov.MProvConnection(backend='sqlite', path=path, asynchronous=True)
+        writer.set_graph('sqlite-graph')
+        token = writer.store_stream_tuple('local_in', 4, {'name': 'in 4'})
+        writer.close()
+        assert conn.get_node(token)[0]['name'] == 'in 4'
+
+        # A graph captured locally can be shipped to PostgreSQL
+        target = mprov.MProvConnection()
+        target.set_graph('sqlite-graph')
+        target.create_or_reset_graph()
+        assert conn.export_graph(target) > 0
+        assert sorted(target.get_child_entities(window[0])) == sorted(inputs)
+        assert target.get_node(inputs[0])[0]['seen'] == datetime.datetime(2021, 1, 2, 12)
+        target.create_or_reset_graph()
+        target.close()
+
+        conn.create_or_reset_graph()
+        assert conn.get_child_entities(window[0]) == []
+        with pytest.raises(ValueError):
+            mprov.MProvConnection(backend='sqlite', path=path, staged=True)
+        conn.close()
+
+    def test_memory_backend(self, tmp_path):
+        conn = mprov.MProvConnection(backend='memory')
+        conn.create_or_reset_graph()
+
+        inputs = [conn.store_stream_tuple('mem_in', i, {'name': 'in %d' % i}) for i in (2, 3)]
+        result = conn.store_windowed_result('mem_out', 2, {'name': 'out'},
+                                            [conn.get_entity_id('mem_in', i) for i in (1, 2)],
+                                            'mem_op', None, None)
+        window = conn.get_source_entities(result)
+        assert sorted(conn.get_child_entities(window[0])) == sorted(inputs)
+        assert conn.get_parent_entities(inputs[0]) == window
+        assert conn.get_node(result)[0]['name'] == 'out'
+        ann = conn.store_annotation('mem_in', 2, 'quality', 0.5)
+        assert conn.get_annotations(inputs[0]) == [[{'quality': 0.5}]]
+        assert conn.get_node(ann)[0]['quality'] == 0.5
+
+        # Snapshots load back into a new store
+        path = str(tmp_path / 'mprov.snapshot')
+        conn.save_snapshot(path)
+        loaded = mprov.MProvConnection(backend='memory', path=path)
+        assert sorted(loaded.get_child_entities(window[0])) == sorted(inputs)
+        assert loaded.get_node(inputs[1])[0]['name'] == 'in 3'
+
+        # And are saved on close
+        token = loaded.store_stream_tuple('mem_in', 4, {'name': 'in 4'})
+        loaded.close()
+        assert mprov.MProvConnection(backend='memory', path=path).get_node(token)[0]['name'] == 'in 4'
+
+        writer = mprov.MProvConnection(backend='memory', asynchronous=True, tuple_storage='jsonb')
+        token = writer.store_stream_tuple('mem_in', 2, {'name': 'in 2'})
+        writer.flush()
+        assert writer.get_node(token)[0]['name'] == 'in 2'
+        writer.close()
+
+        conn.create_or_reset_graph()
+        assert conn.get_child_entities(window[0]) == []
+        with pytest.raises(ValueError):
+            mprov.MProvConnection().save_snapshot(path)
+
+    @pytest.mark.parametrize('options', [{}, {'layout': 'node_ids'}, {'layout': 'time'}, {'backend': 'memory'}])
+    def test_lineage(self, options):
+        conn = mprov.MProvConnection(**options)
+        conn.set_graph('lineage-graph')
+        conn.create_or_reset_graph()
+
+        inputs = [conn.store_stream_tuple('raw', i, {'name': 'raw %d' % i}) for i in (2, 3)]
+        first = conn.store_windowed_result('cleaned', 2, {'name': 'cleaned'},
+                                           [conn.get_entity_id('raw', i) for i in (1, 2)], 'clean', None, None)
+        second = conn.store_derived_result('scored', 2, {'name': 'scored'},
+                                           first, 'score', None, None)
+
+        lineage = conn.get_lineage(second)
+        nodes = dict(lineage['nodes'])
+        assert nodes[first] == 1
+        assert all(nodes[token] == 3 for token in inputs)
+        window = conn.get_source_entities(first)[0]
+        assert (window, inputs[0], 'hadMember') in lineage['edges']
+        assert len(set(lineage['edges'])) == len(lineage['edges'])
+
+        assert [token for token, _ in conn.get_lineage(second, max_depth=1)['nodes']] == \
+            sorted(conn.get_source_entities(second) + conn.get_creating_activities(second))
+        assert len(conn.get_lineage(second, limit=3)['edges']) == 3
+        assert second in dict(conn.get_lineage(inputs[0], direction='down')['nodes'])
+        assert conn.get_lineage(inputs[0], labels=['wasDerivedFrom']) == {'nodes': [], 'edges': []}
+
+        # Cycles are followed once
+        conn.store_derived_from(inputs[0], second)
+        lineage = conn.get_lineage(second)
+        assert (inputs[0], second, 'wasDerivedFrom') in lineage['edges']
+        assert len(set(lineage['edges'])) == len(lineage['edges'])
+        with pytest.raises(ValueError):
+            conn.get_lineage(second, direction='sideways')
+        conn.create_or_reset_graph()
+        conn.close()
+
+    @pytest.mark.parametrize('options', [{}, {'layout': 'node_ids'}, {'layout': 'time'}, {'backend': 'memory'},
+                                         {'backend': 'sqlite'}])
+    def test_lineage_depth(self, options, tmp_path):
+        if options.get('backend') == 'sqlite':
+            options = dict(options, path=str(tmp_path / 'lineage.db'))
+        conn = mprov.MProvConnection(**options)
+        conn.set_graph('lineage-depth-graph')
+        conn.create_or_reset_graph()
+
+        source = conn.store_stream_tuple('depth_in', 2, {'name': 'in'})
+        result = conn.store_derived_result('depth_out', 2, {'name': 'out'}, source, 'depth_op', None, None)
+        # Every backend follows at least one edge, and refuses to follow none
+        for max_depth in (0, -1):
+            with pytest.raises(ValueError):
+                conn.get_lineage(result, max_depth=max_depth)
+        nearest = conn.get_lineage(result, max_depth=1)
+        assert all(depth == 1 for _, depth in nearest['nodes']) and source in dict(nearest['nodes'])
+        conn.create_or_reset_graph()
+        conn.close()
+
+    @pytest.mark.parametrize('options', [{}, {'layout': 'node_ids'}, {'layout': 'time'}, {'backend': 'memory'}])
+    def test_get_nodes(self, options):
+        conn = mprov.MProvConnection(**options)
+        conn.set_graph('nodes-graph')
+        conn.create_or_reset_graph()
+
+        tokens = [conn.store_stream_tuple('many', i, {'name': 'tuple %d' % i, 'value': i}) for i in range(2, 12)]
+        missing = conn.get_token_qname(conn.get_entity_id('many', 100))
+        nodes = conn.get_nodes(tokens + [missing])
+        assert list(nodes) == tokens + [missing]
+        assert nodes[tokens[3]] == conn.get_node(tokens[3])[0]
+        assert nodes[tokens[3]]['value'] == 5
+        assert nodes[missing] == {}
+        assert conn.get_nodes([]) == {}
+        conn.create_or_reset_graph()
+        conn.close()
+
+    @pytest.mark.parametrize('options', [{}, {'layout': 'node_ids'}, {'layout': 'time'}, {'backend': 'memory'}])
+    def test_annotations_and_producers(self, options):
+        conn = mprov.MProvConnection(**options)
+        conn.set_graph('producers-graph')
+        conn.create_or_reset_graph()
+
+        token = conn.store_stream_tuple('annotated', 2, {'name': 'first'})
+        conn.store_annotations(token, {'unit': 'mV', 'gain': 2})
+        assert sorted(conn.get_annotations(token), key=str) == sorted([[{'unit': 'mV'}], [{'gain': 2}]], key=str)
+        assert conn.get_annotations(conn.get_token_qname(conn.get_entity_id('annotated', 100))) == []
+
+        code = 'def produce(x):\n    return x\n'
+        stream = conn.create_collection('produced')
+        for location in (1, 2):
+            conn.store_generated_by(stream, conn.store_activity(conn.store_code(code), None, None, location))
+        assert conn.get_stream_producers('produced') == [conn._get_qname(code)]
+        assert conn.get_stream_producers('annotated') == []
+        conn.create_or_reset_graph()
+        conn.close()
+
+    @pytest.mark.parametrize('options', [{}, {'backend': 'memory'}])
+    def test_graph_cache(self, options):
+        conn = mprov.MProvConnection(cache=GraphCache(maxsize=4), **options)
+        conn.set_graph('cache-graph')
+        conn.create_or_reset_graph()
+
+        collection = conn.create_collection('cached_stream')
+        first = conn.store_stream_tuple('cached_stream', 2, {'name': 'first'})
+        conn.add_to_collection(first, collection)
+        assert conn.get_node(first)[0]['name'] == 'first'
+        conn.get_node(first)[0]['name'] = 'changed'
+        assert conn.get_node(first)[0]['name'] == 'first'
+        assert conn.get_child_entities(collection) == [first]
+        assert conn.get_child_entities(collection) == [first]
+        assert conn.get_cache_stats()['hits'] == 3
+
+        # Local writes invalidate the entries they make stale
+        second = conn.store_stream_tuple('cached_stream', 3, {'name': 'second'})
+        conn.add_to_collection(second, collection)
+        assert sorted(conn.get_child_entities(collection)) == sorted([first, second])
+        assert conn.get_parent_entities(second) == [collection]
+        assert conn.get_cache_stats()['invalidations'] >= 1
+
+        for token in (first, second):
+            conn.get_source_entities(token)
+            conn.get_derived_entities(token)
+        stats = conn.get_cache_stats()
+        assert stats['evictions'] > 0 and stats['size'] == 4
+        conn.create_or_reset_graph()
+        assert conn.get_cache_stats()['size'] == 0
+        conn.close()
+
+        now = [0.0]
+        cache = GraphCache(ttl=10, timer=lambda: now[0])
+        cache.put(GraphCache.node_key('g', 'n'), {'name': 'n'})
+        assert cache.get(GraphCache.node_key('g', 'n')) == {'name': 'n'}
+        now[0] = 11.0
+        assert cache.get(GraphCache.node_key('g', 'n')) is None
+        cache.put(GraphCache.node_key('g', 'm'), {})
+        assert cache.get_stats()['expirations'] == 1
+
+    @pytest.mark.parametrize('options', [{}, {'layout': 'node_ids'}, {'layout': 'time'}, {'backend': 'memory'}])
+    def test_iter_connected(self, options):
+        conn = mprov.MProvConnection(itersize=3, **options)
+        conn.set_graph('iter-graph')
+        conn.create_or_reset_graph()
+
+        collection = conn.create_collection('paged_stream')
+        members = [conn.store_stream_tuple('paged_stream', i, {'name': 'tuple %d' % i}) for i in range(2, 12)]
+        for member in members:
+            conn.add_to_collection(member, collection)
+        conn.add_to_collection(members[0], collection)
+
+        # Each member once, in token order, while other queries run
+        streamed = []
+        for member in conn.iter_child_entities(collection):
+            assert conn.get_node(member)[0]['name'].startswith('tuple')
+            streamed.append(member)
+        assert streamed == sorted(members)
+
+        pages = []
+        after = None
+        while True:
+            page = list(conn.iter_child_entities(collection, after=after, limit=4))
+            if not page:
+                break
+            pages.append(page)
+            after = page[-1]
+        assert [len(page) for page in pages] == [4, 4, 2]
+        assert sum(pages, []) == sorted(members)
+        assert list(conn.iter_connected_to(conn.get_graph(), members[3], 'hadMember')) == [collection]
+        assert list(conn.iter_connected_from(conn.get_graph(), collection, 'wasDerivedFrom')) == []
+
+        assert dict(conn.iter_provenance_data(conn.get_graph(), members[3], itersize=1)) == \
+            conn.get_node(members[3])[0]
+        conn.create_or_reset_graph()
+        conn.close()
+
+    @pytest.mark.parametrize('options', [{}, {'layout': 'node_ids'}, {'layout': 'time'}, {'backend': 'memory'},
+                                         {'backend': 'sqlite'}])
+    def test_reachability(self, options, tmp_path):
+        if options.get('backend') == 'sqlite':
+            options = dict(options, path=str(tmp_path / 'reachability.db'))
+        conn = mprov.MProvConnection(reachability=ReachabilityIndex(), **options)
+        conn.set_graph('reachability-graph')
+        conn.create_or_reset_graph()
+
+        inputs = [conn.store_stream_tuple('raw', i, {'name': 'raw %d' % i}) for i in (2, 3)]
+        first = conn.store_windowed_result('cleaned', 2, {'name': 'cleaned'},
+                                           [conn.get_entity_id('raw', i) for i in (1, 2)], 'clean', None, None)
+        second = conn.store_derived_result('scored', 2, {'name': 'scored'}, first, 'score', None, None)
+        assert conn.depends_on(second, inputs[0]) and conn.depends_on(first, inputs[1])
+        assert not conn.depends_on(inputs[0], second)
+        assert not conn.depends_on(second, conn.get_token_qname(conn.get_entity_id('raw', 100)))
+
+        # The same answers as tracing lineage in the graph store, or loading the index from it
+        index = conn.reachability
+        ancestors = conn.ancestors(second)
+        assert first in ancestors and set(inputs) <= ancestors
+        conn.reachability = None
+        assert conn.ancestors(second) == ancestors
+        assert conn.depends_on(second, inputs[0])
+        conn.reachability = index
+        index.drop(conn.get_graph())
+        assert conn.ancestors(second) == ancestors
+
+        # Edges added later reach everything that depends on their source, without cycles
+        later = conn.store_stream_tuple('raw', 9, {'name': 'raw 9'})
+        conn.store_derived_from(inputs[0], later)
+        assert conn.depends_on(second, later)
+        conn.store_derived_from(later, second)
+        assert conn.depends_on(later, first) and second not in conn.ancestors(second)
+        assert index.get_stats()['graphs'] == 1
+        conn.create_or_reset_graph()
+        assert not conn.depends_on(second, inputs[0])
+        conn.close()
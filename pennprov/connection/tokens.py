@@ -0,0 +1,62 @@
+"""
+ Copyright 2021 Trustees of the University of Pennsylvania
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import binascii
+import hashlib
+
+
+class TokenGenerator:
+    """
+    A TokenGenerator creates the deterministic IDs of activity nodes, from the
+    name of the operator and the location (index or window) of the call.
+    """
+    def activity_id(self, operator, aid):
+        # type: (str, Any) -> str
+        raise NotImplementedError
+
+
+class Pbkdf2TokenGenerator(TokenGenerator):
+    """
+    The activity IDs of earlier releases: 20 rounds of PBKDF2-SHA256 over the
+    operator name concatenated with the location, as text whatever its type.
+    """
+    def activity_id(self, operator, aid):
+        # type: (str, Any) -> str
+        if aid:
+            dk = hashlib.pbkdf2_hmac('sha256', (operator + str(aid)).encode('utf-8'), b'prov', 20)
+        else:
+            dk = hashlib.pbkdf2_hmac('sha256', (operator).encode('utf-8'), b'prov', 20)
+
+        return binascii.hexlify(dk).decode('utf-8')
+
+
+class Blake2bTokenGenerator(TokenGenerator):
+    """
+    Activity IDs from a single BLAKE2b digest of a length-prefixed encoding of
+    the operator name and location, so that ('ab', 'c') and ('a', 'bc') differ.
+    IDs carry an 'a2.' prefix to keep them apart from PBKDF2 IDs.
+    """
+    prefix = 'a2.'
+
+    def __init__(self, digest_size=16):
+        # type: (int) -> None
+        self.digest_size = digest_size
+
+    def activity_id(self, operator, aid):
+        # type: (str, Any) -> str
+        h = hashlib.blake2b(digest_size=self.digest_size, person=b'mprov-activity')
+        for part in (operator, str(aid) if aid else ''):
+            data = part.encode('utf-8')
+            h.update(str(len(data)).encode('ascii') + b':' + data)
+
+        return self.prefix + h.hexdigest()
@@ -0,0 +1,138 @@
+"""
+ Copyright 2021 Trustees of the University of Pennsylvania
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import logging
+import queue
+import threading
+
+from pennprov.connection.batch import WriteBatch
+
+
+class BackgroundWriter:
+    """
+    BackgroundWriter drains WriteBatches from a bounded queue on a dedicated
+    thread, merging whatever has queued up into a single transaction.  When
+    the queue is full, submit() either blocks the caller or drops the batch,
+    depending on the policy.  Only the caller of on_written learns which
+    rows were committed; dropped and failed batches are not reported.
+    """
+    BLOCK = 'block'
+    DROP = 'drop'
+
+    def __init__(self, graph_conn, write, queue_size=10000, policy=BLOCK, max_batches=1000, on_written=None):
+        # type: (Any, Callable, int, str, int, Callable[[WriteBatch], None]) -> None
+        """
+        Start the writer thread
+        :param graph_conn: Database connection owned by the writer thread
+        :param write: Function taking (connection, WriteBatch) that writes and commits the batch
+        :param queue_size: Maximum number of batches waiting to be written
+        :param policy: BLOCK or DROP, for when the queue is full
+        :param max_batches: Maximum number of queued batches merged into one transaction
+        :param on_written: Function taking each WriteBatch once it has been committed, called
+            on the writer thread before flush() returns
+        """
+        if policy not in (self.BLOCK, self.DROP):
+            raise ValueError('Unknown queue policy ' + str(policy))
+
+        self.graph_conn = graph_conn
+        self.write = write
+        self.policy = policy
+        self.max_batches = max_batches
+        self.on_written = on_written
+        self.dropped = 0
+        self.written = 0
+        self.transactions = 0
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='mprov-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, batch):
+        # type: (WriteBatch) -> None
+        """
+        Queue a batch to be written by the writer thread
+        """
+        self._raise_error()
+        if self.policy == self.BLOCK:
+            self._queue.put(batch)
+        else:
+            try:
+                self._queue.put_nowait(batch)
+            except queue.Full:
+                self.dropped += 1
+                logging.warning('Provenance write queue is full, dropped %d rows', len(batch))
+
+    def flush(self):
+        """
+        Block until every queued batch has been committed
+        """
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """
+        Write any queued batches, then stop the writer thread
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self.graph_conn.close()
+        self._raise_error()
+
+    def get_stats(self):
+        # type: () -> Dict[str, int]
+        return {'queued': self._queue.qsize(),
+                'written': self.written,
+                'transactions': self.transactions,
+                'dropped': self.dropped}
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            count = 1
+            if item is None:
+                self._queue.task_done()
+                break
+
+            batch = WriteBatch()
+            batch.extend(item)
+            while count < self.max_batches:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                count += 1
+                if item is None:
+                    stop = True
+                    break
+                batch.extend(item)
+
+            try:
+                self.write(self.graph_conn, batch)
+                self.written += len(batch)
+                self.transactions += 1
+                if self.on_written is not None:
+                    self.on_written(batch)
+            except Exception as e:
+                logging.error('Provenance writer failed to write %d rows: %s', len(batch), e)
+                self._error = e
+            finally:
+                for i in range(count):
+                    self._queue.task_done()
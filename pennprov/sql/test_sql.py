@@ -7,15 +7,31 @@ from pennprov.api.decorators import MProvAgg
 import pandas as pd
 
 logging.basicConfig(level=logging.DEBUG)
-connection_key = MProvConnectionCache.Key()
-mprov_conn = MProvConnectionCache.get_connection(connection_key)
-if mprov_conn:
+
+
+def sql_provenance():
+    # type: () -> SqlProvenance
+    """
+    SqlProvenance over a graph of its own, reset, so these tests neither
+    depend on nor disturb the graph other tests share
+    """
+    mprov_conn = MProvConnectionCache.get_connection(MProvConnectionCache.Key(graph='sql-graph'))
+    if not mprov_conn:
+        raise RuntimeError('Could not connect')
     mprov_conn.create_or_reset_graph()
-else:
-    raise RuntimeError('Could not connect')
+    return SqlProvenance(mprov_conn)
+
 
+def check_query(query):
+    # type: (str) -> None
+    sql = sql_provenance()
+    token = sql.query_to_entity(query)
+    print(token)
+    assert sql.query_to_entity(query) == token
+    assert sql.mprov.get_node(token)[0]['code'] == query
 
-def simple_query():
+
+def test_simple_query():
     query = 'select * from test'
     parsed = """
 == Parsed Logical Plan ==
@@ -35,9 +51,10 @@ LogicalRDD [x#0L, y#1L, name#2], false
 *(1) Scan ExistingRDD[x#0L,y#1L,name#2]
     """
     print(parsed)
+    check_query(query)
 
 
-def join_query():
+def test_join_query():
     query = 'select t1.x, count(*) from test t1 join test t2 on t1.x = t2.y group by t1.x'
     parsed = """
 == Parsed Logical Plan ==
@@ -87,11 +104,5 @@ Aggregate [x#0L], [x#0L, count(1) AS count(1)#32L]
                      +- *(3) Scan ExistingRDD[x#28L,y#29L,name#30]
     """
     print(parsed)
+    check_query(query)
 
-
-sql = SqlProvenance(mprov_conn)
-
-print(sql.query_to_entity("test"))
-
-simple_query()
-join_query()